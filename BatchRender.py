@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+"""Filter many audio files offline on all cores.
+
+Each input is a file, a directory (every audio file in it) or a glob
+pattern (** for subdirectories). Files are filtered as by RenderFile
+into OUTDIR, under their paths from the directory all the inputs are
+in (so files of the same name in different directories are kept
+apart), by a pool of worker processes. Each
+worker keeps one olabatch and one Filters (with its compiled tables)
+per configuration and reuses them for every file it is given.
+
+A file longer than --split seconds is also split across the workers
+when the chain has no state that carries from block to block (a
+mapping without the noise filter; the noise average and the divider's
+phases do). The parent reads it into shared memory, each worker filters
+a range of whole blocks in place, starting from the 3 * overlap samples
+before its range, and the parent then joins the seams: olabatch's
+output depends on earlier blocks only through the running sum D and
+the previous half block (see OlaFFT.olabatch), which are linear, so
+each range is filtered from zero state and the sums of the ranges
+before it are added afterwards. The result matches filtering the file
+in one piece to rounding (--check compares them). The shared input has
+zero blocks after the end for the overlap-add's tail, and the file is
+written from latency_samples on, so that it lines up with the input as
+RenderFile's output does. A split file is held in shared memory twice
+over as float64, so no more than SPLITS of them are held at a time:
+the files before are reported (and a split one written) first.
+
+At the end the total audio, wall clock and CPU time are reported: the
+throughput in seconds of audio per second and the parallel efficiency
+(CPU time / (wall clock * jobs)).
+"""
+import argparse
+import glob
+import multiprocessing
+import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
+import os
+import time
+
+import numpy
+import soundfile as sf
+
+import Filters
+import OlaFFT
+import RenderFile
+
+SPLITS = 2  # Splits in shared memory at once: one filtered, one joined
+
+cache = {}  # in each worker: olabatch and Filters by configuration
+
+
+def tools(blocksize, samplerate, options):
+    # the olabatch and Filters this worker keeps for these settings
+    key = ("ola", blocksize)
+    if key not in cache:
+        cache[key] = OlaFFT.olabatch(blocksize)
+    ola = cache[key]
+    filters = None
+    if options["mode"] in ("fold", "linear", "nonlinear"):
+        key = ("filters", blocksize, samplerate, options["lower"],
+            options["upper"], options["maxbirdfreq"])
+        if key not in cache:
+            cache[key] = Filters.Filters(blocksize, samplerate,
+                lower=options["lower"], upper=options["upper"],
+                maxbirdfreq=options["maxbirdfreq"])
+        filters = cache[key]
+    return ola, filters
+
+
+def stateless(options):
+    return not options["noise"] and options["mode"] != "divide"
+
+
+def renderTask(infile, outfile, blocksize, chunk, options, subtype):
+    # a whole file in one worker
+    cpu = time.process_time()
+    samplerate = sf.info(infile).samplerate
+    ola, filters = tools(blocksize, samplerate, options)
+    duration, elapsed = RenderFile.render(infile, outfile, blocksize, chunk,
+        subtype=subtype, ola=ola, filters=filters, **options)
+    return duration, time.process_time() - cpu
+
+
+def rangeTask(inname, outname, shape, samplerate, begin, end, blocksize,
+              chunk, options):
+    """
+    Filters samples [begin, end) of the shared input into the shared
+    output from zero state and returns the state to join it with the
+    next range: the running sum and the last half block.
+    """
+    cpu = time.process_time()
+    inmemory = multiprocessing.shared_memory.SharedMemory(inname)
+    outmemory = multiprocessing.shared_memory.SharedMemory(outname)
+    try:
+        data = numpy.ndarray(shape, numpy.float64, inmemory.buf)
+        out = numpy.ndarray(shape, numpy.float64, outmemory.buf)
+        ola, filters = tools(blocksize, samplerate, options)
+        chain = RenderFile.makechain(blocksize, samplerate, shape[1],
+            filters=filters, **options)
+        h = blocksize // 2
+        history = numpy.zeros([h * 3, shape[1]])
+        before = data[max(begin - h * 3, 0):begin]
+        history[len(history) - len(before):] = before
+        ola.reset()
+        ola.history = history
+        ola.running = numpy.zeros([shape[1], h])
+        ola.second = numpy.zeros([shape[1], h])
+        step = blocksize * chunk
+        for i in range(begin, end, step):
+            out[i:min(i + step, end)] = ola.process(data[i:min(i + step, end)],
+                chain)
+        running, second = ola.running.copy(), ola.second.copy()
+        del data, out
+    finally:
+        inmemory.close()
+        outmemory.close()
+    return running, second, time.process_time() - cpu
+
+
+class Split(object):
+    """A long file split into ranges, filtered in shared memory."""
+    def __init__(self, infile, outfile, blocksize, jobs, subtype):
+        self.infile = infile
+        self.outfile = outfile
+        self.subtype = subtype
+        self.blocksize = blocksize
+        self.latency = OlaFFT.olabatch(blocksize).latency_samples
+        with sf.SoundFile(infile) as f:
+            self.frames = f.frames
+            self.samplerate = f.samplerate
+            # enough blocks for the tail to come out
+            blocks = -(-(f.frames + self.latency) // blocksize)
+            self.shape = (blocks * blocksize, f.channels)
+            size = max(int(numpy.prod(self.shape)) * 8, 1)
+            self.inmemory = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=size)
+            self.outmemory = multiprocessing.shared_memory.SharedMemory(
+                create=True, size=size)
+            self.data = numpy.ndarray(self.shape, numpy.float64,
+                self.inmemory.buf)
+            self.out = numpy.ndarray(self.shape, numpy.float64,
+                self.outmemory.buf)
+            self.data[f.frames:] = 0
+            f.read(out=self.data[:f.frames])
+        # whole blocks per range, about one range per job
+        bounds = numpy.linspace(0, blocks, min(jobs, blocks) + 1).astype(int)
+        self.ranges = [(a * blocksize, b * blocksize)
+            for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+
+    def submit(self, pool, chunk, options):
+        self.results = [pool.apply_async(rangeTask, (self.inmemory.name,
+            self.outmemory.name, self.shape, self.samplerate, begin, end,
+            self.blocksize, chunk, options)) for begin, end in self.ranges]
+
+    def finish(self):
+        """
+        Adds the sums carried over from the ranges before each range and
+        writes the file; returns the CPU time taken by the workers.
+        """
+        h = self.blocksize // 2
+        channels = self.shape[1]
+        carried = numpy.zeros([channels, h])  # D at the start of the range
+        second = numpy.zeros([channels, h])  # the last half block before it
+        cpu = 0.0
+        for (begin, end), result in zip(self.ranges, self.results):
+            running, last, seconds = result.get()
+            cpu += seconds
+            blocks = self.out[begin:end].reshape(-1, self.blocksize, channels)
+            blocks[0, :h] += second.T
+            blocks[1:, :h] += carried.T
+            blocks[:, h:] += carried.T
+            second = last + carried
+            carried = carried + running
+        sf.write(self.outfile, self.out[self.latency:self.latency
+            + self.frames], self.samplerate, subtype=self.subtype)
+        return cpu
+
+    def check(self, options):
+        # the largest difference from filtering the file in one piece
+        ola, filters = tools(self.blocksize, self.samplerate, options)
+        ola.reset()
+        whole = ola.process(self.data, RenderFile.makechain(self.blocksize,
+            self.samplerate, self.shape[1], filters=filters, **options))
+        return abs(whole - self.out).max()
+
+    def close(self):
+        del self.data, self.out
+        for memory in (self.inmemory, self.outmemory):
+            memory.close()
+            memory.unlink()
+
+
+def expand(inputs):
+    # files from names, directories and glob patterns, in order, once each
+    extensions = {"." + e.lower() for e in sf.available_formats()}
+    files = []
+    for name in inputs:
+        if os.path.isdir(name):
+            found = sorted(os.path.join(name, f) for f in os.listdir(name))
+        elif os.path.isfile(name):
+            found = [name]
+        else:
+            found = sorted(glob.glob(name, recursive=True))
+        files.extend(f for f in found if os.path.isfile(f)
+            and os.path.splitext(f)[1].lower() in extensions)
+    return list(dict.fromkeys(files))
+
+
+def outputs(files, outdir):
+    # the output of each file: its path from the inputs' common directory
+    paths = [os.path.abspath(f) for f in files]
+    root = os.path.commonpath([os.path.dirname(p) for p in paths])
+    return [os.path.join(outdir, os.path.relpath(p, root)) for p in paths]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', metavar='INPUT', nargs='+',
+        help='audio file, directory or glob pattern')
+    parser.add_argument('-o', '--outdir', required=True,
+        help='directory for the filtered files')
+    RenderFile.addoptions(parser)
+    parser.add_argument('--chunk', type=int, default=256,
+        help='blocks processed at a time (default: %(default)s)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+        help='worker processes (default: %(default)s)')
+    parser.add_argument('--split', type=float, default=60.0,
+        help='split files longer than this many seconds across the '
+             'workers (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+        help='compare split files with filtering them in one piece')
+    args = parser.parse_args()
+    if args.chunk < 1 or args.jobs < 1:
+        parser.error('chunk and jobs must be at least 1')
+
+    files = expand(args.inputs)
+    if not files:
+        parser.error('no audio files found')
+    os.makedirs(args.outdir, exist_ok=True)
+    options = RenderFile.settings(args)
+
+    began = time.perf_counter()
+    duration = 0.0
+    cpu = 0.0
+    failed = 0
+    # one resource tracker, shared by the workers, so that the shared 
+    # memory they attach to is only unlinked by this process
+    multiprocessing.resource_tracker.ensure_running()
+    with multiprocessing.Pool(args.jobs) as pool:
+        tasks = []  # (infile, seconds, task) not yet reported, in order
+
+        def drain(held=None):
+            # report the files submitted so far, in order, until no more
+            # than 'held' Splits are left holding their shared memory (or
+            # all of them)
+            nonlocal cpu, duration, failed
+            while tasks and (held is None or sum(isinstance(task, Split)
+                    for _, _, task in tasks) > held):
+                infile, seconds, task = tasks.pop(0)
+                try:
+                    if isinstance(task, Split):
+                        try:
+                            cpu += task.finish()
+                            note = "split in %d" % len(task.ranges)
+                            if args.check:
+                                note += (", largest difference from one "
+                                         "piece %.3g" % task.check(options))
+                        finally:
+                            task.close()
+                    else:
+                        cpu += task.get()[1]
+                        note = ""
+                except Exception as e:
+                    print("%s: %s: %s" % (infile, type(e).__name__, e))
+                    failed += 1
+                    continue
+                duration += seconds
+                print("%8.1f s  %s %s" % (seconds, infile, note))
+
+        for infile, outfile in zip(files, outputs(files, args.outdir)):
+            if os.path.abspath(outfile) == os.path.abspath(infile):
+                print("skipping %s: would overwrite it" % infile)
+                failed += 1
+                continue
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            try:
+                info = sf.info(infile)
+            except RuntimeError as e:
+                print("skipping %s: %s" % (infile, e))
+                failed += 1
+                continue
+            if (stateless(options) and args.jobs > 1
+                    and info.duration > args.split):
+                # a Split reads its whole file into shared memory (twice,
+                # as float64), so finish the earlier ones first
+                drain(SPLITS - 1)
+                split = Split(infile, outfile, args.blocksize, args.jobs,
+                    args.subtype)
+                split.submit(pool, args.chunk, options)
+                tasks.append((infile, info.duration, split))
+            else:
+                tasks.append((infile, info.duration, pool.apply_async(
+                    renderTask, (infile, outfile, args.blocksize, args.chunk,
+                    options, args.subtype))))
+        drain()
+
+    elapsed = time.perf_counter() - began
+    print("%d files (%d failed), %.1f s of audio in %.2f s: %.0fx real time, "
+          "%.1f s CPU in %d jobs (%.0f%% efficiency)" % (len(files), failed,
+          duration, elapsed, duration / elapsed, cpu, args.jobs,
+          100 * cpu / (elapsed * args.jobs)))
+
+
+if __name__ == "__main__":
+    main()
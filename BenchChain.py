@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Measure whether the DSP chain keeps up in real time, without a device.
+
+Drives the same per-block chain as PySongFinder's callback (olafft rfft,
+DC removal, NoiseFilter.averageNoise or with --noise-type wiener the
+NoiseSuppressor, a Filters mapping, olafft irfft) on
+all channels, for every combination of blocksize, sampling rate,
+mono/stereo input and source. Sources are 'synthetic' (noise plus a
+swept tone) and the files in samples/ (looped to length; their own
+sampling rate is ignored, only the content matters).
+
+For each configuration it reports the per-block processing time (p50,
+p99, max), the real-time factor (processing time / audio time, which
+must stay well below 1), the number of blocks over their frames /
+samplerate budget, and the peak bytes allocated within a block (from
+tracemalloc, in a separate untimed pass).
+
+-o saves the results as JSON with the git commit, machine and library
+versions; --compare prints the change in p50/p99 against an earlier
+JSON file so regressions can be spotted between commits.
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy
+
+import OlaFFT
+import Filters
+import NoiseFilter
+import NoiseSuppressor
+
+BLOCKSIZES = (256, 512, 1024, 2048, 4096)
+SAMPLERATES = (44100, 48000, 96000)
+CHANNELS = (1, 2)
+
+
+def synthetic(length, samplerate, channels):
+    # low level noise plus a tone sweeping 200 Hz - 12 kHz once a second
+    t = numpy.arange(length) / samplerate
+    sweep = numpy.sin(2 * numpy.pi * (200 * t + 11800 / 2 * (t % 1.0) ** 2))
+    data = 0.05 * numpy.random.standard_normal([length, channels])
+    data += 0.5 * sweep[:, numpy.newaxis]
+    return data
+
+
+def samplefile(filename, length, channels):
+    import soundfile as sf
+    data, _ = sf.read(filename, always_2d=True)
+    data = numpy.resize(data, [length, data.shape[1]])  # loop to length
+    if data.shape[1] >= channels:
+        return data[:, :channels]
+    return numpy.repeat(data[:, :1], channels, axis=1)
+
+
+class Chain(object):
+    """The PySongFinder callback on all channels, writing into out."""
+    def __init__(self, blocksize, samplerate, mode="fold", noise=True,
+                 backend="numpy", noisetype="average"):
+        self.ola = OlaFFT.olafft(blocksize, ring=True, backend=backend)
+        self.filters = Filters.Filters(blocksize, samplerate)
+        self.mapping = getattr(self.filters, mode)
+        self.denoise = None
+        if noise and noisetype == "wiener":
+            self.denoise = NoiseSuppressor.NoiseSuppressor(blocksize,
+                samplerate, channels=2).suppress
+        elif noise:
+            self.denoise = NoiseFilter.NoiseFilter(blocksize, samplerate,
+                channels=2).averageNoise
+
+    def __call__(self, indata, out):
+        freqdata = self.ola.rfft(indata)
+        freqdata[0] = 0
+        if self.denoise is not None:
+            self.denoise(freqdata)
+        self.mapping(freqdata)
+        self.ola.irfft(freqdata, out=out)
+
+
+def measure(chain, data, blocksize, samplerate, warmup=5):
+    nblocks = len(data) // blocksize
+    out = numpy.zeros([blocksize, 2])
+    for i in range(min(warmup, nblocks)):
+        chain(data[i * blocksize:(i + 1) * blocksize], out)
+
+    times = numpy.zeros(nblocks)
+    clock = time.perf_counter
+    for i in range(nblocks):
+        block = data[i * blocksize:(i + 1) * blocksize]
+        start = clock()
+        chain(block, out)
+        times[i] = clock() - start
+
+    # allocations, untimed since tracemalloc slows everything down
+    peak = 0
+    tracemalloc.start()
+    for i in range(min(10, nblocks)):
+        block = data[i * blocksize:(i + 1) * blocksize]
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        chain(block, out)
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+
+    budget = blocksize / samplerate
+    return {
+        "p50_us": numpy.percentile(times, 50) * 1e6,
+        "p99_us": numpy.percentile(times, 99) * 1e6,
+        "max_us": times.max() * 1e6,
+        "mean_us": times.mean() * 1e6,
+        "budget_us": budget * 1e6,
+        "rtf": times.sum() / (nblocks * budget),
+        "misses": int((times > budget).sum()),
+        "alloc_bytes": int(peak),
+        "blocks": nblocks,
+    }
+
+
+def machine():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"],
+            capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+    }
+
+
+def key(result):
+    return (result["source"], result["blocksize"], result["samplerate"],
+            result["channels"])
+
+
+def compare(results, filename):
+    with open(filename) as f:
+        old = {key(r): r for r in json.load(f)["results"]}
+    print()
+    print("change against %s:" % filename)
+    for result in results:
+        before = old.get(key(result))
+        if before is None or "error" in before or "error" in result:
+            continue
+        print("%-12s %5d %6d %d  p50 %+6.1f%%  p99 %+6.1f%%" % (key(result) + (
+            100 * (result["p50_us"] / before["p50_us"] - 1),
+            100 * (result["p99_us"] / before["p99_us"] - 1))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-b', '--blocksize', type=int, action='append',
+        help='block size, may be repeated (default: 256 to 4096)')
+    parser.add_argument('-r', '--samplerate', type=int, action='append',
+        help='sampling rate, may be repeated (default: 44100, 48000, 96000)')
+    parser.add_argument('-c', '--channels', type=int, action='append',
+        choices=CHANNELS, help='input channels, may be repeated '
+                               '(default: 1 and 2)')
+    parser.add_argument('-s', '--source', action='append',
+        help="'synthetic' or an audio file, may be repeated "
+             "(default: synthetic and samples/*.wav)")
+    parser.add_argument('-n', '--blocks', type=int, default=200,
+        help='blocks timed per configuration (default: %(default)s)')
+    parser.add_argument('-m', '--mode', default='fold',
+        choices=['fold', 'linear', 'nonlinear'],
+        help='frequency mapping (default: %(default)s)')
+    parser.add_argument('--no-noise', action='store_true',
+        help='leave out the noise filter')
+    parser.add_argument('--noise-type', default='average',
+        choices=['average', 'wiener'],
+        help='NoiseFilter averaging or the NoiseSuppressor '
+             '(default: %(default)s)')
+    parser.add_argument('--fft', default='numpy',
+        help='FFT backend: numpy, scipy, fftw or auto (default: %(default)s)')
+    parser.add_argument('-o', '--output', help='save results as JSON')
+    parser.add_argument('--compare', metavar='JSON',
+        help='compare against results saved earlier')
+    args = parser.parse_args()
+
+    sources = args.source or ["synthetic"] + sorted(glob.glob(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "samples", "*.wav")))
+
+    results = []
+    print("%-12s %5s %6s %2s %9s %9s %9s %9s %7s %6s %9s" % ("source",
+        "block", "rate", "ch", "p50 us", "p99 us", "max us", "budget us",
+        "rtf", "misses", "alloc B"))
+    for source in sources:
+        name = os.path.basename(source)[:12]
+        for blocksize in args.blocksize or BLOCKSIZES:
+            for samplerate in args.samplerate or SAMPLERATES:
+                for channels in args.channels or CHANNELS:
+                    length = blocksize * args.blocks
+                    if source == "synthetic":
+                        data = synthetic(length, samplerate, channels)
+                    else:
+                        data = samplefile(source, length, channels)
+                    if channels == 1:
+                        data = data[:, 0]
+                    result = {"source": name, "blocksize": blocksize,
+                              "samplerate": samplerate, "channels": channels}
+                    try:
+                        chain = Chain(blocksize, samplerate, args.mode,
+                            not args.no_noise, args.fft, args.noise_type)
+                        result.update(measure(chain, data, blocksize,
+                            samplerate))
+                    except Exception as e:
+                        result["error"] = type(e).__name__ + ': ' + str(e)
+                        print("%-12s %5d %6d %2d %s" % (key(result) + (
+                            result["error"],)))
+                        results.append(result)
+                        continue
+                    results.append(result)
+                    print("%-12s %5d %6d %2d %9.1f %9.1f %9.1f %9.1f %7.4f "
+                          "%6d %9d" % (key(result) + (result["p50_us"],
+                          result["p99_us"], result["max_us"],
+                          result["budget_us"], result["rtf"],
+                          result["misses"], result["alloc_bytes"])))
+
+    if args.output:
+        settings = {"mode": args.mode, "noise": not args.no_noise,
+                    "noisetype": args.noise_type, "fft": args.fft,
+                    "blocks": args.blocks}
+        with open(args.output, "w") as f:
+            json.dump({"machine": machine(), "settings": settings,
+                       "results": results}, f, indent=1)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Time olafft per block, shifting buffers against ring=True.
+
+Runs rfft + irfft on random stereo blocks for each blocksize and prints
+the mean time per block, the real-time budget of a block at the given
+sampling rate, and the peak bytes allocated while processing blocks
+with ring=True (from tracemalloc, which NumPy reports its array buffers
+to). With the numpy backend nearly all of that is numpy.fft's internal
+scratch space; pyFFTW (--fft fftw) plans do not allocate. With --mono
+the ring is also timed with layout="mono", which transforms the one
+channel once instead of copying it to two.
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy
+
+import OlaFFT
+
+
+def run(ola, blocks):
+    freqdata = ola.rfft(blocks[0])
+    ola.irfft(freqdata)  # warm up
+    start = time.perf_counter()
+    for block in blocks:
+        freqdata = ola.rfft(block)
+        ola.irfft(freqdata)
+    return (time.perf_counter() - start) / len(blocks)
+
+
+def allocated(ola, blocks):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    for block in blocks:
+        freqdata = ola.rfft(block)
+        ola.irfft(freqdata)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return max(peak - base, 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samplerate', type=float, default=44100,
+        help='sampling rate used for the budget (default: %(default)s)')
+    parser.add_argument('-n', '--blocks', type=int, default=200,
+        help='blocks timed per blocksize (default: %(default)s)')
+    parser.add_argument('--mono', action='store_true',
+        help='feed mono blocks')
+    parser.add_argument('--fft', default='numpy',
+        help='FFT backend for ring=True: numpy, scipy, fftw or auto '
+             '(default: %(default)s)')
+    args = parser.parse_args()
+
+    print("%9s %12s %12s %8s %12s %12s" % ("blocksize", "shift us",
+        "ring us", "speedup", "budget us", "ring bytes")
+        + (" %12s" % "mono us" if args.mono else ""))
+    for blocksize in (256, 512, 1024, 2048, 4096):
+        shape = [blocksize] if args.mono else [blocksize, 2]
+        blocks = [numpy.random.random(shape) - 0.5 for _ in range(args.blocks)]
+
+        shift = run(OlaFFT.olafft(blocksize), blocks)
+        ring = run(OlaFFT.olafft(blocksize, ring=True, backend=args.fft),
+            blocks)
+        ola = OlaFFT.olafft(blocksize, ring=True, backend=args.fft)
+        run(ola, blocks[:2])
+        bytes = allocated(ola, blocks[:20])
+        mono = ""
+        if args.mono:
+            mono = " %12.1f" % (run(OlaFFT.olafft(blocksize, ring=True,
+                backend=args.fft, layout="mono"), blocks) * 1e6)
+
+        print("%9d %12.1f %12.1f %7.2fx %12.1f %12d" % (blocksize,
+            shift * 1e6, ring * 1e6, shift / ring,
+            blocksize / args.samplerate * 1e6, bytes) + mono)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""Change PySongFinder's filters while it runs, from another program.
+
+A Server runs an asyncio server on a thread of its own beside the audio
+stream, on a Unix socket (ADDRESS is a path) or on localhost TCP
+(ADDRESS is PORT or localhost:PORT). The protocol is one JSON object per
+line each way:
+
+    {"cmd": "set", "upper": 5000, "mode": "linear"}
+    {"cmd": "status"}
+
+set changes any of lower, upper, maxbirdfreq (Hz), alpha (the noise
+smoothing per block), mode, noise (true or false), noisetype (average
+or wiener: NoiseFilter or NoiseSuppressor) and divisor. The server
+checks them and calls the program's apply(changes) in a thread pool,
+so the new Filters tables are made off both the audio thread and the
+server's loop (which goes on answering); apply builds the new
+FilterChain and hands it to the callback with FilterChain.Slot.swap,
+which the callback picks up at the next block boundary. status returns
+the settings, the chain, the callback's load (Monitor.Load) and, with
+--govern, the Governor's tier. Each reply has "ok", and "error" when it
+is false.
+
+Run this file to send a command:
+
+    python ControlServer.py /tmp/songfinder set upper=5000 mode=linear
+    python ControlServer.py 8765 status
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+MODES = ("fold", "linear", "nonlinear", "divide", "none")
+NOISETYPES = ("average", "wiener")
+PARAMETERS = {"lower": float, "upper": float, "maxbirdfreq": float,
+              "alpha": float, "mode": str, "noise": bool, "divisor": int,
+              "noisetype": str}
+LOCAL = ("localhost", "127.0.0.1", "::1")
+
+
+def address(text):
+    # ("unix", path) or ("tcp", host, port)
+    host, _, port = text.rpartition(":")
+    if port.isdigit():
+        host = host.strip("[]") or "127.0.0.1"
+        if host not in LOCAL:
+            raise ValueError("the control server only listens on localhost")
+        return ("tcp", host, int(port))
+    return ("unix", text)
+
+
+def parse(request):
+    # the settings in a set request, as their types
+    changes = {}
+    for key, value in request.items():
+        if key not in PARAMETERS:
+            raise ValueError("unknown setting %r: use %s" % (key,
+                ", ".join(PARAMETERS)))
+        kind = PARAMETERS[key]
+        if kind is bool:
+            if value not in (True, False, 0, 1):
+                raise ValueError("%s must be true or false" % key)
+            value = bool(value)
+        elif kind is str:
+            value = str(value)
+        elif isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError("%s must be a number" % key)
+        changes[key] = kind(value)
+    return changes
+
+
+def check(settings, samplerate):
+    # raises ValueError unless the whole set of settings makes sense
+    if settings["mode"] not in MODES:
+        raise ValueError("mode must be one of " + ", ".join(MODES))
+    if settings["noisetype"] not in NOISETYPES:
+        raise ValueError("noisetype must be one of " + ", ".join(NOISETYPES))
+    if settings["divisor"] not in (2, 3, 4):
+        raise ValueError("divisor must be 2, 3 or 4")
+    if not 0 < settings["alpha"] <= 1:
+        raise ValueError("alpha must be above 0 and at most 1")
+    if not (0 <= settings["lower"] < settings["upper"]
+            <= settings["maxbirdfreq"] <= samplerate / 2):
+        raise ValueError("need 0 <= lower < upper <= maxbirdfreq <= %g"
+            % (samplerate / 2))
+
+
+class Server(object):
+    """
+    apply(changes) is called off the audio thread with the parsed
+    changes of each set request and returns the settings now in force
+    (raising ValueError to refuse them); status() returns a dict for the
+    status request. Call start() once the stream is running and close()
+    when it stops.
+    """
+    def __init__(self, where, apply, status):
+        self.where = address(where)
+        self.apply = apply
+        self.status = status
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+        self.requests = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=asyncio.run,
+            args=(self.serve(),), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = self.loop.create_future()
+        try:
+            if self.where[0] == "unix":
+                path = self.where[1]
+                if os.path.lexists(path):
+                    # a socket left by a run that died; anything else
+                    # there is not ours to remove
+                    if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                        raise FileExistsError("%s exists and is not a "
+                            "socket" % path)
+                    os.remove(path)
+                server = await asyncio.start_unix_server(self.handle,
+                    self.where[1])
+            else:
+                server = await asyncio.start_server(self.handle,
+                    self.where[1], self.where[2])
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.ready.set()
+        async with server:
+            await self.stopping
+        if self.where[0] == "unix" and os.path.exists(self.where[1]):
+            os.remove(self.where[1])
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.answer(line)
+                writer.write(json.dumps(reply).encode() + b"\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, line):
+        self.requests += 1
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError("a request is a JSON object")
+            command = request.pop("cmd", "status")
+            if command == "status":
+                return dict(self.status(), ok=True)
+            if command != "set":
+                raise ValueError("unknown cmd %r: use set or status"
+                    % command)
+            changes = parse(request)
+            began = time.perf_counter()
+            settings = await self.loop.run_in_executor(None, self.apply,
+                changes)
+            return {"ok": True, "settings": settings,
+                    "built_ms": (time.perf_counter() - began) * 1e3}
+        except ValueError as e:  # json's errors are ValueErrors too
+            return {"ok": False, "error": str(e)}
+        except Exception as e:
+            # anything else (a failed rebuild, say) is still answered,
+            # and the connection kept open
+            return {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+
+    def close(self):
+        if self.loop is not None and not self.stopping.done():
+            self.loop.call_soon_threadsafe(self.stopping.set_result, None)
+        if self.thread is not None:
+            self.thread.join(5.0)
+
+
+def request(where, message, timeout=10.0):
+    # send one request and return the reply (a blocking client)
+    where = address(where)
+    if where[0] == "unix":
+        connection = socket.socket(socket.AF_UNIX)
+        connection.settimeout(timeout)
+        connection.connect(where[1])
+    else:
+        connection = socket.create_connection(where[1:], timeout)
+    with connection, connection.makefile("rwb") as f:
+        f.write(json.dumps(message).encode() + b"\n")
+        f.flush()
+        return json.loads(f.readline())
+
+
+def value(text):
+    # a command line value as JSON if it is JSON, else a string
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('address', metavar='ADDRESS',
+        help='the socket path or [localhost:]PORT given to --control')
+    parser.add_argument('command', choices=['status', 'set'])
+    parser.add_argument('settings', nargs='*', metavar='KEY=VALUE',
+        help='for set: %s' % ', '.join(PARAMETERS))
+    args = parser.parse_args()
+    message = {"cmd": args.command}
+    for setting in args.settings:
+        key, equals, text = setting.partition("=")
+        if not equals:
+            parser.error('settings are KEY=VALUE')
+        message[key] = value(text)
+    try:
+        reply = request(args.address, message)
+    except (OSError, ValueError) as e:
+        parser.exit(1, "%s: %s\n" % (type(e).__name__, e))
+    print(json.dumps(reply, indent=2))
+    if not reply.get("ok"):
+        parser.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Uniformly partitioned convolution, for long FIR filters such as a
+per-ear prescription EQ. The impulse response is cut into partitions of
+blocksize taps and each is transformed once (2 * blocksize point rfft).
+Every block, the last two blocks of input are transformed, the spectrum
+goes into a frequency-domain delay line and the output spectrum is the
+sum over partitions of (input spectrum from p blocks ago) * (partition
+p): one complex multiply-accumulate per partition, done for all of them
+and all channels in one numpy.einsum. The second half of its irfft is
+the output (overlap-save).
+
+Output block t includes input block t, so the only delay is the block
+itself (latency_samples is 0) however long the filter. The delay line is
+stored twice, like olafft's ring, so the partitions are always in order
+without shifting. All arrays are allocated in the constructor.
+
+The impulse response is (taps,) for every channel or (taps, channels),
+e.g. a WAV file with the left and right ear filters as its channels
+(see load). firFromCurve makes a linear-phase FIR from an EQ curve.
+
+dtype is the sample format, as for olafft: float64, float32 (worked in 
+float32 and complex64 throughout) or int16 (worked in float32 at int16 
+scale, since the filter is linear, and rounded and clipped on output).
+"""
+import numpy
+
+import FFTBackends
+import OlaFFT
+
+
+class Convolver(object):
+    latency_samples = 0
+
+    def __init__(self, ir, blocksize, channels=2, backend="numpy", dtype=None):
+        ir = numpy.asarray(ir, dtype=numpy.float64)
+        if ir.ndim == 1:
+            ir = numpy.repeat(ir[:, numpy.newaxis], channels, axis=1)
+        if ir.shape[1] == 1:
+            ir = numpy.repeat(ir, channels, axis=1)
+        if ir.shape[1] != channels:
+            raise ValueError("impulse response has %d channels, not %d"
+                % (ir.shape[1], channels))
+        self.blocksize = blocksize
+        self.channels = channels
+        self.dtype = numpy.dtype(dtype or numpy.float64)
+        real, scale = OlaFFT.precision(self.dtype)
+        self.integer = scale is not None
+        self.backend = FFTBackends.get(backend, shape=[blocksize * 2, channels],
+            dtype=real)
+        complex_ = numpy.result_type(real, numpy.complex64)
+
+        # partitions, zero padded to 2 * blocksize and transformed, oldest
+        # first so that they line up with the delay line
+        self.partitions = -(-len(ir) // blocksize)
+        padded = numpy.zeros([self.partitions, blocksize * 2, channels])
+        for p in range(self.partitions):
+            part = ir[p * blocksize:(p + 1) * blocksize]
+            padded[p, :len(part)] = part
+        self.filters = numpy.fft.rfft(padded, axis=1)[::-1].astype(complex_)
+
+        self.input = numpy.zeros([blocksize * 2, channels], dtype=real)
+        self.spectrum = numpy.zeros([blocksize + 1, channels], dtype=complex_)
+        self.delayline = numpy.zeros(
+            [self.partitions * 2, blocksize + 1, channels], dtype=complex_)
+        self.slot = 0
+        self.sum = numpy.zeros([blocksize + 1, channels], dtype=complex_)
+        self.result = numpy.zeros([blocksize * 2, channels], dtype=real)
+        self.output = numpy.zeros([blocksize, channels], dtype=self.dtype)
+
+    def process(self, indata, out=None):
+        # indata and out may be the same array
+        n = self.blocksize
+        if indata.ndim == 1:
+            indata = indata[:, numpy.newaxis]
+        self.input[:n] = self.input[n:]
+        self.input[n:] = indata
+        self.backend.rfft(self.input, out=self.spectrum)
+
+        # newest spectrum goes in slot and slot + partitions; the
+        # partitions before it are then slot + 1 .. slot + partitions
+        p = self.partitions
+        self.slot = (self.slot + 1) % p
+        self.delayline[self.slot] = self.spectrum
+        self.delayline[self.slot + p] = self.spectrum
+        numpy.einsum("pkc,pkc->kc", self.delayline[self.slot + 1:self.slot + p + 1],
+            self.filters, out=self.sum)
+
+        self.backend.irfft(self.sum, out=self.result)
+        if out is None:
+            out = self.output
+        if self.integer:
+            OlaFFT.toint16(self.result[n:], out, self.result[:n])
+        else:
+            out[:] = self.result[n:]
+        return out
+
+
+def load(filename):
+    """
+    Reads an impulse response: a .npy array or an audio file (with one
+    channel per ear), returned as (taps, channels).
+    """
+    if filename.endswith(".npy"):
+        ir = numpy.load(filename)
+    else:
+        import soundfile as sf
+        ir = sf.read(filename, always_2d=True)[0]
+    if ir.ndim == 1:
+        ir = ir[:, numpy.newaxis]
+    return ir
+
+
+def firFromCurve(frequencies, gains, taps, samplerate):
+    """
+    A linear-phase FIR of taps (odd) taps whose response follows gains
+    (dB) at frequencies (Hz), interpolated linearly in between and held
+    at the ends. Pass a list of curves (one per ear) for a (taps, ears)
+    result. The delay is (taps - 1) / 2 samples.
+    """
+    curves = numpy.atleast_2d(gains)
+    size = 1 << int(numpy.ceil(numpy.log2(taps * 4)))
+    bins = numpy.arange(size // 2 + 1) * samplerate / size
+    irs = []
+    for curve in curves:
+        response = 10.0 ** (numpy.interp(bins, frequencies, curve) / 20.0)
+        ir = numpy.roll(numpy.fft.irfft(response, size), taps // 2)[:taps]
+        irs.append(ir * numpy.hanning(taps + 2)[1:-1])
+    return numpy.column_stack(irs)
+
+
+def main():
+    blocksize = 256
+    ir = numpy.random.standard_normal([3000, 2]) * numpy.exp(
+        -numpy.arange(3000) / 500.0)[:, numpy.newaxis]
+    convolver = Convolver(ir, blocksize)
+    x = numpy.random.standard_normal([blocksize * 40, 2])
+    y = numpy.concatenate([convolver.process(x[i:i + blocksize]).copy()
+        for i in range(0, len(x), blocksize)])
+    for c in range(2):
+        expected = numpy.convolve(x[:, c], ir[:, c])[:len(x)]
+        print("channel", c, "largest difference from numpy.convolve:",
+            abs(y[:, c] - expected).max())
+
+    fir = firFromCurve([250, 1000, 2000, 4000], [[0, 5, 15, 25], [0, 0, 10, 20]],
+        1023, 44100)
+    response = 20 * numpy.log10(abs(numpy.fft.rfft(fir, 44100, axis=0)))
+    print("EQ at 250, 1000, 2000, 4000 Hz:", response[[250, 1000, 2000, 4000]].round(1).T)
+
+
+if __name__ == "__main__":
+    main()
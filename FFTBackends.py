@@ -0,0 +1,239 @@
+"""
+FFT backends for olafft and wireFFT. Each backend has rfft(x, out=None,
+axis=0) and irfft(X, out=None, axis=0) that behave like numpy.fft.rfft and
+irfft (irfft always returns the even length 2 * (nbins - 1)). If out is
+given the result is written into it and out is returned.
+
+    numpy  numpy.fft; writes straight into out with NumPy 2.
+    scipy  scipy.fft with workers (threads for multichannel arrays) and
+           overwrite_x, which lets it reuse the input as scratch.
+    fftw   pyFFTW, with an FFTW plan built once for each array shape.
+
+Each backend keeps one plan (or, for numpy and scipy, the keyword
+arguments to use) per (shape, dtype, axis, direction), so for a stream
+that is one per (blocksize, channels, dtype). get() hands out one shared
+backend per name and options so every olafft with the same settings
+shares its plans.
+
+autotune() times every installed backend on a given array shape and
+returns the fastest, so 'auto' picks the best backend for this machine
+at startup. scipy and pyFFTW are optional; available() lists what can be
+used. With TableCache enabled, FFTW's wisdom and the autotune results
+are kept on disk, so neither is measured again on the next start. The
+wisdom is saved by saveplans() once the plans are made (autotune and
+PySongFinder call it after planning) and at exit, not for every plan.
+"""
+import atexit
+import importlib.util
+import inspect
+import time
+
+import numpy
+
+import TableCache
+
+# numpy.fft.rfft/irfft accept out= from NumPy 2.0
+FFT_OUT = "out" in inspect.signature(numpy.fft.rfft).parameters
+
+NAMES = ("numpy", "scipy", "fftw")
+MODULES = {"numpy": "numpy", "scipy": "scipy", "fftw": "pyfftw"}
+
+
+class Backend(object):
+    name = None
+
+    def __init__(self):
+        self.plans = {}
+
+    def plan(self, data, axis, inverse):
+        key = (data.shape, data.dtype, axis, inverse)
+        if key not in self.plans:
+            self.plans[key] = self.makeplan(data, axis, inverse)
+        return self.plans[key]
+
+    def rfft(self, x, out=None, axis=0):
+        return self.plan(x, axis, False)(x, out)
+
+    def irfft(self, X, out=None, axis=0):
+        return self.plan(X, axis, True)(X, out)
+
+    def saveplans(self):
+        # keep what planning learnt (in TableCache, if enabled)
+        pass
+
+
+class NumpyBackend(Backend):
+    name = "numpy"
+
+    def makeplan(self, data, axis, inverse):
+        function = numpy.fft.irfft if inverse else numpy.fft.rfft
+
+        def run(x, out):
+            if out is None:
+                return function(x, axis=axis)
+            if FFT_OUT:
+                return function(x, axis=axis, out=out)
+            out[...] = function(x, axis=axis)
+            return out
+        return run
+
+
+class ScipyBackend(Backend):
+    name = "scipy"
+
+    def __init__(self, workers=None, overwrite=False):
+        Backend.__init__(self)
+        import scipy.fft
+        self.fft = scipy.fft
+        self.workers = workers
+        self.overwrite = overwrite
+
+    def makeplan(self, data, axis, inverse):
+        function = self.fft.irfft if inverse else self.fft.rfft
+        options = dict(axis=axis, workers=self.workers,
+            overwrite_x=self.overwrite)
+
+        def run(x, out):
+            if out is None:
+                return function(x, **options)
+            out[...] = function(x, **options)
+            return out
+        return run
+
+
+class FFTWBackend(Backend):
+    name = "fftw"
+
+    def __init__(self, threads=1, effort="FFTW_MEASURE"):
+        Backend.__init__(self)
+        import pyfftw
+        import pyfftw.builders
+        self.pyfftw = pyfftw
+        self.builders = pyfftw.builders
+        self.threads = threads
+        self.effort = effort
+        # the wisdom of earlier runs, so measured plans are made at once
+        self.wisdomkey = ("wisdom", pyfftw.__version__)
+        wisdom = TableCache.load("fftw", self.wisdomkey)
+        if wisdom is not None:
+            pyfftw.import_wisdom(tuple(bytes(wisdom["w%d" % i])
+                for i in range(len(wisdom))))
+        self.unsaved = False  # plans made since the wisdom was saved
+        atexit.register(self.saveplans)
+
+    def makeplan(self, data, axis, inverse):
+        # planned on a scratch array so planning leaves data alone. The
+        # plan may destroy its input, so run copies x into the plan's own
+        # input array: given an aligned x of the right shape, fftw(x) would
+        # use (and, for irfft, overwrite) x itself.
+        build = self.builders.irfft if inverse else self.builders.rfft
+        fftw = build(numpy.zeros_like(data), axis=axis,
+            overwrite_input=True, threads=self.threads,
+            planner_effort=self.effort)
+        self.unsaved = True
+
+        def run(x, out):
+            fftw.input_array[...] = x
+            result = fftw()
+            if out is None:
+                return result.copy()
+            out[...] = result
+            return out
+        return run
+
+    def saveplans(self):
+        # the whole wisdom, once, rather than after every plan
+        if self.unsaved:
+            self.unsaved = False
+            TableCache.save("fftw", self.wisdomkey, **{"w%d" % i:
+                numpy.frombuffer(w, dtype=numpy.uint8)
+                for i, w in enumerate(self.pyfftw.export_wisdom())})
+
+
+backends = {}  # shared backends by (name, options)
+tuned = {}  # autotune results by (shape, dtype)
+
+
+def available():
+    return [name for name in NAMES
+            if importlib.util.find_spec(MODULES[name]) is not None]
+
+
+def get(name="numpy", shape=None, dtype=numpy.float64, **options):
+    """
+    Returns the shared backend called name ('numpy', 'scipy', 'fftw' or
+    'auto'); a Backend instance is returned unchanged. options go to the
+    backend (workers/overwrite for scipy, threads/effort for fftw). 'auto'
+    runs autotune on shape, the (frame, channels) array to be transformed.
+    """
+    if isinstance(name, Backend):
+        return name
+    if name is None:
+        name = "numpy"
+    name = name.lower()
+    if name == "auto":
+        if shape is None:
+            raise ValueError("autotuning needs the shape of the data")
+        name = autotune(shape, dtype)[0]
+        options = {}
+    key = (name, tuple(sorted(options.items())))
+    if key not in backends:
+        if name == "numpy":
+            backends[key] = NumpyBackend(**options)
+        elif name == "scipy":
+            backends[key] = ScipyBackend(**options)
+        elif name == "fftw":
+            backends[key] = FFTWBackend(**options)
+        else:
+            raise ValueError("FFT backend must be one of %s or 'auto'"
+                % ", ".join(NAMES))
+    return backends[key]
+
+
+def autotune(shape, dtype=numpy.float64, repeats=100):
+    """
+    Times an rfft + irfft round trip of an array of shape with every
+    available backend (on their default settings) and returns the
+    fastest name and a dict of seconds per round trip. The result is
+    remembered for the rest of the run, and in TableCache when it is on.
+    """
+    key = (tuple(shape), numpy.dtype(dtype))
+    if key in tuned:
+        return tuned[key]
+    cachekey = (key[0], key[1].str, tuple(available()))
+    cached = TableCache.load("autotune", cachekey)
+    if cached is not None:
+        timings = dict(zip((str(n) for n in cached["names"]),
+            (float(t) for t in cached["seconds"])))
+        tuned[key] = (min(timings, key=timings.get), timings)
+        return tuned[key]
+
+    x = numpy.random.random(shape).astype(dtype)
+    freq = numpy.zeros((shape[0] // 2 + 1,) + tuple(shape[1:]),
+        dtype=numpy.result_type(dtype, numpy.complex64))
+    y = numpy.zeros(shape, dtype=dtype)
+    timings = {}
+    for name in available():
+        backend = get(name)
+        backend.irfft(backend.rfft(x, freq), y)  # plan and warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            backend.irfft(backend.rfft(x, freq), y)
+        timings[name] = (time.perf_counter() - start) / repeats
+        backend.saveplans()
+    tuned[key] = (min(timings, key=timings.get), timings)
+    TableCache.save("autotune", cachekey, names=numpy.array(list(timings)),
+        seconds=numpy.array(list(timings.values())))
+    return tuned[key]
+
+
+def main():
+    print("available:", ", ".join(available()))
+    for blocksize in (256, 1024, 4096):
+        best, timings = autotune((blocksize * 2, 2))
+        print(blocksize, best, ", ".join("%s %.1f us" % (name, t * 1e6)
+            for name, t in timings.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+"""
+A FilterChain is a list of stages that each change the frequency data
+in place. compile(freqdata) binds every stage to the array it will be
+given each block (olafft returns the same freqdata array every time) and
+flattens the chain into a list of ready-made calls, so run() is just a
+loop over them: no lookups, views or allocation per block.
+
+A Slot holds the chain the callback runs. A new chain is built and
+compiled on another thread (the Filters tables are made then) and
+handed over with swap(), which is a single attribute assignment. The
+callback reads the attribute once per block, so the change happens on a
+block boundary with no lock. The overlapping windows of the OLA blend the
+last block of the old chain into the first of the new one. Stateful
+stages (the NoiseFilter average) can be passed to the new chain so their
+state carries over instead of restarting; the chain carries the noise
+smoothing, so a new alpha changes on the same block boundary. swap() is
+prepare() (the compile) and use() (the assignment); several chains can
+be prepared beforehand and use()d from the audio thread (Governor does).
+
+Noise runs NoiseFilter.averageNoise and Suppress the NoiseSuppressor
+(build's noisetype 'average' or 'wiener').
+
+Stages take a channel (None for all channels) and only touch that
+column, as PySongFinder has done with channel 0. If compile is given a
+Monitor, a mark for each stage (by its kind: 'dc', 'noise', 'mapping')
+is put after it in the list of calls.
+"""
+import functools
+
+import numpy
+
+import Filters
+import NoiseFilter
+
+
+class Stage(object):
+    channel = None
+    kind = None
+
+    def select(self, freqdata):
+        if self.channel is None or freqdata.ndim == 1:
+            return freqdata
+        return freqdata[:, self.channel]
+
+    def ops(self, freqdata):
+        # return the calls, with no arguments, that apply the stage
+        raise NotImplementedError
+
+
+class RemoveDC(Stage):
+    kind = "dc"
+
+    def __init__(self, channel=None):
+        self.channel = channel
+
+    def ops(self, freqdata):
+        return [functools.partial(self.select(freqdata)[0:1].fill, 0)]
+
+
+class Noise(Stage):
+    # alpha (None: the NoiseFilter's own) is the smoothing of this chain
+    kind = "noise"
+
+    def __init__(self, noiseFilter, channel=None, alpha=None):
+        self.noiseFilter = noiseFilter
+        self.channel = channel
+        self.alpha = alpha
+
+    def ops(self, freqdata):
+        return [functools.partial(self.noiseFilter.averageNoise,
+                                  self.select(freqdata), self.alpha)]
+
+
+class Suppress(Stage):
+    # the NoiseSuppressor, in place of Noise
+    kind = "noise"
+
+    def __init__(self, suppressor, channel=None):
+        self.suppressor = suppressor
+        self.channel = channel
+
+    def ops(self, freqdata):
+        return [functools.partial(self.suppressor.suppress,
+                                  self.select(freqdata))]
+
+
+class Mapping(Stage):
+    # mode is 'fold', 'linear' or 'nonlinear'
+    kind = "mapping"
+
+    def __init__(self, filters, mode="fold", channel=None):
+        self.filters = filters
+        self.mode = mode
+        self.channel = channel
+
+    def ops(self, freqdata):
+        data = self.select(freqdata)
+        binmap = self.filters.binmap(self.mode, len(data))
+        return [functools.partial(binmap.apply, data)]
+
+
+class Divide(Stage):
+    # SongFinder frequency division; the Divider keeps block parity so 
+    # use one per chain
+    kind = "mapping"
+
+    def __init__(self, divider, channel=None):
+        self.divider = divider
+        self.channel = channel
+
+    def ops(self, freqdata):
+        return [functools.partial(self.divider.divide, self.select(freqdata))]
+
+
+class FilterChain(object):
+    def __init__(self, stages=(), name=""):
+        self.stages = list(stages)
+        self.name = name
+        self.calls = []
+        self.freqdata = None
+
+    def compile(self, freqdata, monitor=None):
+        self.freqdata = freqdata
+        self.calls = []
+        for stage in self.stages:
+            self.calls.extend(stage.ops(freqdata))
+            if monitor is not None and stage.kind in monitor.stages:
+                self.calls.append(functools.partial(monitor.mark,
+                    monitor.stages.index(stage.kind)))
+        return self
+
+    def run(self):
+        for call in self.calls:
+            call()
+
+
+class Slot(object):
+    def __init__(self, chain, monitor=None):
+        self.monitor = monitor
+        self.chain = chain.compile(chain.freqdata, monitor)
+        self.swaps = 0
+
+    def swap(self, chain):
+        # call off the audio thread; chain is compiled for the current 
+        # chain's array first
+        self.use(self.prepare(chain))
+
+    def prepare(self, chain):
+        # off the audio thread: compile chain for this slot, to use later
+        return chain.compile(self.chain.freqdata, self.monitor)
+
+    def use(self, chain):
+        # any thread, the audio thread included: a chain from prepare()
+        self.chain = chain
+        self.swaps += 1
+
+    def run(self):
+        # audio thread: one read of self.chain per block
+        self.chain.run()
+
+
+def build(freqdata, blocksize, samplerate, mode="fold", noise=True,
+          channel=None, noiseFilter=None, lower=30, upper=4500,
+          maxbirdfreq=12000, divisor=2, start=3000, hop=None,
+          dtype=numpy.float64, alpha=None, noisetype="average",
+          suppressor=None):
+    """
+    Builds and compiles the PySongFinder chain: DC removal, the noise
+    filter (if noise; noiseFilter is reused when given, or with 
+    noisetype 'wiener' a NoiseSuppressor, suppressor) and the mapping:
+    'fold', 'linear', 'nonlinear', 'divide' (by divisor from start Hz)
+    or 'none'. blocksize is the n_fft of the filters (half of olafft's
+    frame) and hop is olafft's hop, if it has one. dtype is the real 
+    precision of the filters (olafft's real, float32 for its float32 and 
+    int16 modes). alpha is the noise smoothing, if not the NoiseFilter's 
+    own. 
+    """
+    stages = [RemoveDC()]
+    if noise and noisetype == "wiener":
+        if suppressor is None:
+            import NoiseSuppressor  # only when it is chosen
+            channels = 1
+            if channel is None and freqdata.ndim > 1:
+                channels = freqdata.shape[1]
+            suppressor = NoiseSuppressor.NoiseSuppressor(blocksize,
+                samplerate, lower=lower, upper=upper,
+                maxbirdfreq=maxbirdfreq, channels=channels, hop=hop,
+                dtype=dtype)
+        stages.append(Suppress(suppressor, channel))
+    elif noise:
+        if noiseFilter is None:
+            channels = 1
+            if channel is None and freqdata.ndim > 1:
+                channels = freqdata.shape[1]
+            noiseFilter = NoiseFilter.NoiseFilter(blocksize, samplerate,
+                lower=lower, upper=upper, maxbirdfreq=maxbirdfreq,
+                channels=channels, hop=hop, dtype=dtype)
+        stages.append(Noise(noiseFilter, channel, alpha))
+    if mode == "divide":
+        stages.append(Divide(Filters.Divider(blocksize, samplerate, divisor,
+            start, maxbirdfreq, hop, dtype), channel))
+        mode = "divide by %d from %g Hz" % (divisor, start)
+    elif mode != "none":
+        filters = Filters.Filters(blocksize, samplerate, lower=lower,
+            upper=upper, maxbirdfreq=maxbirdfreq, dtype=dtype)
+        stages.append(Mapping(filters, mode, channel))
+    name = mode + (" + noise" if noise else "")
+    if noise and noisetype == "wiener":
+        name += " (wiener)"
+    return FilterChain(stages, name).compile(freqdata)
+
+
+def main():
+    import numpy as np
+    freqdata = (np.random.random([1025, 2])
+        + np.random.random([1025, 2]) * 1j).astype(np.csingle)
+    expected = freqdata.copy()
+    filters = Filters.Filters(1024, 44100)
+    expected[0] = 0
+    filters.foldLoop(expected[:, 0])
+
+    slot = Slot(build(freqdata, 1024, 44100, "linear", noise=False,
+        channel=0))
+    slot.swap(build(freqdata, 1024, 44100, "fold", noise=False, channel=0))
+    slot.run()
+    print(slot.chain.name, "matches loop:",
+        np.allclose(freqdata, expected, rtol=1e-5, atol=1e-5))
+
+
+if __name__ == "__main__":
+    main()
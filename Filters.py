@@ -11,47 +11,264 @@ takes equal sized groups of bins and adds their content to the
 output. Nonlinear does the same thing but with groups starting at 1 bin
 and growing as defined so that the last group goes into the UPPERFREQ bin. 
 
-Not implemented, but similar to folding would be to provide frequency
-division by 2, 3, or 4 as in the hardware SongFinder.
+Similar to folding is frequency division by 2, 3, or 4 as in the 
+hardware SongFinder (Divider, below): everything from the starting 
+frequency up to the limit of bird song is moved to 1/divisor of its 
+frequency and added to what is there; bins above the limit are zeroed. 
 
 A possible improvement might be to do the compression grouping 
 proportionately. Just a guess -- I suspect the difference will be 
 inaudible. 
+
+Every mapping only moves and adds bins, so it is a linear map of the 
+spectrum. Rather than walk the bins in Python for each block, the loop 
+versions (foldLoop, linearLoop, nonlinearLoop) are run once at
+construction on Sources, which keeps for each bin only the input bins
+summed into it, and the result is compiled into a BinMap: a gather
+index plus the start of each destination group. fold,
+linear and nonlinear then apply the BinMap to the whole frequency array 
+(all channels at once) with numpy.take and numpy.add.reduceat. With 
+TableCache enabled the compiled maps are kept on disk by band limits 
+and memory-mapped on the next start instead of being made again. 
+
+dtype (Filters, BinMap, Divider) is the real precision to work in: 
+float32 keeps complex64 data complex64 instead of promoting it through 
+float64 weights and phases. 
 """
+import collections
 import math as m
+import numpy
 
+import FrequencyGrid
+import TableCache
 
+# the defaults; each Filters uses the FrequencyGrid of its own n_fft 
+# and sample_freq
 N_FFT = 1024
 SAMPLE_FREQ = 44100 # typical sampling frequency
 NYQUISTFREQ = SAMPLE_FREQ // 2  # Nyquist Frequency
 
 def freqtobin(freq):
-    return int((N_FFT - 1) * freq / NYQUISTFREQ + 0.5) + 1
+    return FrequencyGrid.grid(N_FFT, SAMPLE_FREQ).bin(freq)
 
 LOWFREQ = freqtobin(30)  # lower limit for hearing range
 UPPERFREQ = freqtobin(4500)  # upper limit for hearing range
 MAXBIRDFREQ = freqtobin(12000)
-multiplier = 1.0
-adder = 1.0
-wrap = 1
+
+
+class Sources(object):
+    """
+    A spectrum of nbins for the loops to run on in place of the data:
+    bin i holds a Counter of the input bins (and their weights) summed
+    into it. The loops only add bins together and zero them, so this
+    traces a mapping in O(nbins) where an identity matrix takes
+    O(nbins ** 2).
+    """
+    def __init__(self, nbins):
+        self.rows = [collections.Counter({i: 1}) for i in range(nbins)]
+        self.shape = (nbins,)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def __setitem__(self, i, value):
+        # data[i] += data[j] stores the Counter back; data[i] = 0 and
+        # data[i:] = 0 zero
+        if isinstance(value, collections.Counter) and not isinstance(i, slice):
+            self.rows[i] = value
+        elif isinstance(value, collections.Counter) or value != 0:
+            raise ValueError("Sources can only be added to or zeroed")
+        elif isinstance(i, slice):
+            for j in range(*i.indices(len(self.rows))):
+                self.rows[j] = collections.Counter()
+        else:
+            self.rows[i] = collections.Counter()
+
+
+class BinMap(object):
+    """
+    A compiled bin mapping. rows[r][c] is the weight of input bin c in
+    output bin r (rows as traced by Sources). Bins below 'start' must be
+    left untouched by the mapping; only data[start:] is rewritten by
+    apply, in work areas kept for the last shape and dtype it was given
+    (so one BinMap is used by one stream at a time).
+    """
+    def __init__(self, rows, dtype=numpy.float64):
+        nbins = len(rows)
+        # a bin is changed if its row is not just itself or it is summed
+        # into another bin
+        changed = set()
+        for r, row in enumerate(rows):
+            if row != {r: 1}:
+                changed.add(r)
+                changed.update(c for c, w in row.items() if w)
+        self.nbins = nbins
+        self.start = min(changed) if changed else nbins
+
+        index, dest, groups, weights = [], [], [], []
+        for r in range(self.start, nbins):
+            sources = sorted(c for c, w in rows[r].items() if w)
+            if sources:
+                dest.append(r - self.start)
+                groups.append(len(index))
+                index.extend(c - self.start for c in sources)
+                weights.extend(rows[r][c] for c in sources)
+
+        self.index = numpy.array(index, dtype=numpy.intp)
+        self.dest = numpy.array(dest, dtype=numpy.intp)
+        self.groups = numpy.array(groups, dtype=numpy.intp)
+        self.weights = None
+        if any(w != 1 for w in weights):
+            self.weights = numpy.array(weights, dtype=dtype)
+        self.work = None
+
+    def arrays(self):
+        # what TableCache keeps of a compiled map
+        arrays = dict(index=self.index, dest=self.dest, groups=self.groups,
+            size=numpy.array([self.nbins, self.start]))
+        if self.weights is not None:
+            arrays["weights"] = self.weights
+        return arrays
+
+    @staticmethod
+    def restore(arrays, dtype=numpy.float64):
+        # a BinMap from arrays() (e.g. memory-mapped from TableCache)
+        binmap = BinMap.__new__(BinMap)
+        binmap.nbins, binmap.start = (int(n) for n in arrays["size"])
+        binmap.index = arrays["index"]
+        binmap.dest = arrays["dest"]
+        binmap.groups = arrays["groups"]
+        binmap.weights = None
+        if "weights" in arrays:
+            binmap.weights = numpy.asarray(arrays["weights"], dtype=dtype)
+        binmap.work = None
+        return binmap
+
+    def workareas(self, sub):
+        # the buffers apply works in, made again only when the shape or
+        # dtype of the data changes: the gathered bins, their sums, the
+        # weights in the data's dtype and at full size (a cast or a
+        # broadcast multiply buffers), the flat index of each sum in
+        # data[start:] and a contiguous copy of it for strided data
+        key = (sub.shape[1:], sub.dtype)
+        if self.work is None or self.work[0] != key:
+            rest = sub.shape[1:]
+            width = int(numpy.prod(rest, dtype=int))
+            gathered = numpy.empty((len(self.index),) + rest, sub.dtype)
+            sums = numpy.empty((len(self.groups),) + rest, sub.dtype)
+            weights = None
+            if self.weights is not None:
+                weights = numpy.empty_like(gathered)
+                weights[...] = self.weights.reshape((-1,) + (1,) * len(rest))
+            flat = (self.dest[:, numpy.newaxis] * width
+                + numpy.arange(width)).ravel()
+            staging = numpy.empty(sub.shape, sub.dtype)
+            self.work = (key, gathered, sums, weights, flat, staging)
+        return self.work[1:]
+
+    def apply(self, data):
+        if len(data) != self.nbins:
+            raise ValueError("BinMap compiled for %d bins, got %d" 
+                % (self.nbins, len(data)))
+        sub = data[self.start:]
+        if len(self.index) == 0:
+            sub[:] = 0
+            return data
+
+        gathered, sums, weights, flat, staging = self.workareas(sub)
+        # take and indexed assignment buffer strided data, so that is
+        # mapped in a contiguous copy
+        work = sub
+        if not sub.flags.c_contiguous:
+            work = staging
+            numpy.copyto(work, sub)
+        # mode="clip" as the default "raise" buffers out (the index is
+        # always in range)
+        numpy.take(work, self.index, axis=0, out=gathered, mode="clip")
+        if weights is not None:
+            numpy.multiply(gathered, weights, out=gathered)
+        numpy.add.reduceat(gathered, self.groups, axis=0, out=sums)
+        work[:] = 0
+        # a flat index assignment does not allocate; work[dest] does
+        work.reshape(-1)[flat] = sums.reshape(-1)
+        if work is not sub:
+            numpy.copyto(sub, work)
+        return data
+
 
 class Filters(object):
     def __init__(self, n_fft=1024, sample_freq = 44100, 
-        lower = 30, upper = 4500, maxbirdfreq = 12000):
+        lower = 30, upper = 4500, maxbirdfreq = 12000, dtype = numpy.float64):
         self.N_FFT = n_fft
+        self.dtype = dtype
         self.SAMPLE_FREQ = sample_freq
         self.NYQUISTFREQ = sample_freq // 2
 
-        self.LOWFREQ = freqtobin(lower)
-        self.UPPERFREQ = freqtobin(upper)
-        self.MAXBIRDFREQ = freqtobin(maxbirdfreq)
+        self.grid = FrequencyGrid.grid(n_fft, sample_freq)
+        self.LOWFREQ, self.UPPERFREQ, self.MAXBIRDFREQ = self.grid.limits(
+            lower, upper, maxbirdfreq)
 
         self.first = False
-        self.wrap = UPPERFREQ - LOWFREQ + 1
-        self.multiplier = m.pow((MAXBIRDFREQ - LOWFREQ + 1), 1 / (UPPERFREQ - LOWFREQ + 1))
-        self.adder = int((MAXBIRDFREQ - LOWFREQ + 1)/(UPPERFREQ - LOWFREQ + 1))
+        low, upper, maxbird = self.LOWFREQ, self.UPPERFREQ, self.MAXBIRDFREQ
+        self.wrap = upper - low + 1
+        self.multiplier = m.pow((maxbird - low + 1), 1 / (upper - low + 1))
+        self.adder = int((maxbird - low + 1)/(upper - low + 1))
+
+        # compile the mappings for the rfft size used by olafft 
+        # (blocksize + 1 bins); other lengths are compiled on first use
+        self.maps = {}
+        self.compile(n_fft + 1)
+
+    def compile(self, nbins):
+        # run each loop once on Sources to trace its mapping, or take
+        # the compiled map from TableCache when it is on
+        for name, loop in (("fold", self.foldLoop),
+                           ("linear", self.linearLoop),
+                           ("nonlinear", self.nonlinearLoop)):
+            key = (name, nbins, self.LOWFREQ, self.UPPERFREQ, self.MAXBIRDFREQ)
+            arrays = TableCache.load("binmap", key)
+            if arrays is not None:
+                self.maps[(name, nbins)] = BinMap.restore(arrays, self.dtype)
+                continue
+            sources = Sources(nbins)
+            first, self.first = self.first, False
+            loop(sources)
+            self.first = first
+            self.maps[(name, nbins)] = BinMap(sources.rows, self.dtype)
+            TableCache.save("binmap", key, **self.maps[(name, nbins)].arrays())
+
+    def binmap(self, name, nbins):
+        if (name, nbins) not in self.maps:
+            self.compile(nbins)
+        return self.maps[(name, nbins)]
+
+    def fold(self, data):
+        # data is frequency data from a single-sided fft such as rfft, 
+        # either one channel or an (nbins, channels) array
+        if self.first:
+            print(data.shape)
+            self.first = False
+        self.binmap("fold", len(data)).apply(data)
+
+    def linear(self, data):
+        if self.first:
+            print(data.shape)
+            self.first = False
+        self.binmap("linear", len(data)).apply(data)
 
-    def fold(self, data): 
+    def nonlinear(self, data):
+        if self.first:
+            print(data.shape)
+            self.first = False
+        self.binmap("nonlinear", len(data)).apply(data)
+
+    # The loop versions below define the mappings. They are only used to 
+    # compile the BinMaps and as a reference in main().
+
+    def foldLoop(self, data): 
         # data is assumed to be frequency data from a single-sided
         # fft such as rfft. Currently, it is for a single channel. 
         
@@ -68,13 +285,16 @@ class Filters(object):
         data[self.MAXBIRDFREQ + 1:] = 0
 
 
-    def linear(self, data):
+    def linearLoop(self, data):
         # linear compression ((b-a)*(x - min))//(max - min) + a
         # b = upper, a=fold, max = NFREQ, min = 0 (or 1?)
         if self.first:
             print(data.shape)
             self.first = False
 
+        if self.UPPERFREQ >= self.MAXBIRDFREQ:
+            # upper at or past Nyquist: nothing above it to compress
+            return
         for i in range(self.LOWFREQ, self.MAXBIRDFREQ):
             icomp = ((self.UPPERFREQ - self.LOWFREQ) * i) // (self.MAXBIRDFREQ - self.LOWFREQ) + self.LOWFREQ - 1
             data[icomp] += data[i]
@@ -82,7 +302,7 @@ class Filters(object):
         
         data[self.MAXBIRDFREQ + 1:] = 0
 
-    def nonlinear(self, data):
+    def nonlinearLoop(self, data):
         # log scaling
         # EXAMPLE
         #   Given the values on the linear NFREQ range from fold to NFREQ,
@@ -120,6 +340,117 @@ class Filters(object):
         data[self.MAXBIRDFREQ + 1:] = 0 # zero rest of frequency data
 
 
+dividers = {}  # DividerTables by (n_fft, sample_freq, divisor, start, maxbirdfreq, hop)
+
+
+class DividerTables(object):
+    """
+    The fixed part of a Divider. olafft frames are 2 * n_fft long, so 
+    there are n_fft + 1 bins and bin k is k * sample_freq / (2 * n_fft) 
+    Hz. Source bin k goes to target bin round(k / divisor); index is a 
+    (targets, divisor) table of the sources of each target, with valid 
+    marking those that are really in the divided range. expected is the 
+    phase a tone at the centre of each source bin turns through in one 
+    hop. 
+    """
+    def __init__(self, n_fft, sample_freq, divisor, start, maxbirdfreq, hop):
+        nbins = n_fft + 1
+        size = 2 * n_fft
+        grid = FrequencyGrid.grid(n_fft, sample_freq)
+        self.first = min(grid.nearest(start), nbins)
+        last = min(grid.nearest(maxbirdfreq), nbins - 1)
+        self.targets = numpy.arange((self.first + divisor // 2) // divisor, 
+                                    (last + divisor // 2) // divisor + 1)
+        sources = (self.targets[:, numpy.newaxis] * divisor - divisor // 2 
+            + numpy.arange(divisor))
+        self.valid = ((sources >= self.first) & (sources <= last))[..., numpy.newaxis]
+        self.index = numpy.clip(sources, 0, nbins - 1)
+        self.expected = (2 * numpy.pi * self.index * hop / size)[..., numpy.newaxis]
+
+
+def dividertables(n_fft, sample_freq, divisor, start, maxbirdfreq, hop=None):
+    hop = hop or n_fft
+    key = (n_fft, sample_freq, divisor, start, maxbirdfreq, hop)
+    if key not in dividers:
+        dividers[key] = DividerTables(n_fft, sample_freq, divisor, start, 
+            maxbirdfreq, hop)
+    return dividers[key]
+
+
+class Divider(object):
+    """
+    SongFinder style frequency division, done as a phase vocoder so that 
+    a tone really comes out at 1/divisor of its frequency. Each frame, 
+    the true frequency in every source bin is found from how far its 
+    phase turned since the last frame (less the expected turn of the 
+    bin centre). Each target bin gets the summed magnitude of its 
+    sources and a phase that advances by 1/divisor of the turn of the 
+    strongest of them. hop is olafft's hop (default n_fft, as in the ring 
+    and shifting modes); a hop of a quarter frame or less (75 % overlap) 
+    gives much cleaner tones than half a frame. 
+
+    The tables are shared by every Divider with the same settings. The 
+    phases are per stream, so call divide() once per frame on all 
+    channels at once and use one Divider per stream. divideBlocks() does 
+    the same for an (nbins, nblocks, channels) array of consecutive 
+    frames. 
+    """
+    def __init__(self, n_fft=1024, sample_freq=44100, divisor=2, 
+                 start=3000, maxbirdfreq=12000, hop=None, dtype=numpy.float64):
+        if divisor not in (2, 3, 4):
+            raise ValueError("divisor must be 2, 3 or 4")
+        self.divisor = divisor
+        self.start = start
+        self.tables = dividertables(n_fft, sample_freq, divisor, start, 
+            maxbirdfreq, hop)
+        self.dtype = dtype
+        self.expected = self.tables.expected.astype(dtype)
+        self.previous = None  # source phases of the last frame
+        self.phase = None  # target phases
+
+    def divide(self, data):
+        tables = self.tables
+        if data.ndim == 1:
+            data = data[:, numpy.newaxis]
+        if self.previous is None:
+            self.previous = numpy.zeros(tables.index.shape + data.shape[1:], 
+                dtype=self.dtype)
+            self.phase = numpy.zeros(tables.targets.shape + data.shape[1:], 
+                dtype=self.dtype)
+
+        sources = data[tables.index]  # (targets, divisor, channels)
+        magnitude = numpy.abs(sources) * tables.valid
+        angle = numpy.angle(sources)
+        turn = angle - self.previous - self.expected
+        self.previous = angle
+        turn -= 2 * numpy.pi * numpy.round(turn / (2 * numpy.pi))
+        turn += self.expected  # the true turn, for the true frequency
+
+        strongest = numpy.argmax(magnitude, axis=1)[:, numpy.newaxis]
+        self.phase += numpy.take_along_axis(turn, strongest, axis=1)[:, 0] / self.divisor
+        self.phase %= 2 * numpy.pi
+
+        data[tables.first:] = 0
+        data[tables.targets] += magnitude.sum(axis=1) * numpy.exp(1j * self.phase)
+
+    def divideBlocks(self, data):
+        for i in range(data.shape[1]):  # the phases carry frame to frame
+            self.divide(data[:, i])
+
+    def state(self):
+        # the phases, e.g. to checkpoint a long render (none before
+        # the first frame)
+        if self.previous is None:
+            return {}
+        return {"previous": self.previous, "phase": self.phase}
+
+    def restore(self, state):
+        if "previous" in state:
+            # as saved: the phases take the spectra's precision
+            self.previous = numpy.array(state["previous"])
+            self.phase = numpy.array(state["phase"])
+
+
 def main():
     fc = Filters(1024, 44100, 30, 4500, 12000)
 
@@ -142,6 +473,26 @@ def main():
     fc.nonlinear(data)
     print("nonlinear compression data: ")
     print(data[:freqtobin(4500)])
+    print()
+
+    # check the compiled maps against the loops on stereo rfft-sized data
+    for name in ("fold", "linear", "nonlinear"):
+        data = (np.random.random([1025, 2]) 
+            + np.random.random([1025, 2]) * 1j).astype(np.csingle)
+        expected = data.copy()
+        getattr(fc, name + "Loop")(expected)
+        getattr(fc, name)(data)
+        # the bins summed are the same, only the order of the additions 
+        # (and so the rounding) can differ
+        print(name, "matches loop:", np.allclose(data, expected, rtol=1e-5, atol=1e-5))
+    print()
+
+    # a 6 kHz tone divided by 2 from 3 kHz comes out at 3 kHz 
+    dv = Divider(1024, 44100, divisor=2, start=3000)
+    t = np.arange(2048) / 44100
+    data = np.fft.rfft(np.sin(2 * np.pi * 6000 * t) * np.hanning(2048))
+    dv.divide(data)
+    print("6 kHz divided by 2 peaks at", np.argmax(abs(data)) * 44100 / 2048, "Hz")
 
 if __name__ == "__main__":
     import numpy as np
@@ -0,0 +1,86 @@
+"""
+The frequencies of the bins of olafft's spectrum, shared by the stages.
+
+olafft's frames are 2 * n_fft samples, so its rfft has n_fft + 1 bins
+and bin k is centred on k * samplerate / (2 * n_fft) Hz. A FrequencyGrid
+holds, for one (n_fft, samplerate):
+
+    frequencies  the centre of each bin, Hz
+    edges        the n_fft + 2 band edges: halfway between centres, 0
+                 and the Nyquist frequency at the ends
+    bin(freq)    the bin the Filters and NoiseFilter band limits have
+                 always used (the formula that was fixed at 1024 bins
+                 and 44100 Hz in each module)
+    nearest(freq) the bin whose centre is nearest freq
+    limits(lower, upper, maxbirdfreq)
+                 the LOWFREQ, UPPERFREQ and MAXBIRDFREQ bins, remembered
+                 per grid; a limit at or above the Nyquist frequency
+                 (12000 Hz below 24 kHz sampling) is the last bin, n_fft
+
+grid(n_fft, samplerate) returns the one FrequencyGrid for its arguments,
+made on first use, so every stage built for a stream shares it and a new
+blocksize or sampling rate only costs one more.
+"""
+import numpy
+
+grids = {}  # FrequencyGrid by (n_fft, samplerate)
+
+
+class FrequencyGrid(object):
+    def __init__(self, n_fft, samplerate):
+        self.n_fft = n_fft
+        self.samplerate = samplerate
+        self.nyquist = samplerate / 2
+        self.width = samplerate / (2 * n_fft)  # Hz per bin
+        self.frequencies = numpy.arange(n_fft + 1) * self.width
+        self.edges = numpy.concatenate(([0.0],
+            (self.frequencies[:-1] + self.frequencies[1:]) / 2,
+            [self.nyquist]))
+        self.bands = {}
+
+    def bin(self, freq):
+        return int((self.n_fft - 1) * freq / self.nyquist + 0.5) + 1
+
+    def nearest(self, freq):
+        return int(freq / self.width + 0.5)
+
+    def limits(self, lower=30, upper=4500, maxbirdfreq=12000):
+        key = (lower, upper, maxbirdfreq)
+        if key not in self.bands:
+            self.bands[key] = tuple(min(self.bin(freq), self.n_fft)
+                for freq in (lower, upper, maxbirdfreq))
+        return self.bands[key]
+
+
+def grid(n_fft=1024, samplerate=44100):
+    key = (n_fft, float(samplerate))
+    if key not in grids:
+        grids[key] = FrequencyGrid(n_fft, float(samplerate))
+    return grids[key]
+
+
+def main():
+    for n_fft, samplerate in ((1024, 44100), (256, 44100), (1024, 96000)):
+        g = grid(n_fft, samplerate)
+        low, upper, maxbird = g.limits()
+        print("%5d bins at %6d Hz: %.2f Hz per bin; 30/4500/12000 Hz are "
+              "bins %d/%d/%d, centred on %.0f/%.0f/%.0f Hz" % (n_fft + 1,
+              samplerate, g.width, low, upper, maxbird,
+              g.frequencies[low], g.frequencies[upper], g.frequencies[maxbird]))
+    print("shared:", grid(1024, 44100) is grid(1024, 44100.0))
+
+    # below 24 kHz the default 12000 Hz is past Nyquist: every mapping
+    # must still be made and run within the spectrum
+    import Filters
+    for samplerate in (8000, 11025, 22050):
+        limits = grid(1024, samplerate).limits()
+        filters = Filters.Filters(1024, samplerate)
+        data = numpy.ones([1025, 2], dtype=complex)
+        for mode in ("fold", "linear", "nonlinear"):
+            getattr(filters, mode)(data)
+        print("%5d Hz: limits %s, every mapping runs" % (samplerate,
+            "/".join(map(str, limits))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Keeps PySongFinder (--govern) playing when the machine slows down (a
+Raspberry Pi throttling when it is hot) by doing less work, rather than
+letting the callback miss its deadline and the sound click or drop out.
+
+wrap() a callback and the Governor times every block (Monitor.Load: a
+moving average of the callback's time over the block's budget,
+frames / samplerate). When that average is above 'down' it steps down
+a tier, each cheaper than the last:
+
+    full          the settings as given
+    no noise      without the noise filter
+    mapping fold  divide replaced by fold (divide is the costly mapping;
+                  the compiled fold, linear and nonlinear maps cost
+                  much the same, so they are kept)
+    mirror        only channel 0 transformed, played on both channels
+                  (olafft.mirror; stereo layout only)
+    passthrough   no transforms: the input, delayed by olafft's
+                  latency_samples so that it lines up
+
+A tier that would change nothing for the settings is left out. After
+each change it waits 'hold' seconds (and at least 3 / smoothing blocks)
+for the average to settle before deciding again. When the average has
+been below 'up' for 'recover' seconds it steps back up, but only if the
+tier above is expected to fit: its load when it was left, scaled by how
+much the load of this tier has fallen since it settled after that. So
+a tier that was too slow is not retried until the machine is faster,
+and a tier that is left again soon after stepping up to it waits twice
+as long (up to 32 times 'recover') before it is tried again; with the
+two thresholds this keeps it from see-sawing.
+
+Tiers change between blocks. The chain of each tier is made and
+compiled beforehand, off the audio thread (rebuild(), also when the
+settings change), and the callback switches to one by an attribute
+assignment (FilterChain.Slot.use). Leaving passthrough, the callback
+runs into a spare block for a frame's worth of blocks, to fill
+olafft's buffers again, while the delayed input still plays.
+
+Changes are appended to a list by the audio thread and printed by a
+reader thread started by run() (as Monitor does); close() prints the
+time spent in each tier.
+"""
+import sys
+import threading
+import time
+
+import numpy
+
+import Monitor
+
+CHEAPER = {"divide": "fold"}  # mapping: a cheaper one
+
+
+def tiers(settings, mirror=True):
+    """
+    The tiers below settings, as (name, settings, mirror); passthrough
+    has no settings. Tiers that would change nothing are left out.
+    """
+    levels = [("full", dict(settings), False)]
+    cheaper = dict(settings, noise=False)
+    levels.append(("no noise", cheaper, False))
+    cheaper = dict(cheaper, mode=CHEAPER.get(cheaper["mode"],
+        cheaper["mode"]))
+    levels.append(("mapping " + cheaper["mode"], cheaper, False))
+    if mirror:
+        levels.append(("mirror", cheaper, True))
+    levels.append(("passthrough", None, False))
+    kept = levels[:1]
+    for level in levels[1:]:
+        if level[1:] != kept[-1][1:]:
+            kept.append(level)
+    return kept
+
+
+class Delay(object):
+    # a fixed delay of the input, in whole blocks stored twice so that
+    # the delayed block is always contiguous (as olafft's side ring)
+    def __init__(self, delay, blocksize, channels, dtype):
+        self.delay = delay
+        self.blocksize = blocksize
+        self.size = -(-(delay + blocksize) // blocksize) * blocksize
+        self.ring = numpy.zeros([self.size * 2, channels], dtype=dtype)
+        self.write = 0
+
+    def push(self, indata):
+        n = self.blocksize
+        w = self.write
+        self.ring[w:w + n] = indata
+        self.ring[w + self.size:w + self.size + n] = indata
+        self.write = (w + n) % self.size
+
+    def read(self, out):
+        # the block pushed last, delay samples ago
+        r = (self.write - self.blocksize - self.delay) % self.size
+        out[:] = self.ring[r:r + self.blocksize]
+
+
+class Governor(object):
+    def __init__(self, slot, ola, make, settings, blocksize, samplerate,
+                 channels=(2, 2), dtype="float32", down=0.7, up=0.4,
+                 hold=0.5, recover=3.0, smoothing=0.1, file=None):
+        """
+        slot is the FilterChain.Slot the callback runs, ola its olafft
+        and make(settings) builds a chain for settings. channels is the
+        stream's (input, output) channels.
+        """
+        self.slot = slot
+        self.ola = ola
+        self.make = make
+        self.mirror = ola.layout == "stereo" and (ola.ring
+            or ola.hop is not None)
+        self.load = Monitor.Load(blocksize, samplerate, smoothing)
+        self.down = down
+        self.up = up
+        period = blocksize / samplerate
+        # in blocks, and long enough for the average to settle
+        self.hold = max(int(round(hold / period)), int(3 / smoothing))
+        self.recover = max(1, int(round(recover / period)))
+        self.file = file
+
+        self.delay = Delay(ola.latency_samples, blocksize, channels[0],
+            dtype)
+        self.spare = numpy.zeros([blocksize, channels[1]], dtype=dtype)
+        self.warm = -(-len(ola.frame) // blocksize) + 1  # blocks
+
+        # audio thread
+        self.tier = 0
+        self.passthrough = False
+        self.warming = 0
+        self.since = 0  # blocks since the last change
+        self.calm = 0  # blocks below 'up'
+        self.left = {}  # load of each tier when it was left
+        self.settled = {}  # load of each tier once settled
+        self.patience = {}  # tier: times 'recover' to wait before retrying
+        self.rose = False  # the tier was stepped up to
+        self.events = []  # (seconds, from, to, load)
+        self.counts = {}  # tier name: blocks
+
+        self.rebuild(settings)
+        self.levels, self.pending = self.pending, None
+        self.switch(0, log=False)
+        self.began = time.monotonic()
+        self.done = threading.Event()
+        self.thread = None
+        self.read = 0
+
+    def rebuild(self, settings):
+        # off the audio thread: the chains of the tiers for settings,
+        # switched to at the next block
+        levels = []
+        for name, values, mirror in tiers(settings, self.mirror):
+            chain = None
+            if values is not None:
+                chain = self.slot.prepare(self.make(values))
+            levels.append((name, chain, mirror))
+        self.pending = levels  # one assignment: the audio thread takes it
+
+    # audio thread
+
+    def wrap(self, callback):
+        # a stream callback that runs callback, or passes the input
+        # through, as the tier says
+        def governed(indata, outdata, frames, time, status):
+            begin = Monitor.time_ns()
+            self.delay.push(indata)
+            if not self.passthrough:
+                callback(indata, outdata, frames, time, status)
+            elif self.warming:  # leaving passthrough: fill olafft again
+                callback(indata, self.spare, frames, time, status)
+                self.delay.read(outdata)
+                self.warming -= 1
+                if not self.warming:
+                    self.passthrough = False
+            else:
+                self.delay.read(outdata)
+            self.load.measure(Monitor.time_ns() - begin, frames)
+            self.decide()
+        return governed
+
+    def decide(self):
+        # after each block: the tier for the next one
+        levels = self.pending
+        if levels is not None:  # from rebuild(): start afresh
+            self.pending = None
+            self.levels = levels
+            self.left = {}
+            self.settled = {}
+            self.patience = {}
+            self.switch(min(self.tier, len(levels) - 1), log=False)
+        name = self.levels[self.tier][0]
+        self.counts[name] = self.counts.get(name, 0) + 1
+        self.since += 1
+        if self.since < self.hold or self.warming:
+            return
+        load = self.load.load
+        if self.since == self.hold and not self.rose:
+            # paired with left[tier - 1]: the machine's speed then
+            self.settled[self.tier] = load
+        if self.rose and self.since == self.recover:
+            self.patience.pop(self.tier, None)  # it held
+        if load > self.down:
+            self.calm = 0
+            if self.tier < len(self.levels) - 1:
+                self.switch(self.tier + 1)
+            return
+        if self.tier == 0 or load >= self.up:
+            self.calm = 0
+            return
+        self.calm += 1
+        if self.calm < self.recover * self.patience.get(self.tier - 1, 1):
+            return
+        above = self.tier - 1
+        expected = load
+        if (above in self.left and self.levels[self.tier][1] is not None
+                and self.settled.get(self.tier)):
+            # (passthrough's load is too small to go by)
+            expected = self.left[above] * load / self.settled[self.tier]
+        if expected < self.down:
+            self.switch(above)
+        else:
+            self.calm = 0  # still too slow for the tier above
+
+    def switch(self, tier, log=True):
+        name, chain, mirror = self.levels[tier]
+        if log:
+            self.left[self.tier] = self.load.load
+            if tier > self.tier and self.rose and self.since < self.recover:
+                # stepped up too soon: wait twice as long next time
+                self.patience[self.tier] = min(32,
+                    2 * self.patience.get(self.tier, 1))
+            self.events.append((time.monotonic(), self.levels[self.tier][0],
+                name, self.load.load))
+        if chain is not None:
+            if self.passthrough and not self.warming:
+                self.warming = self.warm
+            if self.slot.chain is not chain:
+                self.slot.use(chain)
+        else:
+            self.passthrough = True
+            self.warming = 0
+        self.ola.mirror = mirror
+        self.rose = tier < self.tier
+        self.tier = tier
+        self.since = 0
+        self.calm = 0
+
+    # reader
+
+    def report(self):
+        out = self.file or sys.stdout
+        events = self.events[self.read:]
+        self.read += len(events)
+        for when, before, after, load in events:
+            print("[governor] %.1f s  load %.2f: %s -> %s" % (
+                when - self.began, load, before, after), file=out)
+        if events:
+            out.flush()
+
+    def loop(self):
+        while not self.done.wait(0.5):
+            self.report()
+
+    def run(self):
+        # start the background reader
+        self.began = time.monotonic()
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # stop the reader and print the blocks played in each tier
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+        total = sum(self.counts.values()) or 1
+        print("[governor] %d changes; blocks per tier: %s" % (
+            len(self.events), ", ".join("%s %d (%.0f%%)" % (name, n,
+            100.0 * n / total) for name, n in self.counts.items())),
+            file=self.file or sys.stdout)
+
+    def status(self):
+        # for the control server
+        levels = self.levels
+        return {"tier": levels[min(self.tier, len(levels) - 1)][0],
+                "tiers": [level[0] for level in levels],
+                "changes": len(self.events)}
+
+
+def main():
+    # a machine that slows down, in real time: the real chain runs, then
+    # waits as long again as a throttle factor says, and the factor is
+    # raised for a while
+    import FilterChain
+    import OlaFFT
+    blocksize, samplerate = 512, 44100
+    ola = OlaFFT.olafft(blocksize, ring=True, dtype="float32")
+    settings = dict(mode="divide", noise=True, divisor=2)
+
+    def make(settings):
+        return FilterChain.build(ola.freqdata, blocksize, samplerate,
+            settings["mode"], settings["noise"], channel=0,
+            divisor=settings["divisor"], dtype=ola.real)
+
+    slot = FilterChain.Slot(make(settings))
+    governor = Governor(slot, ola, make, settings, blocksize, samplerate,
+        hold=0.2, recover=0.5)
+    rng = numpy.random.default_rng(0)
+    indata = (0.1 * rng.standard_normal([blocksize, 2])).astype("float32")
+    outdata = numpy.zeros([blocksize, 2], dtype="float32")
+
+    def process(indata, outdata):
+        ola.rfft(indata)
+        slot.run()
+        ola.irfft(ola.freqdata, out=outdata)
+
+    # the time of each tier here (which also makes the FFT plans)
+    costs = []
+    for name, chain, mirror in governor.levels[:-1]:
+        slot.use(chain)
+        ola.mirror = mirror
+        for i in range(100):
+            process(indata, outdata)
+        best = None
+        for repeat in range(5):
+            begin = Monitor.time_ns()
+            for i in range(50):
+                process(indata, outdata)
+            took = (Monitor.time_ns() - begin) // 50
+            best = took if best is None else min(best, took)
+        costs.append(best)
+    governor.switch(0, log=False)
+    slower = [1.0]
+
+    def callback(indata, outdata, frames, time, status):
+        # a machine 'slower' times slower: waits out the difference
+        end = Monitor.time_ns() + costs[governor.tier] * slower[0]
+        process(indata, outdata)
+        while Monitor.time_ns() < end:
+            pass
+
+    # the full chain's load: 30 %, then 120 % (the cheaper mapping
+    # fits), 250 % (only passthrough does) and 30 % again
+    period = blocksize / samplerate
+    schedule = [(150, 0.3), (450, 1.2), (750, 2.5), (1300, 0.3)]
+    governed = governor.wrap(callback)
+    governor.run()
+    began = time.perf_counter()
+    for block in range(schedule[-1][0]):
+        load = next(load for end, load in schedule if block < end)
+        slower[0] = load * period * 1e9 / costs[0]
+        governed(indata, outdata, blocksize, None, None)
+        time.sleep(max(0.0, began + (block + 1) * period
+            - time.perf_counter()))
+    governor.close()
+    print("each tier's time: %s; budget %.0f us" % (", ".join(
+        "%s %.0f us" % (level[0], cost / 1e3) for level, cost in zip(
+        governor.levels, costs)), period * 1e6))
+
+
+if __name__ == "__main__":
+    main()
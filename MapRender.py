@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+"""Filter a WAV file of any size in constant memory, resumably.
+
+For recordings too big to read (RenderFile reads chunks through
+soundfile, which is fine for hours but not for a night of dawn chorus
+at high rates): the input's sample data is memory-mapped with
+numpy.memmap straight from the WAV file and the output is a WAV file of
+the final size, made up front, whose sample data is memory-mapped and
+written in place. Both are mapped a window (--window blocks) at a time
+and the maps are dropped after each window, so only one window of each
+is resident whatever the size of the file. Each window goes through
+OlaFFT.olabatch and the filters as in RenderFile, so the output is the
+same as RenderFile's (for a float output): lined up with the input, the
+overlap-add's latency_samples dropped from the front and its tail
+flushed with zeros after the end.
+
+After each window the output is flushed to disk and a checkpoint is
+written next to it (OUTFILE.checkpoint.npz): the samples done, the
+olabatch overlap-add state and the filters' own state (the noise
+average, the divider's phases). If the render is interrupted, running
+the same command again carries on from the checkpoint with the same
+result as an uninterrupted run; --restart starts again. The checkpoint
+is removed when the render is done, and ignored if the input or the
+settings have changed.
+
+WAV files with 8 (unsigned), 16, 24 or 32 bit PCM or 32 or 64 bit
+float samples are read, including RF64 (WAV over 4 GB) and
+WAVE_FORMAT_EXTENSIBLE; the output is RF64 when it needs to be. Integer
+samples are scaled by 2 ** (bits - 1), rounded and clipped on output.
+"""
+import argparse
+import os
+import resource
+import struct
+import time
+
+import numpy
+
+import OlaFFT
+import RenderFile
+
+# subtype: (format tag, bits, dtype of a sample; None for 24 bit)
+SUBTYPES = {"PCM_U8": (1, 8, "u1"), "PCM_16": (1, 16, "<i2"),
+            "PCM_24": (1, 24, None),
+            "PCM_32": (1, 32, "<i4"), "FLOAT": (3, 32, "<f4"),
+            "DOUBLE": (3, 64, "<f8")}
+EXTENSIBLE = 0xFFFE
+
+
+class WavInfo(object):
+    def __init__(self, channels, samplerate, subtype, offset, frames):
+        self.channels = channels
+        self.samplerate = samplerate
+        self.subtype = subtype
+        self.offset = offset  # of the sample data in the file
+        self.frames = frames
+        self.framebytes = channels * SUBTYPES[subtype][1] // 8
+
+
+def readheader(filename):
+    """The layout of a WAV (or RF64) file's samples, as a WavInfo."""
+    with open(filename, "rb") as f:
+        riff = f.read(12)
+        if riff[:4] not in (b"RIFF", b"RF64") or riff[8:12] != b"WAVE":
+            raise ValueError("%s is not a WAV file" % filename)
+        datasize = None  # from ds64, for RF64
+        subtype = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("%s has no data chunk" % filename)
+            chunk, size = header[:4], struct.unpack("<I", header[4:])[0]
+            if chunk == b"ds64":
+                datasize = struct.unpack("<QQQ", f.read(24))[1]
+                f.seek(size - 24 + (size & 1), 1)
+            elif chunk == b"fmt ":
+                body = f.read(size)
+                tag, channels, samplerate, _, align, bits = struct.unpack(
+                    "<HHIIHH", body[:16])
+                if tag == EXTENSIBLE and size >= 26:
+                    tag = struct.unpack("<H", body[24:26])[0]
+                bits = align * 8 // channels  # the container size
+                subtype = next((name for name, (t, b, _) in SUBTYPES.items()
+                    if (t, b) == (tag, bits)), None)
+                if subtype is None:
+                    raise ValueError("%s: format %d with %d bit samples is "
+                        "not supported" % (filename, tag, bits))
+                f.seek(size & 1, 1)
+            elif chunk == b"data":
+                if subtype is None:
+                    raise ValueError("%s has no fmt chunk" % filename)
+                offset = f.tell()
+                if size == 0xFFFFFFFF and datasize is not None:
+                    size = datasize
+                size = min(size, os.path.getsize(filename) - offset)
+                info = WavInfo(channels, samplerate, subtype, offset, 0)
+                info.frames = size // info.framebytes
+                return info
+            else:
+                f.seek(size + (size & 1), 1)
+
+
+def create(filename, channels, samplerate, subtype, frames):
+    # a WAV file of the final size, its samples all zero (a sparse file
+    # where the file system allows); returns its WavInfo
+    tag, bits, _ = SUBTYPES[subtype]
+    align = channels * bits // 8
+    datasize = frames * align
+    fmt = struct.pack("<4sIHHIIHH", b"fmt ", 16, tag, channels, samplerate,
+        samplerate * align, align, bits)
+    if 4 + len(fmt) + 8 + datasize + (datasize & 1) < 2 ** 32:
+        header = (struct.pack("<4sI4s", b"RIFF", 4 + len(fmt) + 8 + datasize
+            + (datasize & 1), b"WAVE") + fmt
+            + struct.pack("<4sI", b"data", datasize))
+    else:
+        riffsize = 4 + 36 + len(fmt) + 8 + datasize + (datasize & 1)
+        header = (struct.pack("<4sI4s", b"RF64", 0xFFFFFFFF, b"WAVE")
+            + struct.pack("<4sIQQQI", b"ds64", 28, riffsize, datasize,
+                frames, 0) + fmt
+            + struct.pack("<4sI", b"data", 0xFFFFFFFF))
+    with open(filename, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + datasize + (datasize & 1))
+    return WavInfo(channels, samplerate, subtype, len(header), frames)
+
+
+def window(filename, info, start, count, mode="r"):
+    # frames [start, start + count) of the file's samples, mapped
+    dtype = SUBTYPES[info.subtype][2]
+    shape = (count, info.channels)
+    if dtype is None:  # 24 bit: three bytes a sample
+        dtype, shape = numpy.uint8, shape + (3,)
+    return numpy.memmap(filename, dtype, mode, info.offset
+        + start * info.framebytes, shape)
+
+
+def tofloat(raw, subtype, out):
+    # samples as float64 at +-1, into out
+    bits = SUBTYPES[subtype][1]
+    if subtype == "PCM_24":
+        value = (raw[..., 0].astype(numpy.int32)
+            | raw[..., 1].astype(numpy.int32) << 8
+            | raw[..., 2].astype(numpy.int32) << 16)
+        value = (value << 8) >> 8  # sign
+        numpy.multiply(value, 1.0 / 2 ** 23, out=out)
+    elif subtype == "PCM_U8":  # unsigned: silence is 128
+        numpy.subtract(raw, 128.0, out=out)
+        out *= 1.0 / 128
+    elif subtype in ("PCM_16", "PCM_32"):
+        numpy.multiply(raw, 1.0 / 2 ** (bits - 1), out=out)
+    else:
+        out[...] = raw
+    return out
+
+
+def fromfloat(data, subtype, raw):
+    # float samples at +-1 into the file's format
+    bits = SUBTYPES[subtype][1]
+    if subtype in ("FLOAT", "DOUBLE"):
+        raw[...] = data
+        return
+    full = 2 ** (bits - 1)
+    value = numpy.clip(numpy.rint(data * full), -full, full - 1)
+    if subtype == "PCM_U8":
+        raw[...] = value + 128
+    elif subtype == "PCM_24":
+        value = value.astype(numpy.int32)
+        raw[..., 0] = value & 0xFF
+        raw[..., 1] = (value >> 8) & 0xFF
+        raw[..., 2] = (value >> 16) & 0xFF
+    else:
+        raw[...] = value
+
+
+def fingerprint(infile, blocksize, latency, subtype, options):
+    # what a checkpoint is only good for
+    stat = os.stat(infile)
+    return repr((os.path.abspath(infile), stat.st_size, stat.st_mtime_ns,
+        blocksize, latency, subtype, sorted(options.items())))
+
+
+def checkpoint(name, key, position, ola, chain):
+    arrays = {"key": numpy.array(key), "position": numpy.array(position),
+        "history": ola.history, "running": ola.running, "second": ola.second}
+    arrays.update(("chain." + k, v) for k, v in chain.state().items())
+    temporary = name + ".tmp"
+    with open(temporary, "wb") as f:
+        numpy.savez(f, **arrays)
+    os.replace(temporary, name)
+
+
+def resume(name, key, ola, chain):
+    # the position saved in a checkpoint matching key (0 if none), with
+    # ola and chain put back as they were there
+    if not os.path.exists(name):
+        return 0
+    with numpy.load(name) as saved:
+        if str(saved["key"]) != key:
+            return 0
+        ola.history = saved["history"].copy()
+        ola.running = saved["running"].copy()
+        ola.second = saved["second"].copy()
+        chain.restore({k[len("chain."):]: saved[k].copy()
+            for k in saved.files if k.startswith("chain.")})
+        return int(saved["position"])
+
+
+def render(infile, outfile, blocksize=1024, windowblocks=256, subtype=None,
+           restart=False, progress=None, **options):
+    """
+    Filters infile into outfile, resuming from a checkpoint unless
+    restart; returns (seconds of audio, seconds taken, sample resumed
+    from). progress(done, frames) is called after each window.
+    """
+    began = time.perf_counter()
+    info = readheader(infile)
+    subtype = subtype or info.subtype
+    if subtype not in SUBTYPES:
+        raise ValueError("subtype must be one of " + ", ".join(SUBTYPES))
+    ola = OlaFFT.olabatch(blocksize)
+    chain = RenderFile.makechain(blocksize, info.samplerate, info.channels,
+        **options)
+    name = outfile + ".checkpoint.npz"
+    latency = ola.latency_samples
+    key = fingerprint(infile, blocksize, latency, subtype, options)
+
+    position = 0
+    if not restart and os.path.exists(outfile):
+        position = resume(name, key, ola, chain)
+    if position:
+        out = readheader(outfile)
+        if (out.frames, out.channels, out.subtype) != (info.frames,
+                info.channels, subtype):
+            position = 0
+            ola.reset()
+            chain = RenderFile.makechain(blocksize, info.samplerate,
+                info.channels, **options)
+    if not position:
+        out = create(outfile, info.channels, info.samplerate, subtype,
+            info.frames)
+    resumed = min(position, info.frames)
+
+    # position counts the whole blocks processed, input and then the
+    # zeros that flush the tail; output sample n is processed sample
+    # n + latency
+    step = blocksize * windowblocks
+    end = info.frames + latency
+    data = numpy.zeros([step, info.channels])
+    while position < end:
+        size = min(step, -(-(end - position) // blocksize) * blocksize)
+        count = min(max(info.frames - position, 0), size)  # of the input
+        if count:
+            raw = window(infile, info, position, count)
+            tofloat(raw, info.subtype, data[:count])
+            del raw  # unmapped: only this window is ever resident
+        data[count:size] = 0
+        result = ola.process(data[:size], chain)
+        first = max(latency - position, 0)
+        last = min(end - position, size)
+        if first < last:
+            raw = window(outfile, out, position + first - latency,
+                last - first, "r+")
+            fromfloat(result[first:last], subtype, raw)
+            raw.flush()
+            del raw
+        position += size
+        checkpoint(name, key, position, ola, chain)
+        if progress is not None:
+            progress(min(position, info.frames), info.frames)
+    if os.path.exists(name):
+        os.remove(name)
+    return (info.frames / info.samplerate, time.perf_counter() - began,
+        resumed)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'infile', metavar='INFILE', help='WAV file to be filtered')
+    parser.add_argument(
+        'outfile', metavar='OUTFILE', help='filtered WAV file to write')
+    RenderFile.addoptions(parser)
+    parser.add_argument('--window', type=int, default=256,
+        help='blocks mapped and processed at a time (default: %(default)s)')
+    parser.add_argument('--restart', action='store_true',
+        help='start again rather than resume from a checkpoint')
+    args = parser.parse_args()
+    if args.window < 1:
+        parser.error('window must be at least 1')
+
+    shown = [0]
+
+    def progress(done, frames):
+        # a line every 10 % (none for an empty file)
+        if frames and done * 10 // frames > shown[0]:
+            shown[0] = done * 10 // frames
+            print("%3d%%  %.1f of %.1f minutes" % (100 * done // frames,
+                done / info.samplerate / 60, frames / info.samplerate / 60),
+                flush=True)
+
+    try:
+        info = readheader(args.infile)
+        duration, elapsed, resumed = render(args.infile, args.outfile,
+            args.blocksize, args.window, args.subtype, args.restart, progress,
+            **RenderFile.settings(args))
+    except KeyboardInterrupt:
+        parser.exit(1, "interrupted: run again to carry on from the last "
+            "checkpoint\n")
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+    if resumed:
+        print("resumed at %.1f s" % (resumed / info.samplerate))
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    print("%.1f s of audio in %.2f s (%.0fx real time), peak resident "
+          "memory %.0f MB" % (duration, elapsed, (duration - resumed
+          / info.samplerate) / elapsed, resource.getrusage(
+          resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+Optional instrumentation for an audio callback. The callback calls
+start(status) on entry, mark(i) after stage i and stop(frames) at the
+end. These only read time.perf_counter_ns (monotonic) and write into a
+preallocated numpy ring of per-stage durations, one row per block, so
+nothing is printed, locked or allocated (beyond Python ints) on the
+audio thread. stop() counts a deadline miss when the callback took
+longer than frames / samplerate, and start() counts the input and
+output over/underflows that PortAudio reports in status.
+
+The ring has a single writer (the callback) and a single reader (the
+background thread started by run()): the writer fills a row and only
+then advances 'written', and the reader only takes rows below that. If
+the reader falls more than a ring behind, the lost rows are counted as
+dropped rather than read half written.
+
+Every 'interval' seconds the reader adds the new rows to log-spaced
+histograms (1 us to 1 s) and writes a summary (blocks, misses, xruns,
+mean/p50/p99/max per stage, the percentiles read from the histograms)
+to stdout or the given file. NullMonitor has the same methods and does
+nothing, so a callback can always be instrumented.
+
+Load is lighter: wrap() a callback and it keeps an exponential moving
+average of the time each block took as a fraction of its budget (the
+block's duration), for a control server to report or for the callback
+to adapt to, without a reader thread.
+"""
+import sys
+import threading
+import time
+
+import numpy
+
+EDGES = numpy.logspace(0, 6, 61)  # histogram bin edges in microseconds
+time_ns = time.perf_counter_ns  # callbacks have an argument called time
+
+
+class NullMonitor(object):
+    stages = []
+
+    def start(self, status=None):
+        pass
+
+    def mark(self, stage):
+        pass
+
+    def stop(self, frames):
+        pass
+
+    def run(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Monitor(object):
+    def __init__(self, stages, blocksize, samplerate, capacity=4096,
+                 interval=10.0, file=None):
+        self.stages = list(stages) + ["total"]
+        self.samplerate = samplerate
+        self.blocksize = blocksize
+        self.budget = int(blocksize / samplerate * 1e9)  # ns
+        self.interval = interval
+        self.file = file
+
+        # written by the audio thread only
+        self.times = numpy.zeros([capacity, len(self.stages)], dtype=numpy.int64)
+        self.rows = list(self.times)  # views, so start() makes none
+        self.written = 0
+        self.row = self.rows[0]
+        self.begin = 0
+        self.last = 0
+        self.misses = 0
+        self.inputOverflows = 0
+        self.inputUnderflows = 0
+        self.outputOverflows = 0
+        self.outputUnderflows = 0
+
+        # owned by the reader
+        self.read = 0
+        self.dropped = 0
+        self.counts = numpy.zeros([len(self.stages), len(EDGES) - 1],
+            dtype=numpy.int64)
+        self.sums = numpy.zeros(len(self.stages))
+        self.maxima = numpy.zeros(len(self.stages))
+        self.blocks = 0
+        self.started = time.monotonic()
+        self.done = threading.Event()
+        self.thread = None
+
+    # audio thread
+
+    def start(self, status=None):
+        self.begin = self.last = time.perf_counter_ns()
+        self.row = self.rows[self.written % len(self.rows)]
+        self.row.fill(0)  # stages that do not run this block read 0
+        if status:
+            if status.input_overflow:
+                self.inputOverflows += 1
+            if status.input_underflow:
+                self.inputUnderflows += 1
+            if status.output_overflow:
+                self.outputOverflows += 1
+            if status.output_underflow:
+                self.outputUnderflows += 1
+
+    def mark(self, stage):
+        now = time.perf_counter_ns()
+        self.row[stage] = now - self.last
+        self.last = now
+
+    def stop(self, frames):
+        total = time.perf_counter_ns() - self.begin
+        self.row[-1] = total
+        budget = self.budget
+        if frames != self.blocksize:
+            budget = int(frames / self.samplerate * 1e9)
+        if total > budget:
+            self.misses += 1
+        self.written += 1
+
+    # reader
+
+    def collect(self):
+        written = self.written
+        capacity = len(self.times)
+        if written - self.read > capacity:
+            self.dropped += written - self.read - capacity
+            self.read = written - capacity
+        rows = numpy.arange(self.read, written) % capacity
+        times = self.times[rows] / 1000.0  # microseconds
+        if self.written - capacity > self.read:  # overwritten while copying
+            lost = self.written - capacity - self.read
+            self.dropped += lost
+            times = times[lost:]
+        self.read = written
+
+        for i in range(len(self.stages)):
+            self.counts[i] += numpy.histogram(times[:, i], EDGES)[0]
+        if len(times):
+            self.sums += times.sum(axis=0)
+            self.maxima = numpy.maximum(self.maxima, times.max(axis=0))
+        self.blocks += len(times)
+
+    def percentile(self, stage, q):
+        counts = self.counts[stage]
+        if counts.sum() == 0:
+            return 0.0
+        cumulative = numpy.cumsum(counts)
+        target = q * cumulative[-1]
+        i = min(numpy.searchsorted(cumulative, target), len(counts) - 1)
+        # interpolated within the bin, whose edges are logarithmic, and
+        # never above the largest time measured
+        fraction = (target - cumulative[i] + counts[i]) / max(counts[i], 1)
+        value = EDGES[i] * (EDGES[i + 1] / EDGES[i]) ** min(fraction, 1.0)
+        return min(value, self.maxima[stage])
+
+    def report(self):
+        out = self.file or sys.stdout
+        print("[monitor] %.1f s  blocks %d  misses %d  dropped %d  "
+              "input over/under %d/%d  output over/under %d/%d" % (
+              time.monotonic() - self.started, self.blocks, self.misses,
+              self.dropped, self.inputOverflows, self.inputUnderflows,
+              self.outputOverflows, self.outputUnderflows), file=out)
+        print("  %-10s %9s %9s %9s %9s" % ("stage", "mean us", "p50 us",
+            "p99 us", "max us"), file=out)
+        for i, stage in enumerate(self.stages):
+            mean = self.sums[i] / self.blocks if self.blocks else 0.0
+            print("  %-10s %9.1f %9.1f %9.1f %9.1f" % (stage, mean,
+                self.percentile(i, 0.5), self.percentile(i, 0.99),
+                self.maxima[i]), file=out)
+        print("  budget %.1f us; total histogram (upper edge us: count): %s"
+            % (self.budget / 1000.0, " ".join("%.0f:%d" % (EDGES[j + 1], c)
+            for j, c in enumerate(self.counts[-1]) if c)), file=out)
+        out.flush()
+
+    def loop(self):
+        while not self.done.wait(self.interval):
+            self.collect()
+            self.report()
+
+    def run(self):
+        # start the background reader
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        # stop the reader and write the final report
+        self.done.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.collect()
+        self.report()
+
+
+class Load(object):
+    def __init__(self, blocksize, samplerate, smoothing=0.05):
+        self.blocksize = blocksize
+        self.samplerate = samplerate
+        self.smoothing = smoothing  # weight of the newest block
+        self.load = 0.0  # moving average of time / budget
+        self.peak = 0.0  # largest since the last reset()
+        self.last = 0.0
+        self.blocks = 0
+        self.misses = 0
+
+    def measure(self, elapsed, frames):
+        # elapsed ns for frames samples; audio thread
+        load = elapsed * self.samplerate / (frames * 1e9)
+        self.last = load
+        if self.blocks:
+            self.load += self.smoothing * (load - self.load)
+        else:
+            self.load = load
+        if load > self.peak:
+            self.peak = load
+        if load > 1.0:
+            self.misses += 1
+        self.blocks += 1
+
+    def wrap(self, callback):
+        # a stream callback that times callback
+        def timed(indata, outdata, frames, time, status):
+            begin = time_ns()
+            callback(indata, outdata, frames, time, status)
+            self.measure(time_ns() - begin, frames)
+        return timed
+
+    def reset(self):
+        self.peak = 0.0
+
+    def status(self):
+        return {"load": self.load, "peak": self.peak, "last": self.last,
+                "blocks": self.blocks, "misses": self.misses}
+
+
+def main():
+    monitor = Monitor(["work"], 1024, 44100, capacity=256, interval=0.1)
+    monitor.run()
+    for i in range(200):
+        monitor.start()
+        time.sleep(0.03 if i % 50 == 0 else 0.001)  # 4 misses
+        monitor.mark(0)
+        monitor.stop(1024)
+    monitor.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,24 @@ time-averaged power spectra (before other filtering?) and multiply
 each bin by (1.0 - avg/max). Subtracting an average bin value seems 
 to introduce artifacts so, hopefully, this approach will be "quieter" 
 and adapt automatically. 
+
+dtype is the precision of the averages: float32 for the complex64
+frequency data of olafft's float32 and int16 modes, so nothing is
+converted to double on the way.
 """
 import numpy
 import math as m
 
+import FrequencyGrid
+
+# the defaults; each NoiseFilter uses the FrequencyGrid of its own n_fft
+# and sample_freq
 N_FFT = 1024
 SAMPLE_FREQ = 44100 # typical sampling frequency
 NYQUISTFREQ = SAMPLE_FREQ // 2  # Nyquist Frequency
 
 def freqtobin(freq):
-    return int((N_FFT - 1) * freq / NYQUISTFREQ + 0.5) + 1
+    return FrequencyGrid.grid(N_FFT, SAMPLE_FREQ).bin(freq)
 
 LOWFREQ = freqtobin(30)  # lower limit for hearing range
 UPPERFREQ = freqtobin(4500)  # upper limit for hearing range
@@ -23,22 +31,43 @@ MAXBIRDFREQ = freqtobin(12000)
 
 class NoiseFilter(object):
     def __init__(self, n_fft=1024, sample_freq = 44100, 
-        lower = 30, upper = 4500, maxbirdfreq = 12000):
+        lower = 30, upper = 4500, maxbirdfreq = 12000, channels = 1,
+        hop = None, dtype = numpy.float64):
         self.N_FFT = n_fft
         self.SAMPLE_FREQ = sample_freq
         self.NYQUISTFREQ = sample_freq // 2
 
-        self.LOWFREQ = freqtobin(lower)
-        self.UPPERFREQ = freqtobin(upper)
-        self.MAXBIRDFREQ = freqtobin(maxbirdfreq)
+        self.grid = FrequencyGrid.grid(n_fft, sample_freq)
+        self.LOWFREQ, self.UPPERFREQ, self.MAXBIRDFREQ = self.grid.limits(
+            lower, upper, maxbirdfreq)
         #alpha for expotential smoothing from Wikipedia should be
         # 1/NYQUISTFREQ/sample-period 
-        self.alpha = N_FFT/SAMPLE_FREQ / 3.0 # average over 3 seconds?
-        self.maxPower = 0.0
+        # averageNoise is called every hop samples (olafft's hop,
+        # n_fft unless the low latency mode is used)
+        self.alpha = (hop or n_fft)/sample_freq / 3.0 # average over 3 seconds?
+        self.channels = channels
         
-    # create global areas for averaging data
-        self.power = numpy.zeros(n_fft)
-        self.maxPower = 0.0
+    # create global areas for averaging data, one column per channel.
+    # Bins 1 to n_fft - 2 are filtered (DC is skipped).
+        self.power = numpy.zeros([n_fft, channels], dtype=dtype)
+        self.maxPower = numpy.zeros(channels, dtype=dtype)
+
+        # work areas so that averageNoise does not allocate per block
+        self.magnitude = numpy.zeros([n_fft - 2, channels], dtype=dtype)
+        self.gain = numpy.zeros([n_fft - 2, channels], dtype=dtype)
+        # the gain again as complex, so applying it needs no cast temporary
+        self.complexGain = numpy.zeros([n_fft - 2, channels],
+            dtype=numpy.result_type(dtype, numpy.complex64))
+        self.tmpMax = numpy.zeros(channels, dtype=dtype)
+        self.active = numpy.zeros(channels, dtype=bool)
+
+        # views used for mono (1-D) data, which shares channel 0's state
+        self.mono = (self.power[1:-1, :1], self.maxPower[:1],
+            self.magnitude[:, :1], self.gain[:, :1], self.complexGain[:, :1],
+            self.tmpMax[:1], self.active[:1])
+        self.multi = (self.power[1:-1], self.maxPower,
+            self.magnitude, self.gain, self.complexGain, self.tmpMax,
+            self.active)
 
     """
     The simplest form of exponential smoothing is given by the formula:
@@ -48,18 +77,58 @@ class NoiseFilter(object):
     where alpha is the smoothing factor, and alpha between 0 and 1.
 
     This does the expotential moving average and then reduces bin values
-    by the average sound level in each bin.  
+    by the average sound level in each bin. data is either a single
+    channel or an (nbins, channels) array, updated in place. alpha, if
+    given, is used instead of self.alpha (so that a FilterChain can carry
+    its own and change it with the rest of the chain).
     """
 
-    def averageNoise(self, data):
-        tmpMax = 0.0
-        for i in range(1, N_FFT-1):
-            self.power[i]= self.power[i] + self.alpha * (abs(data[i]) - self.power[i])
-            tmpMax = max(tmpMax, self.power[i])
+    def averageNoise(self, data, alpha=None):
+        if alpha is None:
+            alpha = self.alpha
+        if data.ndim == 1:
+            power, maxPower, magnitude, gain, complexGain, tmpMax, active = \
+                self.mono
+            data = data[:, numpy.newaxis]
+        elif data.shape[1] == self.channels:
+            power, maxPower, magnitude, gain, complexGain, tmpMax, active = \
+                self.multi
+        else:
+            raise ValueError("NoiseFilter has %d channels, data has %d"
+                % (self.channels, data.shape[1]))
+        bins = data[1:self.N_FFT - 1]
+
+        # power += alpha * (|data| - power)
+        numpy.abs(bins, out=magnitude)
+        magnitude -= power
+        magnitude *= alpha
+        power += magnitude
+
+        # maxPower = tmpMax + alpha * (tmpMax - maxPower)
+        numpy.max(power, axis=0, out=tmpMax)
+        numpy.subtract(tmpMax, maxPower, out=maxPower)
+        maxPower *= alpha
+        maxPower += tmpMax
 
-        self.maxPower = tmpMax + self.alpha * (tmpMax - self.maxPower)
-        for i in range(1,N_FFT-1):
-            data[i] = data[i] * (1.0 - self.power[i]/self.maxPower)
+        # data *= 1 - power / maxPower, leaving silent channels alone
+        numpy.greater(maxPower, 0.0, out=active)
+        gain[...] = 0.0
+        for c in range(gain.shape[1]):
+            # a channel at a time: a masked or broadcast divide buffers
+            if active[c]:
+                numpy.divide(power[:, c], maxPower[c], out=gain[:, c])
+        numpy.subtract(1.0, gain, out=gain)
+        complexGain.real[...] = gain
+        bins *= complexGain
+
+    def state(self):
+        # the running averages, e.g. to checkpoint a long render
+        return {"power": self.power, "maxPower": self.maxPower}
+
+    def restore(self, state):
+        # in place, as the views in self.mono and self.multi share them
+        self.power[...] = state["power"]
+        self.maxPower[...] = state["maxPower"]
 
 def main():
     fc = NoiseFilter(1024, 44100, 30, 4500, 12000)
@@ -75,6 +144,16 @@ def main():
     print("Max:", fc.maxPower)
     print()
 
+    # both ears: each channel keeps its own noise estimate
+    fc = NoiseFilter(1024, 44100, 30, 4500, 12000, channels=2)
+    for i in range(0, 2000):
+        data = np.random.random([1025, 2]) + np.random.random([1025, 2]) * 1j
+        data[:, 1] *= 2.0
+        data[0] = 0
+        fc.averageNoise(data)
+    print("Max per channel:", fc.maxPower)
+    print()
+
 
 if __name__ == "__main__":
     import numpy as np
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+"""
+A noise suppressor to use instead of NoiseFilter. NoiseFilter smooths
+|data| (a square root per bin per block) and scales every bin by
+1 - power / maxPower, so whatever is loudest and sustained -- often the
+bird -- is turned down with the noise. This works on the power of each
+bin (re^2 + im^2, no square root) against an estimate of the noise
+floor, and turns a bin down only by how far it is above that floor.
+
+The floor is found by minimum statistics: the mean power of each bin
+over a segment of 'every' blocks (about 0.2 s), and the floor is the
+smallest of the last 'segments' segment means (about 1.5 s) times the
+bias of taking a minimum (worked out for those sizes). A bird singing
+for a while does not raise it, as some segment in the window is
+quieter. The update (every 'every' blocks, not every block) is also
+gated: each block, the mean of power / floor over the band is compared
+with a threshold, and a segment in which most blocks were above it is
+left out of the window unless the floor is a window old (so that a
+rise in the real noise, e.g. wind, is still followed).
+
+The gain of each bin is Wiener's, xi / (1 + xi), with the a priori SNR
+xi taken as max(gamma - 1, xi_min) from the a posteriori SNR gamma =
+power / (strength * floor); that is 1 - 1 / max(gamma, 1 + xi_min),
+worked out for all bins and channels at once. xi_min sets the lowest
+gain, 'floor' (0.1, -20 dB), and strength > 1 over-subtracts. Bins
+from 1 up to maxbirdfreq are suppressed; the mappings drop those
+above. Until the first segment is done the data is left alone.
+
+As with NoiseFilter, data is one channel or an (nbins, channels) array
+changed in place, one channel's state is shared by 1-D data and
+column 0, and dtype is the precision of the work arrays.
+"""
+import numpy
+
+import FrequencyGrid
+
+QUIET = 1e-20  # the least noise floor: 1 / floor stays finite in silence
+
+biases = {}  # (every, segments): bias, shared by every NoiseSuppressor
+
+
+def bias(every, segments, trials=4000):
+    # 1 / the expected least of 'segments' means of 'every' periodogram
+    # values of noise of unit power (each exponential, so a mean is
+    # gamma(every) / every)
+    key = (every, segments)
+    if key not in biases:
+        rng = numpy.random.default_rng(0)
+        means = rng.gamma(every, 1.0 / every, size=(trials, segments))
+        biases[key] = 1.0 / means.min(axis=1).mean()
+    return biases[key]
+
+
+class NoiseSuppressor(object):
+    def __init__(self, n_fft=1024, sample_freq=44100,
+        lower=30, upper=4500, maxbirdfreq=12000, channels=1,
+        hop=None, dtype=numpy.float64, every=None, window=1.5,
+        floor=0.1, strength=1.0, threshold=2.0):
+        self.N_FFT = n_fft
+        self.SAMPLE_FREQ = sample_freq
+        self.grid = FrequencyGrid.grid(n_fft, sample_freq)
+        self.LOWFREQ, self.UPPERFREQ, self.MAXBIRDFREQ = self.grid.limits(
+            lower, upper, maxbirdfreq)
+        self.top = min(self.MAXBIRDFREQ + 1, n_fft)  # bins 1 to top - 1
+        self.channels = channels
+
+        # suppress is called every hop samples (olafft's hop, n_fft
+        # unless the low latency mode is used)
+        period = (hop or n_fft) / sample_freq
+        self.every = every or max(1, int(round(0.2 / period)))
+        self.segments = max(2, int(round(window / (self.every * period))))
+        self.bias = bias(self.every, self.segments)
+        self.strength = strength
+        self.limit = 1.0 / (1.0 - floor)  # 1 + xi_min
+        self.threshold = threshold * (self.top - 1)  # summed over the bins
+
+        shape = [self.top - 1, channels]
+        self.power = numpy.zeros(shape, dtype=dtype)
+        self.gain = numpy.zeros(shape, dtype=dtype)
+        self.total = numpy.zeros(shape, dtype=dtype)  # this segment's
+        self.noise = numpy.zeros(shape, dtype=dtype)  # the floor
+        self.inverse = numpy.zeros(shape, dtype=dtype)  # 1 / (strength * floor)
+        self.minima = numpy.full([self.segments] + shape, numpy.inf,
+            dtype=dtype)  # segment means, a ring per channel
+        self.energy = numpy.zeros(channels, dtype=dtype)
+        self.loud = numpy.zeros(channels, dtype=bool)
+        self.active = numpy.zeros(channels, dtype=numpy.int64)  # loud blocks
+        self.slot = numpy.zeros(channels, dtype=numpy.int64)
+        self.stale = numpy.zeros(channels, dtype=numpy.int64)  # segments
+        self.count = 0  # blocks in this segment
+        self.ready = False  # until the first segment is done
+
+        # views used for mono (1-D) data, which shares channel 0's state
+        self.mono = (self.power[:, :1], self.gain[:, :1], self.total[:, :1],
+            self.inverse[:, :1], self.energy[:1], self.loud[:1],
+            self.active[:1], self.minima[..., :1], self.noise[:, :1],
+            self.slot[:1], self.stale[:1])
+        self.multi = (self.power, self.gain, self.total, self.inverse,
+            self.energy, self.loud, self.active, self.minima, self.noise,
+            self.slot, self.stale)
+
+    def suppress(self, data):
+        if data.ndim == 1:
+            views = self.mono
+            data = data[:, numpy.newaxis]
+        elif data.shape[1] == self.channels:
+            views = self.multi
+        else:
+            raise ValueError("NoiseSuppressor has %d channels, data has %d"
+                % (self.channels, data.shape[1]))
+        power, gain, total, inverse, energy, loud, active = views[:7]
+        bins = data[1:self.top]
+
+        numpy.multiply(bins.real, bins.real, out=power)
+        numpy.multiply(bins.imag, bins.imag, out=gain)
+        power += gain
+        total += power
+        self.count += 1
+
+        if self.ready:
+            numpy.multiply(power, inverse, out=gain)  # gamma
+            numpy.sum(gain, axis=0, out=energy)
+            numpy.greater(energy, self.threshold, out=loud)
+            active += loud
+            # 1 - 1 / max(gamma, 1 + xi_min)
+            numpy.maximum(gain, self.limit, out=gain)
+            numpy.reciprocal(gain, out=gain)
+            numpy.subtract(1.0, gain, out=gain)
+            bins *= gain
+
+        if self.count == self.every:
+            self.update(*views[2:])
+
+    def update(self, total, inverse, energy, loud, active, minima, noise,
+               slot, stale):
+        # end of a segment: add its mean to the window of each channel
+        # that was mostly quiet (or whose floor is a window old) and
+        # take the floor again
+        take = (2 * active <= self.every) | (stale >= self.segments - 1)
+        if not self.ready:
+            take[...] = True
+        stale += 1
+        for c in numpy.flatnonzero(take):
+            numpy.multiply(total[:, c], 1.0 / self.every,
+                out=minima[slot[c], :, c])
+            slot[c] = (slot[c] + 1) % self.segments
+            stale[c] = 0
+        if take.any():
+            numpy.min(minima, axis=0, out=noise)
+            noise *= self.bias
+            numpy.maximum(noise, QUIET, out=noise)
+            numpy.multiply(noise, self.strength, out=inverse)
+            numpy.reciprocal(inverse, out=inverse)
+        total[...] = 0
+        active[...] = 0
+        self.count = 0
+        self.ready = True
+
+    def state(self):
+        # e.g. to checkpoint a long render
+        return {"total": self.total, "noise": self.noise,
+                "inverse": self.inverse, "minima": self.minima,
+                "active": self.active, "slot": self.slot,
+                "stale": self.stale, "count": numpy.array(self.count),
+                "ready": numpy.array(self.ready)}
+
+    def restore(self, state):
+        # in place, as the views in self.mono and self.multi share them
+        for name in ("total", "noise", "inverse", "minima", "active",
+                     "slot", "stale"):
+            getattr(self, name)[...] = state[name]
+        self.count = int(state["count"])
+        self.ready = bool(state["ready"])
+
+
+def main():
+    import time
+    import NoiseFilter
+
+    # spectra of coloured noise with a bird: a tone in a few bins that
+    # sings for 0.5 s in every 1.5 s
+    n_fft, samplerate, blocks = 1024, 44100, 2000
+    rng = numpy.random.default_rng(1)
+    level = 1.0 / numpy.sqrt(1.0 + numpy.arange(n_fft + 1) / 50.0)
+    noise = (rng.standard_normal([blocks, n_fft + 1, 2])
+        + 1j * rng.standard_normal([blocks, n_fft + 1, 2])) * level[:, None]
+    song = numpy.zeros([blocks, n_fft + 1, 2], dtype=complex)
+    singing = (numpy.arange(blocks) % 64) < 21
+    song[singing, 180:183] = 20.0 * numpy.exp(2j * numpy.pi
+        * rng.random([singing.sum(), 3, 2]))
+
+    for name, make, run in (
+            ("NoiseFilter", NoiseFilter.NoiseFilter, "averageNoise"),
+            ("NoiseSuppressor", NoiseSuppressor, "suppress")):
+        fc = make(n_fft, samplerate, channels=2)
+        process = getattr(fc, run)
+        noisy, sung, times = [], [], []
+        for i in range(blocks):
+            data = noise[i] + song[i]
+            clean = data.copy()
+            start = time.perf_counter()
+            process(data)
+            times.append(time.perf_counter() - start)
+            if i >= blocks // 2:  # once settled
+                gain = abs(data[1:n_fft]) ** 2 / abs(clean[1:n_fft]) ** 2
+                noisy.append(gain[:170].mean())
+                if singing[i]:
+                    sung.append(gain[180:183].mean())
+        print("%-16s noise %6.1f dB, song %6.1f dB, %6.1f us per block" % (
+            name, 10 * numpy.log10(numpy.mean(noisy)),
+            10 * numpy.log10(numpy.mean(sung)),
+            numpy.median(times) * 1e6))
+
+    # mono data uses channel 0's state
+    fc = NoiseSuppressor(n_fft, samplerate, channels=2)
+    for i in range(200):
+        fc.suppress(noise[i, :, 0].copy())
+    print("mono: every %d blocks, window %d segments, bias %.2f, floor "
+          "%.3g (noise %.3g)" % (fc.every, fc.segments, fc.bias,
+          fc.noise[200, 0], 2 * level[201] ** 2))
+
+
+if __name__ == "__main__":
+    main()
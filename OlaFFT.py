@@ -11,25 +11,146 @@ hence Hanning or Blackman are currently allowed.
 This class assumes stereo. If mono is presented to rfft, it will be converted to 
 stereo and the output will be a "stereo" of the frequency data since, in most cases, 
 stereo out is the same for mono or stereo. 
+
+layout says what the channels are, so that nothing is transformed twice: 
+
+    stereo   (the default) two channels, each transformed and filtered; 
+             mono input is written to both, as above
+    mono     one channel (a 1-D block, or the first column of a 2-D one) 
+             is transformed once, freqdata has one column, and the 
+             result is written to both output channels at the end: half 
+             the transforms of stereo for a mono source
+    midside  hop mode only: a stereo pair is split into mid (L + R) / 2, 
+             which is transformed and filtered alone (freqdata has one 
+             column), and side (L - R) / 2, which is delayed by 
+             latency_samples, as hop mode passes unfiltered sound through; 
+             the output is L = mid + side, R = mid - side. For when only 
+             the mid needs filtering, at the cost of mono. 
+
+With ring=True the buffers are used circularly instead of being shifted 
+every block: the input is kept twice (a mirrored ring) so the window is 
+always a contiguous view, the output is accumulated in place at a moving 
+offset, and both channels are windowed and transformed by one rfft/irfft 
+along axis 0. Every array is allocated in the constructor so, with 
+NumPy 2 (which accepts out= in numpy.fft), a block allocates no arrays 
+apart from the scratch space numpy.fft uses internally. The output is 
+the same as the shifting version to within single precision rounding. 
+
+backend chooses the FFT implementation (see FFTBackends): 'numpy' (the 
+default), 'scipy', 'fftw', 'auto' to time them all on this machine and 
+take the fastest, or a backend object. 
+
+hop (in samples) selects the low latency mode: a standard weighted 
+overlap-add of frames of frame samples (default 2 * blocksize, the same 
+frequency resolution as the other modes; freqdata has frame // 2 + 1 
+bins) advanced by hop, e.g. frame // 2 for 50 % overlap or frame // 4 
+for 75 %. hop must divide blocksize: process() takes a device block, 
+runs blocksize // hop frames, calling a stage on freqdata for each, and 
+returns the block. Both windows are the square root of a periodic Hann 
+(or Blackman) window, normalised so that unfiltered input comes back 
+exactly. Output sample n is input sample n - latency_samples, where 
+latency_samples = frame - hop. 
+
+So the delay is set by the frame, not the device block: a smaller 
+blocksize with the frame kept at 2048 (e.g. blocksize = hop = 256) keeps 
+the 1025 bins while the device buffers, which add a block or two on 
+each side, shrink with the blocksize. Smaller hops add overlap (and a 
+little delay) but let the filtering follow changes more closely. 
+
+mirror (ring and hop modes, stereo layout) can be set between blocks 
+to halve the work when the machine cannot keep up: only channel 0 is 
+windowed and transformed (into freqdata[:, 0], so a chain filtering 
+channel 0 carries on) and its frames are overlap-added into both 
+channels of the output. Both channels' input is still kept, so the 
+overlap-add crossfades between the two over one frame each way (in the 
+ring mode each channel keeps its own running sum, described in 
+olabatch, so channel 1 is channel 0 plus that). 
+
+The shifting and ring modes are not a pure delay: most of the signal 
+comes out one block late (latency_samples = blocksize) but part of it 
+comes 3 * overlap late, plus the running sum described in olabatch. 
+
+dtype is the device's sample format. The default, float64, works as 
+before (float64 buffers, complex64 freqdata). float32 keeps every 
+buffer float32 so that, with a backend that transforms in single 
+precision (numpy 2, scipy, fftw), a block is float32 in, complex64 in 
+the frequency domain and float32 out with no conversions in between: 
+half the bytes of float64. int16 takes int16 blocks and works in 
+float32: the 1 / 32768 that brings samples to +-1 is folded into the 
+analysis window (so freqdata has the same scale as for float input) 
+and the 32768 back into the synthesis window in hop mode, or into the 
+copy to the int16 output, which rounds and clips. int16 needs ring or 
+hop mode. 
+
+process_stream(chunks, stage) takes an iterable of chunks of any length 
+(soundfile's blocks(), network frames, ...) and yields the output as 
+each block is done: the chunks are re-blocked into a preallocated block, 
+or taken straight from the chunk when a whole block is there, and at the 
+end the last part block is padded with zeros and the delayed tail is 
+flushed out. 
 """
 import numpy
 import math
 
+import FFTBackends
+
+
+def precision(dtype):
+    """
+    Returns the dtype to work in for device samples of dtype and the 
+    full scale of an integer format (None for float formats). 
+    """
+    dtype = numpy.dtype(dtype or numpy.float64)
+    if dtype == numpy.int16:
+        return numpy.dtype(numpy.float32), 32768.0
+    if dtype in (numpy.float32, numpy.float64):
+        return dtype, None
+    raise ValueError("dtype must be float64, float32 or int16")
+
+
+def toint16(source, out, scratch, scale=None):
+    # out[:] = source * scale rounded and clipped to int16, through the 
+    # float array scratch (the size of source), so nothing is allocated
+    if scale is not None:
+        numpy.multiply(source, scale, out=scratch)
+        source = scratch
+    numpy.rint(source, out=scratch)
+    numpy.clip(scratch, -32768, 32767, out=scratch)
+    out[...] = scratch
+    return out
+
 
 class olafft:
     
-    def __init__(self, blocksize, masktype="hanning"):
+    def __init__(self, blocksize, masktype="hanning", ring=False, 
+                 backend="numpy", hop=None, frame=None, dtype=None, 
+                 layout="stereo"):
         if math.log2(blocksize) % 2 != 0:
             Exception("Blocksize must be a power of 2.")
         self.blocksize = blocksize
         self.overlap = self.blocksize // 2
+        self.dtype = numpy.dtype(dtype or numpy.float64)
+        self.real, self.scale = precision(self.dtype)
+        if self.scale is not None and not ring and hop is None:
+            raise ValueError("int16 needs ring=True or a hop")
+        real = self.real
+        if layout not in ("stereo", "mono", "midside"):
+            raise ValueError("layout must be stereo, mono or midside")
+        if layout == "midside" and (hop is None or self.scale is not None):
+            raise ValueError("midside needs a hop and float samples")
+        self.layout = layout
+        # the channels transformed: one for mono and midside
+        self.columns = columns = 2 if layout == "stereo" else 1
         
         # create global areas for buffering and processing of channel data
-        self.inbuffer = numpy.zeros([self.blocksize * 3, 2])
-        self.outbuffer = numpy.zeros([self.blocksize + self.overlap * 2, 2])
-        self.timedata = numpy.zeros([self.blocksize + self.overlap * 2, 2])
-        self.channel = numpy.zeros([self.blocksize + self.overlap * 2])
-        self.freqdata = numpy.zeros([self.blocksize + 1, 2], dtype=numpy.csingle)
+        self.inbuffer = numpy.zeros([self.blocksize * 3, columns], dtype=real)
+        self.outbuffer = numpy.zeros([self.blocksize + self.overlap * 2, columns], dtype=real)
+        self.timedata = numpy.zeros([self.blocksize + self.overlap * 2, columns], dtype=real)
+        self.channel = numpy.zeros([self.blocksize + self.overlap * 2], dtype=real)
+        self.freqdata = numpy.zeros([self.blocksize + 1, columns], dtype=numpy.csingle)
+        # the block returned, always stereo (the shifting version returns 
+        # outbuffer itself when stereo)
+        self.output = numpy.zeros([self.blocksize, 2], dtype=self.dtype)
         
         self.masktype = None
         
@@ -47,12 +168,276 @@ class olafft:
         else:
             Exception(
                 "Mask type, if defined, must be 'Hanning' or 'Blackman'")
+        self.mask = self.mask.astype(real)
+        if self.scale is not None:
+            self.mask /= self.scale
+
+        self.backend = FFTBackends.get(backend, 
+            shape=[self.blocksize + self.overlap * 2, columns], dtype=real)
+
+        self.ring = ring
+        if ring:
+            # input: three blocks, stored twice so that the last three 
+            # blocks are always contiguous starting at slot (slot + 1) % 3
+            self.inring = numpy.zeros([self.blocksize * 6, columns], dtype=real)
+            self.slot = 0
+            # output: a ring the length of outbuffer read from offset 
+            self.outring = numpy.zeros([self.blocksize + self.overlap * 2, 
+                columns], dtype=real)
+            self.offset = 0
+            # a full (frame, columns) window: broadcasting a column makes 
+            # numpy.multiply buffer the operands
+            self.window = numpy.column_stack((self.mask,) * columns)
+            self.frame = numpy.zeros([self.blocksize + self.overlap * 2, 
+                columns], dtype=real)
+            self.scratch = numpy.zeros([self.blocksize, columns], dtype=real)
+
+        self.hop = hop
+        if hop is not None:
+            self.makeHop(hop, frame or self.blocksize + self.overlap * 2)
+
+        # channel 0 only, both out
+        self.mirror = False
+        if columns == 2 and (ring or hop is not None):
+            # 1-D, which transforms faster than a one column array
+            self.mirrorframe = numpy.zeros(len(self.frame), dtype=real)
+            self.mirrorfreq = numpy.zeros(len(self.freqdata), 
+                dtype=self.freqdata.dtype)
+
+    def makeHop(self, hop, size):
+        if hop < 1 or self.blocksize % hop != 0:
+            raise ValueError("hop must divide the blocksize")
+        if size % hop != 0 or hop > size // 2:
+            raise ValueError("hop must divide the frame and be at most half of it")
+        columns = self.columns
+        self.freqdata = numpy.zeros([size // 2 + 1, columns], dtype=numpy.csingle)
+        # periodic windows, square rooted as they are used twice
+        if self.masktype == "blackman":
+            window = numpy.sqrt(numpy.maximum(numpy.blackman(size + 1)[:-1], 0))
+        else:
+            window = numpy.sqrt(numpy.hanning(size + 1)[:-1])
+        # overlap-add of window ** 2 at this hop, per sample of the hop
+        norm = (window ** 2).reshape(-1, hop).sum(axis=0)
+        synthesis = window / numpy.tile(norm, size // hop)
+        if self.scale is not None:  # int16 in and out
+            window = window / self.scale
+            synthesis = synthesis * self.scale
+
+        real = self.real
+        self.window = numpy.column_stack((window,) * columns).astype(real)
+        self.synthesis = numpy.column_stack((synthesis,) * columns).astype(real)
+        # last frame of input, stored twice so it is always contiguous
+        self.inring = numpy.zeros([size * 2, columns], dtype=real)
+        self.write = 0
+        # output being overlap-added, read hop samples at a time from offset
+        self.outring = numpy.zeros([size, columns], dtype=real)
+        self.offset = 0
+        self.frame = numpy.zeros([size, columns], dtype=real)
+        self.scratch = numpy.zeros([hop, columns], dtype=real)
+        if self.layout == "midside":
+            n = self.blocksize
+            self.mid = numpy.zeros([n, 1], dtype=real)
+            self.midout = numpy.zeros([n, 1], dtype=real)
+            # side, delayed by size - hop: a ring of whole blocks, stored 
+            # twice so the delayed block is always contiguous
+            self.sides = -(-(size - hop + n) // n) * n
+            self.sidering = numpy.zeros([self.sides * 2, 1], dtype=real)
+            self.sidewrite = 0
+
+    @property
+    def latency_samples(self):
+        if self.hop is not None:
+            return len(self.frame) - self.hop
+        return self.blocksize
+
+    def process(self, indata, stage=None, out=None):
+        """
+        Hop mode: filters one block of input, calling stage() (e.g. 
+        FilterChain.run) to change self.freqdata in place for each 
+        frame, and returns the output block (in out, if given). 
+        """
+        if self.hop is None:
+            freqdata = self.rfft(indata)
+            if stage is not None:
+                stage()
+            return self.irfft(freqdata, out)
+        if out is None:
+            out = self.output
+        target = out
+        if self.layout == "midside":
+            indata = self.split(indata)
+            target = self.midout
+        else:
+            indata = self.columnsof(indata)
+        for start in range(0, self.blocksize, self.hop):
+            self.analyse(indata[start:start + self.hop])
+            if stage is not None:
+                stage()
+            self.synthesise(target[start:start + self.hop])
+        if self.layout == "midside":
+            self.join(out)
+        return out
+
+    def columnsof(self, indata):
+        # indata as (samples, columns): mono goes to both stereo columns 
+        # by broadcasting, and the mono layout takes the first channel
+        if indata.ndim == 1:
+            return indata[:, numpy.newaxis]
+        if self.columns == 1:
+            return indata[:, :1]
+        return indata
+
+    def split(self, indata):
+        # midside: returns the mid of a block and puts its side in the ring
+        left, right = indata[:, 0:1], indata[:, 1:2]
+        numpy.add(left, right, out=self.mid)
+        self.mid *= 0.5
+        n = self.blocksize
+        w = self.sidewrite
+        side = self.sidering[w:w + n]
+        numpy.subtract(left, right, out=side)
+        side *= 0.5
+        self.sidering[w + self.sides:w + self.sides + n] = side
+        return self.mid
+
+    def join(self, out):
+        # midside: out = mid +- the side of latency_samples ago
+        n = self.blocksize
+        w = self.sidewrite
+        r = (w - self.latency_samples) % self.sides
+        side = self.sidering[r:r + n]
+        numpy.add(self.midout, side, out=out[:, 0:1])
+        numpy.subtract(self.midout, side, out=out[:, 1:2])
+        self.sidewrite = (w + n) % self.sides
+
+    def process_stream(self, chunks, stage=None, align=True):
+        """
+        Yields the output for chunks (arrays of any length, mono or with 
+        the same channels throughout) as it becomes available, with the 
+        channels of the input. stage is as for process(). With align 
+        (the default) the first latency_samples of output are dropped so 
+        that output sample n is input sample n, and exactly as many 
+        samples come out as went in; otherwise the output is as a device 
+        would play it and has latency_samples more at the end. The arrays 
+        yielded are reused: copy them to keep them. 
+        """
+        n = self.blocksize
+        pending = None  # the part block being collected
+        filled = 0
+        received = produced = 0  # samples in, samples out of process
+        skip = self.latency_samples if align else 0
+        out = numpy.zeros([n, 2], dtype=self.dtype)  # always stereo
+        for chunk in chunks:
+            chunk = numpy.asarray(chunk)
+            if chunk.ndim == 1:
+                chunk = chunk[:, numpy.newaxis]
+            if pending is None:
+                channels = chunk.shape[1]
+                pending = numpy.zeros([n, channels], dtype=self.dtype)
+            received += len(chunk)
+            i = 0
+            while i < len(chunk):
+                if filled == 0 and len(chunk) - i >= n:
+                    # whole blocks straight from the chunk
+                    size = n * (self.streamrun or (len(chunk) - i) // n)
+                    block = chunk[i:i + size]
+                    i += size
+                else:
+                    take = min(n - filled, len(chunk) - i)
+                    pending[filled:filled + take] = chunk[i:i + take]
+                    filled += take
+                    i += take
+                    if filled < n:
+                        break
+                    block = pending
+                    filled = 0
+                result = self.streamblocks(block, stage, out)
+                first = min(max(skip - produced, 0), len(result))
+                produced += len(result)
+                if first < len(result):
+                    yield result[first:, :channels]
+
+        if pending is None:
+            return
+        # zeros in until everything received has come out
+        end = received + self.latency_samples
+        pending[filled:] = 0
+        while produced < end:
+            result = self.streamblocks(pending, stage, out)
+            pending.fill(0)
+            first = min(max(skip - produced, 0), len(result))
+            last = min(end - produced, len(result))
+            produced += len(result)
+            if first < last:
+                yield result[first:last, :channels]
+
+    # blocks per call to streamblocks when a chunk has several (None: 
+    # as many as there are)
+    streamrun = 1
+
+    def streamblocks(self, data, stage, out):
+        return self.process(data, stage, out)
+
+    def analyse(self, indata):
+        size = len(self.outring)
+        hop = self.hop
+        w = self.write
+        self.inring[w:w + hop] = indata
+        self.inring[w + size:w + size + hop] = indata
+        w = self.write = (w + hop) % size
+        if self.mirror:
+            numpy.multiply(self.inring[w:w + size, 0], self.window[:, 0], 
+                out=self.mirrorframe)
+            self.backend.rfft(self.mirrorframe, out=self.mirrorfreq)
+            self.freqdata[:, 0] = self.mirrorfreq
+            return
+        numpy.multiply(self.inring[w:w + size], self.window, out=self.frame)
+        self.backend.rfft(self.frame, out=self.freqdata)
+
+    def synthesise(self, out):
+        size = len(self.outring)
+        hop = self.hop
+        if self.mirror:
+            self.mirrorfreq[:] = self.freqdata[:, 0]
+            self.backend.irfft(self.mirrorfreq, out=self.mirrorframe)
+            self.mirrorframe *= self.synthesis[:, 0]
+            self.unmirror()
+        else:
+            self.backend.irfft(self.freqdata, out=self.frame)
+            self.frame *= self.synthesis
+        p = self.offset
+        self.outring[p:] += self.frame[:size - p]
+        self.outring[:p] += self.frame[size - p:]
+        # the oldest hop now has every frame that overlaps it
+        if self.scale is None:
+            out[:] = self.outring[p:p + hop]
+        else:  # already scaled by the synthesis window
+            toint16(self.outring[p:p + hop], out, self.scratch)
+        self.outring[p:p + hop] = 0
+        self.offset = (p + hop) % size
+
+    def unmirror(self):
+        # the mirror frame into both channels of frame (quicker than 
+        # adding it to the output ring by broadcasting)
+        self.frame[:, 0] = self.mirrorframe
+        self.frame[:, 1] = self.mirrorframe
 
     def rfft(self, indata: numpy.array):
+        if self.hop is not None:
+            if self.hop != self.blocksize:
+                raise ValueError("use process() when hop != blocksize")
+            if self.layout == "midside":
+                self.analyse(self.split(indata))
+            else:
+                self.analyse(self.columnsof(indata))
+            return self.freqdata
+        if self.ring:
+            return self.rfftRing(indata)
+
         # because of buffering, we introduce a delay of 3 reads before output
         # is clean. 
-        if indata.ndim == 1: # if mono, make "stereo"
-            indata = numpy.column_stack((indata, indata))
+        # if mono, make "stereo" (or keep the one channel of the mono layout)
+        indata = self.columnsof(indata)
         
         self.inbuffer[self.blocksize * 2:] = indata  # append to inbuffer
         self.timedata = self.inbuffer[
@@ -61,18 +446,29 @@ class olafft:
         ]
 
         # expand with loop to do all channels
-        for i in range(2):
+        for i in range(self.columns):
             # replace timedata with inbuffer[blocksize - overlap:blocksize * 2 + overlap, :]?
             self.channel[:] = self.timedata[:, i] * self.mask
             # do fft
-            self.freqdata[:, i] = numpy.fft.rfft(self.channel)
+            self.freqdata[:, i] = self.backend.rfft(self.channel)
         
         return self.freqdata
 
-    def irfft(self, freqdata):
+    def irfft(self, freqdata, out=None):
+        if self.hop is not None:
+            if out is None:
+                out = self.output
+            if self.layout == "midside":
+                self.synthesise(self.midout)
+                self.join(out)
+            else:
+                self.synthesise(out)
+            return out
+        if self.ring:
+            return self.irfftRing(freqdata, out)
     
-        for i in range(2):
-            self.channel = numpy.fft.irfft(freqdata[:, i])
+        for i in range(self.columns):
+            self.channel = self.backend.irfft(freqdata[:, i])
             self.outbuffer[:, i] += self.channel
 
         self.inbuffer[:-self.blocksize] = self.inbuffer[self.blocksize:]  # left shift inbuffer
@@ -80,7 +476,191 @@ class olafft:
     
         self.outbuffer[:-self.overlap] = self.outbuffer[self.overlap:]  # left shift outbuffer
         # self.outbuffer[-self.overlap:] = 0  # here, we do a add to the overlap and this zeroed area
+        if self.columns == 1:  # fan the mono block out to both channels
+            if out is None:
+                out = self.output
+            out[:] = self.outbuffer[:self.blocksize]
+            return out
         return self.outbuffer[:self.blocksize]
+
+    def rfftRing(self, indata):
+        n = self.blocksize
+        start = self.slot * n
+        indata = self.columnsof(indata)  # if mono, write it to both channels
+        self.inring[start:start + n] = indata
+        self.inring[start + n * 3:start + n * 4] = indata
+
+        # the last three blocks; the window is the same span of them 
+        # that the shifting version uses
+        first = (self.slot + 1) % 3 * n
+        self.timedata = self.inring[first + n - self.overlap:
+                                    first + n * 2 + self.overlap]
+        if self.mirror:
+            numpy.multiply(self.timedata[:, 0], self.window[:, 0], 
+                out=self.mirrorframe)
+            self.backend.rfft(self.mirrorframe, out=self.mirrorfreq)
+            self.freqdata[:, 0] = self.mirrorfreq
+            return self.freqdata
+        numpy.multiply(self.timedata, self.window, out=self.frame)
+        self.backend.rfft(self.frame, out=self.freqdata)
+        return self.freqdata
+
+    def irfftRing(self, freqdata, out=None):
+        # out, if given, receives the block (e.g. outdata in a callback); 
+        # otherwise a preallocated array is returned
+        if self.mirror:
+            self.mirrorfreq[:] = freqdata[:, 0]
+            self.backend.irfft(self.mirrorfreq, out=self.mirrorframe)
+            self.unmirror()
+        else:
+            self.backend.irfft(freqdata, out=self.frame)
+
+        # add the frame to the whole ring starting at the logical start
+        size = len(self.outring)
+        p = self.offset
+        self.outring[p:] += self.frame[:size - p]
+        self.outring[:p] += self.frame[size - p:]
+
+        self.slot = (self.slot + 1) % 3
+
+        # The shifting version moves outbuffer left by overlap and leaves 
+        # its last overlap samples in place, so they appear twice. Moving 
+        # the offset does the shift; copying those samples into the 
+        # slot that becomes the new tail keeps the duplicate.
+        tail = (p + size - self.overlap) % size
+        self.outring[p:p + self.overlap] = self.outring[tail:tail + self.overlap]
+        p = self.offset = (p + self.overlap) % size
+
+        if out is None:
+            out = self.output
+        # a mono ring goes to every channel of out by broadcasting
+        first = min(self.blocksize, size - p)
+        if self.scale is None:
+            out[:first] = self.outring[p:p + first]
+            out[first:] = self.outring[:self.blocksize - first]
+        else:
+            toint16(self.outring[p:p + first], out[:first], 
+                self.scratch[:first], self.scale)
+            toint16(self.outring[:self.blocksize - first], out[first:], 
+                self.scratch[first:], self.scale)
+        return out
+
+
+class olabatch(olafft):
+    """
+    Offline version of olafft: processes many blocks at once and gives 
+    the same output as calling rfft/irfft (ring=True) block by block. 
+
+    process() takes (nblocks * blocksize, channels) samples. The frames 
+    are strided views of the input, windowed and transformed together, 
+    and stage (if given) is called once with all of their spectra as a 
+    (blocksize + 1, nblocks, channels) array to filter in place. Stages 
+    that keep state from block to block (NoiseFilter) must step along 
+    axis 1 themselves. The last 3 * overlap input samples and the 
+    overlap-add state are carried over to the next call, so a file can 
+    be processed in chunks of any whole number of blocks. dtype is 
+    float64 (the default) or float32, for the samples and the work. 
+    processVariants() filters the same blocks with several stages at the 
+    cost of one forward transform and a batched inverse. 
+
+    Streaming, outbuffer is shifted left by overlap each block and its 
+    last quarter (overlap samples) is left in place, so that quarter 
+    becomes a running sum of the last quarter of every irfft frame. With 
+    y1, y2, y3 the 2nd to 4th quarters of frame t and D the running sum, 
+    output block t is [second(t-1) + y1(t), second(t)] where 
+    second(t) = D(t-1) + y2(t). This is computed with numpy.cumsum, which 
+    adds in the same order as the block-by-block version. 
+    """
+    def __init__(self, blocksize, masktype="hanning", backend="numpy", 
+                 dtype=None):
+        olafft.__init__(self, blocksize, masktype, backend=backend, 
+            dtype=dtype)
+        if self.scale is not None:
+            raise ValueError("olabatch works on float samples")
+        self.history = None  # last 3 * overlap input samples
+        self.running = None  # D, the running sum of last quarters
+        self.second = None  # second half of the previous output block
+
+    def reset(self):
+        # start a new stream, keeping the window and FFT plans
+        self.history = self.running = self.second = None
+
+    # process_stream hands over every whole block a chunk has at once, 
+    # and stage takes the spectra as for process()
+    streamrun = None
+
+    def streamblocks(self, data, stage, out):
+        return self.process(data, stage)
+
+    def process(self, data, stage=None):
+        freqdata = self.spectra(data)
+        if stage is not None:
+            stage(freqdata.transpose(2, 0, 1))
+        return self.overlapadd(self.backend.irfft(freqdata, axis=-1))
+
+    def processVariants(self, data, stages):
+        """
+        Filters data with each of stages (as for process()) from one 
+        forward analysis: the spectra are copied into a (len(stages), 
+        nblocks, channels, bins) stack, each stage filters its copy and 
+        one batched irfft transforms them all. Returns a (len(stages), 
+        samples, channels) array, each variant the same as process() 
+        with its stage would give. The overlap-add state is kept per 
+        variant, so a stream must use the same stages in every call (and 
+        not mix this with process()). 
+        """
+        freqdata = self.spectra(data)
+        variants = numpy.empty((len(stages),) + freqdata.shape, 
+            dtype=freqdata.dtype)
+        variants[:] = freqdata
+        for stage, spectra in zip(stages, variants):
+            if stage is not None:
+                stage(spectra.transpose(2, 0, 1))
+        return self.overlapadd(self.backend.irfft(variants, axis=-1))
+
+    def spectra(self, data):
+        # the windowed frames of whole blocks of data, transformed: 
+        # (nblocks, channels, bins)
+        n = self.blocksize
+        h = self.overlap
+        if data.ndim == 1:
+            data = data[:, numpy.newaxis]
+        if len(data) % n != 0:
+            raise ValueError("process needs a whole number of blocks")
+        nblocks = len(data) // n
+        if self.history is None:
+            self.history = numpy.zeros([h * 3, data.shape[1]], dtype=self.real)
+
+        # frame t is samples [t * n - 3h, t * n + h) of the stream
+        padded = numpy.concatenate((self.history, data))
+        frames = numpy.lib.stride_tricks.sliding_window_view(
+            padded, n * 2, axis=0)[::n][:nblocks]  # (nblocks, channels, 2n)
+        self.history = padded[-h * 3:].copy()
+        return self.backend.rfft(frames * self.mask, axis=-1).astype(numpy.csingle)
+
+    def overlapadd(self, y):
+        # the output blocks from irfft frames y of shape (..., nblocks, 
+        # channels, 2n), the leading axes (variants) each with their own 
+        # running sums
+        n = self.blocksize
+        h = self.overlap
+        *lead, nblocks, channels, _ = y.shape
+        if self.running is None:
+            self.running = numpy.zeros(lead + [channels, h], dtype=self.real)
+            self.second = numpy.zeros(lead + [channels, h], dtype=self.real)
+
+        running = numpy.cumsum(
+            numpy.concatenate((self.running[..., numpy.newaxis, :, :], 
+            y[..., h * 3:]), axis=-3, dtype=self.real), axis=-3)
+        second = running[..., :-1, :, :] + y[..., h * 2:h * 3]
+        first = numpy.concatenate((self.second[..., numpy.newaxis, :, :], 
+            second[..., :-1, :, :]), axis=-3) + y[..., h:h * 2]
+        self.running = running[..., -1, :, :]
+        self.second = second[..., -1, :, :]
+
+        out = numpy.concatenate((first, second), axis=-1)  # (..., nblocks, channels, n)
+        return out.swapaxes(-1, -2).reshape(lead + [nblocks * n, channels])
+
     
 def main():
     BUFFERSIZE = 1024
@@ -12,12 +12,17 @@ larger than the available RAM.
 This example is implemented using NumPy, see play_long_file_raw.py
 for a version that doesn't need NumPy.
 
+The file is filtered as it is read, by olafft.process_stream, so the
+callback only copies blocks out and the last, short, block goes through
+the FFT (and its delayed tail is played) like the others.
+
 """
 import argparse
 import queue
 import sys
 import threading
 
+import numpy
 import sounddevice as sd
 import soundfile as sf
 
@@ -85,27 +90,28 @@ def callback(outdata, frames, time, status):
         outdata[len(data):].fill(0)
         raise sd.CallbackStop
     else:
-        freqdata = olaFFT.rfft(data)
-        data = olaFFT.irfft(freqdata)
         outdata[:] = data
 
 
 try:
     with sf.SoundFile(args.filename) as f:
-        for _ in range(args.buffersize):
-            data = f.read(args.blocksize)
-            if not len(data):
-                break
+        # filtered blocks as played, the last one short; copied as
+        # process_stream reuses its output array
+        blocks = (block.copy() for block in olaFFT.process_stream(
+            f.blocks(args.blocksize), align=False))
+        for data in blocks:
             q.put_nowait(data)  # Pre-fill queue
+            if q.full():
+                break
         stream = sd.OutputStream(
             samplerate=f.samplerate, blocksize=args.blocksize,
             device=args.device, channels=2,  # always stereo out
             callback=callback, finished_callback=event.set)
         with stream:
             timeout = args.blocksize * args.buffersize / f.samplerate
-            while len(data):
-                data = f.read(args.blocksize)
+            for data in blocks:
                 q.put(data, timeout=timeout)
+            q.put(numpy.zeros([0, 2]), timeout=timeout)  # stop, if not yet
             event.wait()  # Wait until playback is finished
 except KeyboardInterrupt:
     parser.exit('\nInterrupted by user')
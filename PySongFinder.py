@@ -3,15 +3,14 @@
 """
 # import debugpy # needed only for debugging in threads
 
+import Startup
+startup = Startup.Startup()  # first, to time the imports
 
 import argparse
 
-import sounddevice as sd
-import numpy  # Make sure NumPy is loaded before it is used in the callback
-assert numpy  # avoid "imported but unused" message (W0611)
-import OlaFFT
-import Filters
-import NoiseFilter
+# sounddevice, NumPy and the filter modules are imported once the 
+# arguments are known (so --help and mistakes are quick), and the 
+# modules only some options use when they are given
 
 def int_or_str(text):
     """Helper function for argument parsing."""
@@ -27,6 +26,7 @@ parser.add_argument(
     help='show list of audio devices and exit')
 args, remaining = parser.parse_known_args()
 if args.list_devices:
+    import sounddevice as sd
     print(sd.query_devices())
     parser.exit(0)
 parser = argparse.ArgumentParser(
@@ -42,45 +42,380 @@ parser.add_argument(
 parser.add_argument(
     '-c', '--channels', type=int, default=2,
     help='number of channels')
-parser.add_argument('--dtype', help='audio data type')
+parser.add_argument('--dtype', default='float32',
+                    help='audio data type, kept through the processing: float32, '
+                         'int16 or float64 (default: %(default)s)')
 parser.add_argument('--samplerate', type=float, help='sampling rate', default=44100)
 parser.add_argument('--blocksize', type=int, help='block size', default=1024)
 parser.add_argument('--latency', type=float, help='latency in seconds')
+parser.add_argument('-m', '--mode', default='fold',
+                    choices=['fold', 'linear', 'nonlinear', 'divide', 'none'],
+                    help='frequency mapping (default: %(default)s)')
+parser.add_argument('--divisor', type=int, default=2, choices=[2, 3, 4],
+                    help='divisor for --mode divide (default: %(default)s)')
+parser.add_argument('--start', type=float, default=3000,
+                    help='lowest frequency divided, Hz (default: %(default)s)')
+parser.add_argument('--no-noise', action='store_true',
+                    help='start without the noise filter')
+parser.add_argument('--noise-type', default='average',
+                    choices=['average', 'wiener'],
+                    help='the NoiseFilter average or the NoiseSuppressor '
+                         '(minimum statistics and Wiener gains) '
+                         '(default: %(default)s)')
+parser.add_argument('--hop', type=int,
+                    help='low latency mode: frames advance by HOP samples, '
+                         'which must divide the block size')
+parser.add_argument('--frame', type=int,
+                    help='with --hop, the frame length (default: twice the '
+                         'block size)')
+parser.add_argument('--layout', default='stereo',
+                    choices=['stereo', 'mono', 'midside'],
+                    help='stereo filters both channels; mono takes one input '
+                         'channel, transforms it once and plays it on every '
+                         'output channel; midside (with --hop) filters only '
+                         'the mid of a stereo pair (default: %(default)s)')
+parser.add_argument('--fft', default='numpy',
+                    help='FFT backend: numpy, scipy, fftw or auto (default: %(default)s)')
+parser.add_argument('--monitor', nargs='?', const='-', metavar='FILE',
+                    help='time each stage and report to FILE (default: stdout)')
+parser.add_argument('--monitor-interval', type=float, default=10.0,
+                    help='seconds between monitor reports (default: %(default)s)')
+parser.add_argument('--eq', metavar='FILE',
+                    help='FIR filter applied to the output by partitioned '
+                         'convolution: .npy or audio file, one channel per ear')
+parser.add_argument('--worker', type=int, metavar='SAFETY',
+                    help='run the processing on a worker thread, SAFETY blocks '
+                         'behind the input; a late block plays unfiltered')
+parser.add_argument('--tap', nargs='?', const='songfinder-tap', metavar='NAME',
+                    help='publish the spectrum before and after filtering in '
+                         'shared memory NAME for SpectrumTap.py to view')
+parser.add_argument('--tap-every', type=int, default=4, metavar='N',
+                    help='publish every N blocks (default: %(default)s)')
+parser.add_argument('--cache', metavar='DIR',
+                    help='keep the filter tables and FFT plans in DIR between '
+                         'runs (default: $SONGFINDER_CACHE or '
+                         '~/.cache/songfinder)')
+parser.add_argument('--no-cache', action='store_true',
+                    help='make the tables afresh and do not save them')
+parser.add_argument('--startup', action='store_true',
+                    help='report how long each part of the startup took, up '
+                         'to the first block of audio')
+parser.add_argument('--simulate', metavar='FILE',
+                    help='play FILE through a simulated device instead of the '
+                         'sound card and report latency, overruns and '
+                         'glitches (see SimStream.py)')
+parser.add_argument('--capture', metavar='FILE',
+                    help='with --simulate, write the output played to FILE')
+parser.add_argument('--jitter', type=float, default=0.0,
+                    help='with --simulate, delay callbacks randomly by up to '
+                         'this many seconds')
+parser.add_argument('--stalls', type=float, default=0.0,
+                    help='with --simulate, the chance per block of a callback '
+                         'stalling for 10 ms')
+parser.add_argument('--contention', type=int, default=0, metavar='THREADS',
+                    help='with --simulate, busy threads contending for the GIL')
+parser.add_argument('--control', metavar='ADDRESS',
+                    help='accept setting changes and status requests on a Unix '
+                         'socket (a path) or localhost TCP ([localhost:]PORT); '
+                         'see ControlServer.py')
+parser.add_argument('--govern', action='store_true',
+                    help='when the callback takes too long (a throttled CPU), '
+                         'step down to cheaper processing: no noise filter, a '
+                         'cheaper mapping, one channel, passthrough; and back '
+                         'up when it is fast again (see Governor.py)')
+parser.add_argument('--govern-down', type=float, default=0.7, metavar='LOAD',
+                    help='with --govern, the load (callback time over the '
+                         'block time) that steps down (default: %(default)s)')
+parser.add_argument('--govern-up', type=float, default=0.4, metavar='LOAD',
+                    help='with --govern, the load below which it steps back '
+                         'up (default: %(default)s)')
 args = parser.parse_args(remaining)
+if args.govern and not 0 < args.govern_up < args.govern_down:
+    parser.error('need 0 < --govern-up < --govern-down')
+startup.mark('arguments')
+
+import numpy  # Make sure NumPy is loaded before it is used in the callback
+import OlaFFT
+import NoiseFilter
+import Monitor
+import FilterChain
+import SpectrumTap
+import TableCache
+startup.mark('numpy and modules')
+if not args.no_cache:
+    TableCache.enable(args.cache)
 
-first = True
-parser.parse_args()  # needed to prevent blocksize from being 'none' in overlap computation
+first = True  # until the first block has been filtered
 blocksize = args.blocksize
 samplerate = args.samplerate
 
-freqdata = numpy.zeros([blocksize, 2])
+olaFFT = OlaFFT.olafft(blocksize, ring=True, backend=args.fft,
+                       hop=args.hop, frame=args.frame,
+                       dtype=args.dtype, layout=args.layout) # define class
+# a mono layout needs one input channel, whatever the output has
+channels = (1, args.channels) if args.layout == 'mono' else args.channels
+n_fft = len(olaFFT.freqdata) - 1  # half the frame
+print('algorithmic latency: %d samples (%.1f ms)' % (olaFFT.latency_samples,
+      1000 * olaFFT.latency_samples / samplerate))
+# plan the transforms now rather than in the first callback (the block of 
+# silence this puts in the overlap is harmless)
+olaFFT.process(numpy.zeros([blocksize, 2], dtype=olaFFT.dtype))
+if args.govern and args.layout == 'stereo':
+    # and the one channel transforms of the governor's mirror tier
+    olaFFT.mirror = True
+    olaFFT.process(numpy.zeros([blocksize, 2], dtype=olaFFT.dtype))
+    olaFFT.mirror = False
+olaFFT.backend.saveplans()  # FFTW's wisdom, in the cache
+startup.mark('olafft and FFT plans')
+noiseFilter = NoiseFilter.NoiseFilter(n_fft, samplerate, lower=30, upper=4500,
+                                      hop=args.hop, dtype=olaFFT.real)
+suppressor = None  # made the first time the wiener noise type is chosen
+
+eq = None
+if args.eq:
+    import Convolver
+    eq = Convolver.Convolver(Convolver.load(args.eq), blocksize,
+                             channels=args.channels, backend=args.fft,
+                             dtype=args.dtype)
+    print('EQ: %d taps in %d partitions' % (eq.partitions * blocksize,
+          eq.partitions))
+
+monitor = Monitor.NullMonitor()
+if args.monitor:
+    # with --hop the stages run once per hop, so only whole blocks are timed
+    stages = ["rfft", "dc", "noise", "mapping", "irfft", "eq"]
+    if args.hop:
+        stages = ["process", "eq"]
+    monitor = Monitor.Monitor(stages,
+        blocksize, samplerate, interval=args.monitor_interval,
+        file=None if args.monitor == '-' else open(args.monitor, 'a'))
+
+tap = SpectrumTap.NullTap()
+if args.tap:
+    tap = SpectrumTap.Tap(len(olaFFT.freqdata), olaFFT.columns, int(samplerate),
+                          args.tap_every, args.tap)
+    print('spectrum tap: view with  python SpectrumTap.py', tap.name)
+
+# channel 0 (or the mono or mid channel) is filtered; the chain can be
+# replaced while running, from the keyboard or the control server
+def makeChain(settings):
+    global suppressor
+    if settings['noisetype'] == 'wiener' and suppressor is None:
+        import NoiseSuppressor
+        suppressor = NoiseSuppressor.NoiseSuppressor(n_fft, samplerate,
+                                                     hop=args.hop,
+                                                     dtype=olaFFT.real)
+    return FilterChain.build(olaFFT.freqdata, n_fft, samplerate,
+        settings['mode'], settings['noise'], channel=0,
+        noiseFilter=noiseFilter, lower=settings['lower'],
+        upper=settings['upper'], maxbirdfreq=settings['maxbirdfreq'],
+        divisor=settings['divisor'], start=args.start, hop=args.hop,
+        dtype=olaFFT.real, alpha=settings['alpha'],
+        noisetype=settings['noisetype'], suppressor=suppressor)
+
+settings = dict(mode=args.mode, noise=not args.no_noise, divisor=args.divisor,
+                lower=30.0, upper=4500.0,
+                maxbirdfreq=min(12000.0, samplerate / 2),
+                alpha=noiseFilter.alpha, noisetype=args.noise_type)
+chain = FilterChain.Slot(makeChain(settings), monitor)
+startup.mark('filter tables')
+
+import threading
+changing = threading.Lock()  # the keyboard and the control server
+
+
+def update(changes, check=None):
+    # off the audio thread: make the chain for the new settings (the
+    # slow part) and hand it to the callback for its next block
+    with changing:
+        new = dict(settings, **changes)
+        if check is not None:
+            check(new)
+        if governor is not None:
+            governor.rebuild(new)  # the chains of all its tiers
+        else:
+            chain.swap(makeChain(new))
+        settings.update(new)
+        return dict(settings)
 
-olaFFT = OlaFFT.olafft(blocksize) # define class
-filter = Filters.Filters(blocksize, samplerate, lower=30, upper=4500)
-noiseFilter = NoiseFilter.NoiseFilter(blocksize, samplerate, lower=30, upper=4500)
 
+def started():
+    # once, from the first callback
+    global first
+    first = False
+    startup.mark('first block')
 
 
 def callback(indata, outdata, frames, time, status):
     
     # debugpy.debug_this_thread() # needed only for debugging in threads
-    global freqdata
+    monitor.start(status)
     freqData = olaFFT.rfft(indata)
-    freqData[0] = 0
-    noiseFilter.averageNoise(freqData[ : , 0]) # channel 0
-    filter.fold(freqData[ : , 0]) # channel 0 
-    outdata[:] = olaFFT.irfft(freqData)    
+    monitor.mark(0)
+    tap.pre(freqData)
+    chain.run() # filters olaFFT.freqdata in place
+    tap.post(freqData)
+    olaFFT.irfft(freqData, out=outdata)
+    monitor.mark(4)
+    if eq is not None:
+        eq.process(outdata, out=outdata)
+        monitor.mark(5)
+    monitor.stop(frames)
+    if first:
+        started()
+
+
+def tapped():
+    # the hop mode stage, with the tap on each side of the chain
+    tap.pre(olaFFT.freqdata)
+    chain.run()
+    tap.post(olaFFT.freqdata)
+
+
+def hopCallback(indata, outdata, frames, time, status):
+    monitor.start(status)
+    olaFFT.process(indata, tapped, outdata)
+    monitor.mark(0)
+    if eq is not None:
+        eq.process(outdata, out=outdata)
+        monitor.mark(1)
+    monitor.stop(frames)
+    if first:
+        started()
+
+if args.hop:
+    callback = hopCallback
+
+governor = None
+if args.govern:
+    import Governor
+    # times the processing and passes the input through when it must
+    governor = Governor.Governor(chain, olaFFT, makeChain, settings,
+        blocksize, samplerate, channels=channels if isinstance(channels, tuple)
+        else (channels, channels), dtype=args.dtype, down=args.govern_down,
+        up=args.govern_up)
+    callback = governor.wrap(callback)
+
+load = None
+if governor is not None:
+    load = governor.load
+elif args.control:
+    load = Monitor.Load(blocksize, samplerate)
+    callback = load.wrap(callback)
+
+worker = None
+if args.worker:
+    import Worker
+    # the stream's callback only moves blocks; the monitor times the worker
+    process = callback
+    worker = Worker.Worker(lambda indata, out: process(indata, out, blocksize,
+                           None, None), blocksize, channels, args.dtype,
+                           safety=args.worker, delay=olaFFT.latency_samples)
+    callback = worker.callback
+    worker.start()
+    print('worker: %d safety blocks, latency %.1f ms more' % (args.worker,
+          1000 * args.worker * blocksize / samplerate))
+
+def commands():
+    # switch the chain from the keyboard until Return alone
+    print('#' * 80)
+    print('type fold, linear, nonlinear, divide2, divide3, divide4, none, '
+          'noise, nonoise, average or wiener and Return to switch; Return '
+          'alone to quit')
+    print('#' * 80)
+    monitor.run()
+    while True:
+        command = input().strip().lower()
+        if not command:
+            break
+        if command in ('fold', 'linear', 'nonlinear', 'none'):
+            changes = dict(mode=command)
+        elif command in ('divide2', 'divide3', 'divide4'):
+            changes = dict(mode='divide', divisor=int(command[-1]))
+        elif command in ('noise', 'nonoise'):
+            changes = dict(noise=command == 'noise')
+        elif command in ('average', 'wiener'):
+            changes = dict(noise=True, noisetype=command)
+        else:
+            print('unknown command:', command)
+            continue
+        update(changes)  # built here, not in callback
+        print('now:', chain.chain.name)
+
+
+def status():
+    # for the control server
+    return dict(settings=dict(settings), chain=chain.chain.name,
+                swaps=chain.swaps, blocksize=blocksize, samplerate=samplerate,
+                latency_ms=1000 * olaFFT.latency_samples / samplerate,
+                governor=governor.status() if governor is not None else None,
+                **load.status())
+
+
+def serve():
+    # the control server, if asked for; returns it (or None) to close
+    if not args.control:
+        return None
+    import ControlServer
+    server = ControlServer.Server(args.control, lambda changes: update(
+        changes, lambda new: ControlServer.check(new, samplerate)), status)
+    server.start()
+    print('control server on', args.control)
+    return server
+
+
+if args.simulate:
+    # no sound card: a SimStream plays the file at the device's pace
+    import functools
+    import SimStream
+    Stream = functools.partial(SimStream.Stream, source=args.simulate,
+                               jitter=args.jitter, stalls=args.stalls,
+                               threads=args.contention)
+else:
+    import sounddevice as sd
+    Stream = sd.Stream
+startup.mark('audio device')
 
 try:
-    with sd.Stream(device=(args.input_device, args.output_device),
-                   samplerate=args.samplerate, blocksize=args.blocksize,
-                   dtype=args.dtype, latency=args.latency,
-                   channels=args.channels, callback=callback):
-        print('#' * 80)
-        print('press Return to quit')
-        print('#' * 80)
-        input()
+    with Stream(device=(args.input_device, args.output_device),
+                samplerate=args.samplerate, blocksize=args.blocksize,
+                dtype=args.dtype, latency=args.latency,
+                channels=channels, callback=callback) as stream:
+        startup.mark('stream open')
+        server = serve()
+        if governor is not None:
+            governor.run()
+        if args.startup:
+            startup.wait('first block')
+            startup.report(note='tables: %d from the cache, %d made' % (
+                TableCache.hits, TableCache.misses))
+        if args.simulate:
+            monitor.run()
+            stream.wait()
+            print('simulated:', stream.report())
+            print(SimStream.analyse(stream, olaFFT.latency_samples
+                                    + (args.worker or 0) * blocksize))
+            if args.capture:
+                stream.save(args.capture)
+        else:
+            commands()
+        if server is not None:
+            server.close()
+    monitor.close()
+    if governor is not None:
+        governor.close()
+    if worker is not None:
+        worker.close()
+        print('worker:', worker.report())
+    tap.close()
 except KeyboardInterrupt:
+    monitor.close()
+    if governor is not None:
+        governor.close()
+    if worker is not None:
+        worker.close()
+        print('worker:', worker.report())
+    tap.close()
     parser.exit('')
 except Exception as e:
     parser.exit(type(e).__name__ + ': ' + str(e))
\ No newline at end of file
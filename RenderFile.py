@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""Filter an audio file offline, without an audio device.
+
+The input (anything soundfile reads, e.g. WAV or FLAC) is read in chunks 
+of many blocks. Each chunk goes through OlaFFT.olabatch, which windows 
+and transforms all of its blocks at once, applies the filters and 
+overlap-adds the result. The output is sample-identical to feeding the 
+same blocks one at a time through olafft and the same filters (--check 
+verifies this), just many times faster than real time. 
+
+The output lines up with the input: the overlap-add's delay 
+(latency_samples) is taken off the front and zeros are fed in after the 
+end until the tail is out, as olafft.process_stream(align=True) does, 
+so the output has the same length, sampling rate and number of 
+channels as the input. 
+"""
+import argparse
+import time
+
+import numpy
+import soundfile as sf
+
+import OlaFFT
+import Filters
+import NoiseFilter
+import NoiseSuppressor
+
+# the choices of addoptions, also checked by SweepRender
+MODES = ['fold', 'linear', 'nonlinear', 'divide', 'none']
+DIVISORS = [2, 3, 4]
+NOISETYPES = ['average', 'wiener']
+
+
+def makechain(blocksize, samplerate, channels, mode="fold", noise=False,
+              lower=30, upper=4500, maxbirdfreq=12000, divisor=2, start=3000,
+              filters=None, noisetype="average"):
+    """
+    Returns a stage for olabatch.process: it gets an (nbins, nblocks, 
+    channels) array and does what PySongFinder's callback does to each 
+    block (DC removal, noise filter, mapping), on every channel; 
+    noisetype 'wiener' uses a NoiseSuppressor for the noise. filters 
+    is a Filters with the same settings to reuse (its tables are the 
+    costly part); the noise filter and divider keep per stream state so 
+    are always new. chain.state() returns that state as a dict of arrays 
+    and chain.restore(state) puts it back. 
+    """
+    mapping = None
+    divider = None
+    if mode == "divide":
+        divider = Filters.Divider(blocksize, samplerate, divisor, start, 
+            maxbirdfreq)
+        mapping = divider.divideBlocks
+    elif mode != "none":
+        if filters is None:
+            filters = Filters.Filters(blocksize, samplerate, 
+                lower=lower, upper=upper, maxbirdfreq=maxbirdfreq)
+        mapping = getattr(filters, mode)
+    noiseFilter = None
+    denoise = None
+    if noise and noisetype == "wiener":
+        noiseFilter = NoiseSuppressor.NoiseSuppressor(blocksize, samplerate, 
+            lower=lower, upper=upper, maxbirdfreq=maxbirdfreq, 
+            channels=channels)
+        denoise = noiseFilter.suppress
+    elif noise:
+        noiseFilter = NoiseFilter.NoiseFilter(blocksize, samplerate, 
+            lower=lower, upper=upper, maxbirdfreq=maxbirdfreq, 
+            channels=channels)
+        denoise = noiseFilter.averageNoise
+
+    def chain(freqdata):
+        freqdata[0] = 0
+        if denoise is not None:
+            for i in range(freqdata.shape[1]):  # noise state is per block
+                denoise(freqdata[:, i])
+        if mapping is not None:
+            mapping(freqdata)
+
+    parts = [(name, part) for name, part in (("noise", noiseFilter), 
+        ("divider", divider)) if part is not None]
+
+    def state():
+        return {name + "." + key: value for name, part in parts 
+                for key, value in part.state().items()}
+
+    def restore(state):
+        for name, part in parts:
+            part.restore({key[len(name) + 1:]: value 
+                for key, value in state.items() if key.startswith(name + ".")})
+
+    chain.state = state
+    chain.restore = restore
+    return chain
+
+
+def render(infile, outfile, blocksize=1024, chunk=256, mode="fold", 
+           noise=False, lower=30, upper=4500, maxbirdfreq=12000, 
+           masktype="hanning", subtype=None, divisor=2, start=3000, 
+           ola=None, filters=None, noisetype="average"):
+    """
+    Filters infile into outfile and returns (seconds of audio, seconds 
+    taken). chunk is the number of blocks processed at a time. ola (an 
+    olabatch, reset here) and filters may be passed in to be reused. 
+    """
+    began = time.perf_counter()
+    with sf.SoundFile(infile) as f:
+        if ola is None:
+            ola = OlaFFT.olabatch(blocksize, masktype)
+        ola.reset()
+        chain = makechain(blocksize, f.samplerate, f.channels, mode, noise, 
+            lower, upper, maxbirdfreq, divisor, start, filters, noisetype)
+        frames = f.frames
+        with sf.SoundFile(outfile, 'w', samplerate=f.samplerate, 
+                          channels=f.channels, subtype=subtype) as out:
+            for result in ola.process_stream(f.blocks(blocksize * chunk, 
+                    always_2d=True), chain):
+                out.write(result)
+        return frames / f.samplerate, time.perf_counter() - began
+
+
+def check(infile, blocksize=1024, blocks=200, **options):
+    """
+    Runs the first blocks of infile through olabatch and, block by 
+    block, through olafft and returns the largest difference. 
+    """
+    data, samplerate = sf.read(infile, frames=blocksize * blocks, 
+        always_2d=True)
+    data = data[:len(data) // blocksize * blocksize]
+    channels = data.shape[1]
+
+    batch = OlaFFT.olabatch(blocksize).process(data, 
+        makechain(blocksize, samplerate, channels, **options))
+
+    ola = OlaFFT.olafft(blocksize, ring=True)
+    chain = makechain(blocksize, samplerate, 2, **options)
+    stream = numpy.zeros([len(data), 2])
+    for i in range(0, len(data), blocksize):
+        freqdata = ola.rfft(data[i:i + blocksize])  # mono goes to both
+        chain(freqdata[:, numpy.newaxis])
+        ola.irfft(freqdata, out=stream[i:i + blocksize])
+    return abs(batch - stream[:, :channels]).max()
+
+
+def addoptions(parser):
+    # the filter settings, shared with BatchRender
+    parser.add_argument(
+        '-b', '--blocksize', type=int, default=1024,
+        help='block size (default: %(default)s)')
+    parser.add_argument(
+        '-m', '--mode', default='fold',
+        choices=MODES,
+        help='frequency mapping (default: %(default)s)')
+    parser.add_argument('--divisor', type=int, default=2, choices=DIVISORS,
+        help='divisor for --mode divide (default: %(default)s)')
+    parser.add_argument('--start', type=float, default=3000,
+        help='lowest frequency divided, Hz (default: %(default)s)')
+    parser.add_argument(
+        '-n', '--noise', action='store_true', help='apply the noise filter')
+    parser.add_argument('--noise-type', default='average', 
+        choices=NOISETYPES,
+        help='with -n: NoiseFilter averaging or the NoiseSuppressor '
+             '(default: %(default)s)')
+    parser.add_argument('--lower', type=float, default=30)
+    parser.add_argument('--upper', type=float, default=4500)
+    parser.add_argument('--maxbirdfreq', type=float, default=12000)
+    parser.add_argument('--subtype', help='output subtype, e.g. PCM_24')
+
+
+def settings(args):
+    # the makechain keyword arguments from parsed addoptions
+    return dict(mode=args.mode, noise=args.noise, lower=args.lower, 
+        upper=args.upper, maxbirdfreq=args.maxbirdfreq, divisor=args.divisor, 
+        start=args.start, noisetype=args.noise_type)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'infile', metavar='INFILE', help='audio file to be filtered')
+    parser.add_argument(
+        'outfile', metavar='OUTFILE', help='filtered audio file to write')
+    addoptions(parser)
+    parser.add_argument(
+        '--chunk', type=int, default=256,
+        help='blocks processed at a time (default: %(default)s)')
+    parser.add_argument(
+        '--check', action='store_true',
+        help='also compare the start of the file against block-by-block '
+             'processing')
+    args = parser.parse_args()
+    if args.chunk < 1:
+        parser.error('chunk must be at least 1')
+
+    options = settings(args)
+    if args.check:
+        print("largest difference from streaming:", 
+            check(args.infile, args.blocksize, **options))
+    duration, elapsed = render(args.infile, args.outfile, args.blocksize, 
+        args.chunk, subtype=args.subtype, **options)
+    print("%.1f s of audio in %.2f s (%.0fx real time)" 
+        % (duration, elapsed, duration / elapsed))
+
+
+if __name__ == "__main__":
+    main()
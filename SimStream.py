@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+"""A stand-in for sd.Stream that needs no audio device.
+
+Stream takes the same arguments as sounddevice.Stream (device and
+latency are accepted and ignored) plus a source: an array of samples, a
+file name (anything soundfile reads) or an iterable of blocks. Its
+thread calls callback(indata, outdata, frames, time, status) at the
+device's cadence: block k has been "recorded" at start + (k + 1) *
+period, the callback is called then with it, and its output is "played"
+if the callback returns within buffers periods of that (its deadline).
+At the end of the source, tail seconds of silence are fed so that
+delayed output comes out too, and then the stream stops by itself.
+
+The device is imitated where it matters for real time:
+    a callback that returns after its deadline is an output underflow:
+        its block is captured as silence (a dropout) and the next
+        callback gets status.output_underflow
+    a callback called so late that the device's input buffers (buffers
+        blocks) have overflowed loses the oldest blocks: they are never
+        given to the callback, their output is silence and the next
+        callback gets status.input_overflow
+    jitter (seconds) delays each callback by a random amount up to it,
+        as the scheduler does, and eats into its time
+    stalls (a probability per block) adds stall seconds to a callback,
+        as a preemption or a page fault would
+    threads busy Python threads contend for the GIL and processes busy
+        processes for the CPUs while the stream runs
+    speed runs the clock faster (or slower) than real time
+
+The input fed and the output played are kept (input, output) for
+analysis: latency() cross-correlates them to find the delay through the
+pipeline and glitches() compares them block by block, after aligning
+them, to find blocks that went missing or wrong. report() sums up the
+callbacks: their times against the budget, overruns and lost blocks.
+
+Run this file to try a pipeline against it: a plain copy (wire), olafft
+in ring mode (ola) or in hop mode (hop), on a file or on noise.
+PySongFinder and wireFFT take --simulate FILE to run on a Stream
+instead of the sound card.
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+
+import numpy
+
+
+class CallbackFlags(object):
+    """The status given to the callback, like sounddevice.CallbackFlags."""
+    def __init__(self):
+        self.input_underflow = False
+        self.input_overflow = False
+        self.output_underflow = False
+        self.output_overflow = False
+        self.priming_output = False
+
+    def __bool__(self):
+        return any(vars(self).values())
+
+    def __str__(self):
+        return ", ".join(name.replace("_", " ")
+            for name, value in vars(self).items() if value)
+
+
+class Time(object):
+    # the callback's time argument, in seconds of the stream's clock
+    def __init__(self, currentTime, inputBufferAdcTime, outputBufferDacTime):
+        self.currentTime = currentTime
+        self.inputBufferAdcTime = inputBufferAdcTime
+        self.outputBufferDacTime = outputBufferDacTime
+
+
+class CallbackStop(Exception):
+    pass
+
+
+class CallbackAbort(Exception):
+    pass
+
+
+def busy(stop):
+    # contention: spin until stop is set
+    while not stop.is_set():
+        for _ in range(10000):
+            pass
+
+
+def readsource(source, samplerate, channels, dtype):
+    # an iterable of arrays from a file name, an array or blocks
+    if isinstance(source, str):
+        import soundfile as sf
+        data, rate = sf.read(source, dtype=dtype, always_2d=True)
+        if rate != samplerate:
+            print("SimStream: %s is at %d Hz, played at %d Hz" % (source,
+                rate, samplerate))
+        source = data
+    if isinstance(source, numpy.ndarray):
+        return [source]
+    return source
+
+
+class Stream(object):
+    def __init__(self, samplerate=44100, blocksize=1024, device=None,
+                 channels=2, dtype="float32", latency=None, callback=None,
+                 finished_callback=None, source=None, buffers=2, jitter=0.0,
+                 stalls=0.0, stall=0.01, threads=0, processes=0, speed=1.0,
+                 tail=1.0, seed=None):
+        if not blocksize:
+            raise ValueError("Stream needs a fixed blocksize")
+        self.samplerate = float(samplerate or 44100)
+        self.blocksize = blocksize
+        self.channels = channels
+        self.inchannels, self.outchannels = (channels if isinstance(channels,
+            (tuple, list)) else (channels, channels))
+        self.dtype = numpy.dtype(dtype or "float32")
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.source = source
+        self.buffers = buffers
+        self.jitter = jitter
+        self.stalls = stalls
+        self.stall = stall
+        self.threads = threads
+        self.processes = processes
+        self.speed = speed
+        self.tail = tail
+        self.random = numpy.random.default_rng(seed)
+
+        self.period = blocksize / self.samplerate / speed
+        self.indata = numpy.zeros([blocksize, self.inchannels], self.dtype)
+        self.outdata = numpy.zeros([blocksize, self.outchannels], self.dtype)
+        self.fed = []  # every input block, delivered or not
+        self.played = []  # what the device played for each
+        self.durations = []  # seconds taken by each callback
+        self.overruns = 0
+        self.dropped = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.finished = threading.Event()
+        self.active = self.stopped = self.closed = False
+        self.stopped = True
+
+    # the sd.Stream interface
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.stopping.clear()
+        self.finished.clear()
+        # one event stops every contender, so with processes it is a
+        # multiprocessing one, shared with the threads
+        self.contention = (multiprocessing.Event() if self.processes
+            else threading.Event())
+        self.contenders = [threading.Thread(target=busy,
+            args=(self.contention,), daemon=True) for _ in range(self.threads)]
+        self.contenders += [multiprocessing.Process(target=busy,
+            args=(self.contention,), daemon=True)
+            for _ in range(self.processes)]
+        for contender in self.contenders:
+            contender.start()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.active, self.stopped = True, False
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    abort = stop
+
+    def close(self):
+        self.stop()
+        self.closed = True
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def wait(self, timeout=None):
+        # until the source and the tail have been played
+        return self.finished.wait(timeout)
+
+    # the device
+
+    def blocks(self):
+        # the input, block by block, then the tail of silence
+        n = self.blocksize
+        pending = numpy.zeros([n, self.inchannels], self.dtype)
+        filled = 0
+        for chunk in readsource(self.source, self.samplerate,
+                                self.inchannels, self.dtype):
+            chunk = numpy.asarray(chunk)
+            if chunk.ndim == 1:
+                chunk = chunk[:, numpy.newaxis]
+            # mono goes to every channel, extra channels are left out
+            chunk = chunk[:, :self.inchannels]
+            i = 0
+            while i < len(chunk):
+                take = min(n - filled, len(chunk) - i)
+                pending[filled:filled + take] = chunk[i:i + take]
+                filled += take
+                i += take
+                if filled == n:
+                    yield pending
+                    filled = 0
+        if filled:
+            pending[filled:] = 0
+            yield pending
+        pending.fill(0)
+        for _ in range(int(numpy.ceil(self.tail * self.samplerate / n))):
+            yield pending
+
+    def run(self):
+        period = self.period
+        status = CallbackFlags()
+        silence = numpy.zeros_like(self.outdata)
+        began = time.perf_counter()
+        try:
+            for k, block in enumerate(self.blocks()):
+                if self.stopping.is_set():
+                    break
+                self.fed.append(block.copy())
+                ready = began + (k + 1) * period  # block k is recorded
+                # woken up to jitter late, unless already behind
+                wake = ready + (self.random.uniform(0, self.jitter)
+                    if self.jitter else 0)
+                now = time.perf_counter()
+                if now < wake:
+                    time.sleep(wake - now)
+                start = time.perf_counter()
+                if start > ready + self.buffers * period:
+                    # the device has recorded over this block
+                    self.played.append(silence.copy())
+                    self.dropped += 1
+                    status.input_overflow = True
+                    continue
+
+                self.indata[:] = block
+                try:
+                    self.callback(self.indata, self.outdata, self.blocksize,
+                        Time(start - began, ready - period - began,
+                             ready + self.buffers * period - began), status)
+                finally:
+                    if self.stalls and self.random.random() < self.stalls:
+                        time.sleep(self.stall)
+                    end = time.perf_counter()
+                    self.durations.append(end - start)
+                status = CallbackFlags()
+                if end > ready + self.buffers * period:  # too late to play
+                    self.played.append(silence.copy())
+                    self.overruns += 1
+                    status.output_underflow = True
+                else:
+                    self.played.append(self.outdata.copy())
+        except (CallbackStop, CallbackAbort):
+            pass
+        finally:
+            self.contention.set()
+            for contender in self.contenders:
+                contender.join()
+            self.active, self.stopped = False, True
+            self.finished.set()
+            if self.finished_callback is not None:
+                self.finished_callback()
+
+    # results
+
+    @property
+    def input(self):
+        if not self.fed:
+            return numpy.zeros([0, self.inchannels], self.dtype)
+        return numpy.concatenate(self.fed)
+
+    @property
+    def output(self):
+        if not self.played:
+            return numpy.zeros([0, self.outchannels], self.dtype)
+        return numpy.concatenate(self.played)
+
+    def save(self, filename):
+        # the output played, as an audio file
+        import soundfile as sf
+        sf.write(filename, self.output, int(self.samplerate))
+
+    def report(self):
+        durations = numpy.array(self.durations or [0.0])
+        budget = self.blocksize / self.samplerate
+        return ("%d blocks of %d samples (budget %.2f ms at %gx): callbacks "
+                "mean %.3f ms, 99%% %.3f ms, max %.3f ms; %d overruns played "
+                "as silence, %d blocks lost to input overflow" % (
+                len(self.fed), self.blocksize, budget * 1e3, self.speed,
+                durations.mean() * 1e3, numpy.percentile(durations, 99) * 1e3,
+                durations.max() * 1e3, self.overruns, self.dropped))
+
+
+def mix(x):
+    # one zero mean float64 channel
+    x = numpy.asarray(x, dtype=numpy.float64)
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    return x - x.mean()
+
+
+def latency(x, y, maxlag=None):
+    """
+    The delay of y (output) behind x (input) in samples, found from the
+    peak of their cross-correlation (by FFT), and the peak's height
+    normalised to 1 for a delayed copy. maxlag limits the search.
+    """
+    x, y = mix(x), mix(y)
+    n = len(x) + len(y)
+    size = 1 << (n - 1).bit_length()
+    correlation = numpy.fft.irfft(numpy.fft.rfft(y, size)
+        * numpy.conj(numpy.fft.rfft(x, size)), size)
+    lags = correlation[:maxlag or len(y)]  # y behind x
+    lag = int(numpy.argmax(numpy.abs(lags)))
+    norm = numpy.sqrt((x ** 2).sum() * (y ** 2).sum()) or 1.0
+    return lag, lags[lag] / norm
+
+
+def glitches(x, y, lag, blocksize, threshold=0.5):
+    """
+    Compares each block of y (as the device played them) with the input 
+    lag samples before it and returns (block, correlation) for each 
+    block whose correlation with the input is below threshold times the 
+    median (a dropout, a skip or a click), ignoring blocks where the 
+    input is silent. 
+    """
+    x, y = mix(x), mix(y)
+    delayed = numpy.zeros(len(y))
+    n = max(min(len(x), len(y) - lag), 0)
+    delayed[lag:lag + n] = x[:n]
+    length = len(y) // blocksize * blocksize
+    if length == 0:
+        return []
+    a = delayed[:length].reshape(-1, blocksize)
+    b = y[:length].reshape(-1, blocksize)
+    power = (a ** 2).sum(axis=1)
+    energy = numpy.sqrt(power * (b ** 2).sum(axis=1))
+    correlation = (a * b).sum(axis=1) / numpy.maximum(energy, 1e-30)
+    sounding = power > 1e-6 * power.max()
+    typical = numpy.median(correlation[sounding]) if sounding.any() else 0
+    bad = numpy.flatnonzero(sounding & (correlation < threshold * typical))
+    return [(int(k), float(correlation[k])) for k in bad]
+
+
+def analyse(stream, expected=None):
+    """
+    The latency and glitches of a stream that has finished, as text. 
+    expected is the pipeline's own latency in samples, if known. 
+    """
+    x, y = stream.input, stream.output
+    lag, peak = latency(x, y, maxlag=stream.blocksize * 16)
+    lines = ["latency %d samples (%.1f ms%s), correlation %.3f" % (lag,
+        lag / stream.samplerate * 1e3, "" if expected is None else
+        "; expected %d" % expected, peak)]
+    bad = glitches(x, y, lag, stream.blocksize)
+    lines.append("%d glitched blocks%s" % (len(bad), (": " + ", ".join(
+        "%d" % k for k, c in bad[:20]) + (" ..." if len(bad) > 20 else ""))
+        if bad else ""))
+    return "\n".join(lines)
+
+
+def pipeline(name, blocksize, dtype):
+    # a callback for main(): a copy, or olafft in ring or hop mode
+    if name == "wire":
+        def callback(indata, outdata, frames, time, status):
+            outdata[:] = indata
+        return callback, 0
+    import OlaFFT
+    if name == "ola":
+        ola = OlaFFT.olafft(blocksize, ring=True, dtype=dtype)
+
+        def callback(indata, outdata, frames, time, status):
+            ola.irfft(ola.rfft(indata), out=outdata)
+        return callback, ola.latency_samples
+    ola = OlaFFT.olafft(blocksize, hop=blocksize // 2, frame=blocksize * 2,
+        dtype=dtype)
+
+    def callback(indata, outdata, frames, time, status):
+        ola.process(indata, out=outdata)
+    return callback, ola.latency_samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('infile', nargs='?',
+        help='audio file to feed (default: noise)')
+    parser.add_argument('--pipeline', default='hop',
+        choices=['wire', 'ola', 'hop'],
+        help='what the callback does (default: %(default)s); ola is not a '
+             'pure delay (see OlaFFT), so it correlates poorly with the '
+             'input even without glitches')
+    parser.add_argument('--seconds', type=float, default=5,
+        help='seconds of noise without a file (default: %(default)s)')
+    parser.add_argument('--samplerate', type=float, default=44100)
+    parser.add_argument('--blocksize', type=int, default=512)
+    parser.add_argument('--dtype', default='float32')
+    parser.add_argument('--buffers', type=int, default=2,
+        help='device buffers: a callback has this many periods '
+             '(default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+        help='random delay of each callback, up to this many seconds')
+    parser.add_argument('--stalls', type=float, default=0.0,
+        help='chance per block of a callback stalling')
+    parser.add_argument('--stall', type=float, default=0.05,
+        help='seconds a stall lasts (default: %(default)s)')
+    parser.add_argument('--threads', type=int, default=0,
+        help='busy threads contending for the GIL')
+    parser.add_argument('--processes', type=int, default=0,
+        help='busy processes contending for the CPUs')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='clock speed relative to real time (default: %(default)s)')
+    parser.add_argument('--capture', metavar='FILE',
+        help='write the output played to FILE')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    source = args.infile
+    if source is None:
+        random = numpy.random.default_rng(args.seed)
+        source = (random.standard_normal([int(args.seconds * args.samplerate),
+            2]) * 0.1).astype(args.dtype)
+    callback, expected = pipeline(args.pipeline, args.blocksize, args.dtype)
+    with Stream(args.samplerate, args.blocksize, channels=2, dtype=args.dtype,
+                callback=callback, source=source, buffers=args.buffers,
+                jitter=args.jitter, stalls=args.stalls, stall=args.stall,
+                threads=args.threads, processes=args.processes,
+                speed=args.speed, seed=args.seed) as stream:
+        stream.wait()
+    print(stream.report())
+    print(analyse(stream, expected))
+    if args.capture:
+        stream.save(args.capture)
+
+
+if __name__ == "__main__":
+    main()
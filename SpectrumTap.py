@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Watch the spectrum before and after filtering while PySongFinder runs.
+
+A Tap publishes the magnitude of olafft's freqdata, before (pre) and
+after (post) the filter chain, in a multiprocessing.shared_memory block
+that another process can read. The audio thread only calls pre() and
+post(): on one block in every 'decimation' they write numpy.abs of
+freqdata straight into the shared buffer, and otherwise they return at
+once. Nothing is allocated, copied, locked or waited for.
+
+The block holds a header of int64 values (sequence, bins, channels,
+decimation, samplerate) and two frames of (2, bins, channels) float32
+magnitudes. Frame s is written into buffer s % 2, the one not being
+shown, and the sequence is set to s when it is complete. A reader
+takes the sequence, copies the buffer it points to and reads the
+sequence again: if it has not changed, the copy is whole, otherwise it
+tries again (the writer may have started on that buffer). The writer
+never waits for a reader and any number of readers can watch.
+
+Run this file to view a tap: a matplotlib plot of both spectra in dB
+for each channel, or a line of text per frame with --text (or without
+matplotlib). --demo publishes a sweeping tone to try the viewer.
+NullTap has the same audio-thread methods and does nothing.
+"""
+import argparse
+import time
+
+import numpy
+
+SEQUENCE, BINS, CHANNELS, DECIMATION, SAMPLERATE = range(5)
+HEADER = 8 * 8  # bytes, with room to spare
+
+
+class NullTap(object):
+    name = None
+
+    def pre(self, freqdata):
+        pass
+
+    def post(self, freqdata):
+        pass
+
+    def close(self):
+        pass
+
+
+def layout(buffer, bins, channels):
+    # the header and the two frames, as arrays on buffer
+    header = numpy.ndarray(5, numpy.int64, buffer)
+    frames = numpy.ndarray((2, 2, bins, channels), numpy.float32, buffer,
+        HEADER)
+    return header, frames
+
+
+def size(bins, channels):
+    return HEADER + 2 * 2 * bins * channels * 4
+
+
+class Tap(object):
+    def __init__(self, bins, channels=2, samplerate=44100, decimation=4,
+                 name=None):
+        # imported here so that PySongFinder only pays for it with --tap
+        import multiprocessing.shared_memory
+        if name is not None:
+            try:  # left behind by a run that did not close it
+                old = multiprocessing.shared_memory.SharedMemory(name)
+                old.close()
+                old.unlink()
+            except FileNotFoundError:
+                pass
+        self.memory = multiprocessing.shared_memory.SharedMemory(name,
+            create=True, size=size(bins, channels))
+        self.name = self.memory.name
+        self.header, self.frames = layout(self.memory.buf, bins, channels)
+        self.header[:] = (0, bins, channels, decimation, samplerate)
+        self.decimation = decimation
+        self.sequence = 0
+        self.count = decimation - 1  # publish the first block
+        self.back = None  # the frame being written, if any
+
+    # audio thread
+
+    def pre(self, freqdata):
+        self.count += 1
+        if self.count < self.decimation:
+            self.back = None
+            return
+        self.count = 0
+        self.back = self.frames[(self.sequence + 1) % 2]
+        numpy.abs(freqdata, out=self.back[0])
+
+    def post(self, freqdata):
+        if self.back is None:
+            return
+        numpy.abs(freqdata, out=self.back[1])
+        self.sequence += 1
+        self.header[SEQUENCE] = self.sequence
+
+    def close(self):
+        del self.header, self.frames, self.back
+        self.memory.close()
+        self.memory.unlink()
+
+
+class Reader(object):
+    """Attaches to a Tap by name and copies out its latest frame."""
+    def __init__(self, name):
+        import multiprocessing.resource_tracker
+        import multiprocessing.shared_memory
+        # only the Tap's process may unlink the block
+        try:
+            self.memory = multiprocessing.shared_memory.SharedMemory(name,
+                track=False)
+        except TypeError:  # before Python 3.13
+            self.memory = multiprocessing.shared_memory.SharedMemory(name)
+            multiprocessing.resource_tracker.unregister(self.memory._name,
+                "shared_memory")
+        header = numpy.ndarray(5, numpy.int64, self.memory.buf)
+        self.bins = int(header[BINS])
+        self.channels = int(header[CHANNELS])
+        self.decimation = int(header[DECIMATION])
+        self.samplerate = int(header[SAMPLERATE])
+        del header
+        self.header, self.frames = layout(self.memory.buf, self.bins,
+            self.channels)
+        self.frequencies = (numpy.arange(self.bins) * self.samplerate
+            / (2 * (self.bins - 1)))
+        self.frame = numpy.zeros((2, self.bins, self.channels), numpy.float32)
+        self.sequence = 0
+
+    def read(self):
+        """
+        Returns the sequence number of a new frame, copied into
+        self.frame (pre, post), or None if there is none since the last.
+        """
+        for _ in range(10):
+            sequence = int(self.header[SEQUENCE])
+            if sequence == self.sequence or sequence == 0:
+                return None
+            self.frame[...] = self.frames[sequence % 2]
+            if int(self.header[SEQUENCE]) == sequence:
+                self.sequence = sequence
+                return sequence
+        return None  # the writer kept overtaking; try later
+
+    def close(self):
+        del self.header, self.frames
+        self.memory.close()
+
+
+def decibels(magnitude):
+    return 20 * numpy.log10(numpy.maximum(magnitude, 1e-9))
+
+
+def text(reader, interval):
+    while True:
+        sequence = reader.read()
+        if sequence is not None:
+            pre, post = reader.frame
+            line = "%8d" % sequence
+            for c in range(reader.channels):
+                line += "  ch%d peak %6.0f Hz %6.1f dB -> %6.0f Hz %6.1f dB" % (
+                    c, reader.frequencies[pre[:, c].argmax()],
+                    decibels(pre[:, c].max()),
+                    reader.frequencies[post[:, c].argmax()],
+                    decibels(post[:, c].max()))
+            print(line, flush=True)
+        time.sleep(interval)
+
+
+def plot(reader, interval):
+    import matplotlib.pyplot as plt
+    from matplotlib.animation import FuncAnimation
+    figure, axes = plt.subplots(reader.channels, 1, sharex=True,
+        squeeze=False)
+    lines = []
+    for c, axis in enumerate(axes[:, 0]):
+        lines.append([axis.plot(reader.frequencies,
+            numpy.zeros(reader.bins), label=label)[0]
+            for label in ("before", "after")])
+        axis.set_ylim(-120, 60)
+        axis.set_ylabel("channel %d, dB" % c)
+        axis.legend(loc="upper right")
+    axes[-1, 0].set_xlabel("Hz")
+
+    def update(_):
+        if reader.read() is not None:
+            for c in range(reader.channels):
+                for stage in range(2):
+                    lines[c][stage].set_ydata(
+                        decibels(reader.frame[stage, :, c]))
+        return [line for pair in lines for line in pair]
+
+    animation = FuncAnimation(figure, update, interval=interval * 1000,
+        blit=True, cache_frame_data=False)
+    plt.show()
+    return animation
+
+
+def demo(name, decimation):
+    # a tone sweeping 200 Hz - 10 kHz, 'filtered' by halving its frequency
+    n_fft = 1024
+    tap = Tap(n_fft + 1, 2, 44100, decimation, name)
+    print("publishing on", tap.name)
+    freqdata = numpy.zeros([n_fft + 1, 2], dtype=numpy.csingle)
+    block = 0
+    try:
+        while True:
+            k = int(10 + (block * 3) % 450)
+            freqdata[:] = 1e-3
+            freqdata[k] = 100
+            tap.pre(freqdata)
+            freqdata[k] = 1e-3
+            freqdata[k // 2] = 100
+            tap.post(freqdata)
+            block += 1
+            time.sleep(n_fft / 44100)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tap.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('name', nargs='?', default='songfinder-tap',
+        help='shared memory name of the tap (default: %(default)s)')
+    parser.add_argument('--text', action='store_true',
+        help='print a line per frame instead of plotting')
+    parser.add_argument('--interval', type=float, default=0.05,
+        help='seconds between reads (default: %(default)s)')
+    parser.add_argument('--demo', action='store_true',
+        help='publish a test signal on the tap instead of viewing it')
+    parser.add_argument('--every', type=int, default=4,
+        help='with --demo, publish every this many blocks '
+             '(default: %(default)s)')
+    args = parser.parse_args()
+    if args.demo:
+        demo(args.name, args.every)
+        return
+
+    reader = Reader(args.name)
+    try:
+        try:
+            import matplotlib
+            assert matplotlib
+        except ImportError:
+            args.text = True
+        if args.text:
+            text(reader, args.interval)
+        else:
+            plot(reader, args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Times the start of a program, from the process starting to the first
+block of audio, so that the startup can be checked on each release.
+
+Create a Startup first thing (before the heavy imports) and call
+mark(name) at the end of each phase; report() prints each phase's time
+and the running total. The first line is the interpreter's own start
+(up to the Startup being made), read from /proc where there is one.
+mark() only appends to a list, so it can be called once from the audio
+callback to time the first block, and wait(name) lets the main thread
+wait for that mark before reporting.
+"""
+import os
+import sys
+import time
+
+
+def processage():
+    # seconds since this process started, or None if unknown (not Linux)
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Startup(object):
+    def __init__(self):
+        self.began = time.perf_counter()
+        self.before = processage()
+        self.marks = []
+
+    def mark(self, name):
+        self.marks.append((name, time.perf_counter()))
+
+    def wait(self, name, timeout=5.0):
+        # for the main thread: until a mark called name exists
+        end = time.perf_counter() + timeout
+        while time.perf_counter() < end:
+            if any(mark == name for mark, when in self.marks):
+                return True
+            time.sleep(0.001)
+        return False
+
+    def report(self, file=None, note=None):
+        file = file or sys.stdout
+        lines = ["startup:"]
+        total = 0.0
+        if self.before is not None:
+            total = self.before
+            lines.append("  %-24s %8.1f ms" % ("python", total * 1e3))
+        last = self.began
+        for name, when in list(self.marks):
+            total += when - last
+            lines.append("  %-24s %8.1f ms  %8.1f ms total" % (name,
+                (when - last) * 1e3, total * 1e3))
+            last = when
+        if note:
+            lines.append("  " + note)
+        print("\n".join(lines), file=file, flush=True)
+
+
+def main():
+    startup = Startup()
+    import numpy
+    startup.mark("numpy")
+    numpy.fft.irfft(numpy.fft.rfft(numpy.zeros(2048)))
+    startup.mark("first transform")
+    startup.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""Render one recording with many filter settings at once.
+
+For tuning the filters: each variant is a set of RenderFile options
+that differ from the ones given on the command line, e.g.
+
+    SweepRender.py song.wav -o sweep -v mode=linear -v upper=6000,noise=1
+    SweepRender.py song.wav -o sweep --grid mode=fold,linear \\
+        --grid upper=4000,4500,5000
+
+(--grid makes every combination of its values, six variants here). The
+recording is read in chunks and each chunk is windowed and transformed
+once by OlaFFT.olabatch.processVariants; every variant filters its own
+copy of the spectra and the copies go through one batched irfft. So K
+variants cost one forward transform, K filterings and K inverse
+transforms instead of K whole renders, and each variant's output is
+sample-identical to rendering it on its own (--check verifies this)
+and lines up with the input, as RenderFile's output does.
+Variants with the same band limits share one Filters.
+
+The variants are written to OUTDIR as NAME.LABEL.EXT, the label made
+from the settings that differ (e.g. song.mode-linear.wav), or with
+--interleave FILE into one file with every variant's channels side by
+side (variant 0's channels first), for comparing them in an editor.
+"""
+import argparse
+import itertools
+import os
+import time
+
+import numpy
+import soundfile as sf
+
+import Filters
+import OlaFFT
+import RenderFile
+
+def oneof(convert, choices):
+    # a KEYS converter that only takes one of RenderFile's choices
+    def check(value):
+        value = convert(value)
+        if value not in choices:
+            raise ValueError("use one of %s" % ", ".join(map(str, choices)))
+        return value
+    return check
+
+
+KEYS = {"mode": oneof(str, RenderFile.MODES),
+        "noise": lambda v: v.lower() in ("1", "true", "yes"),
+        "lower": float, "upper": float, "maxbirdfreq": float,
+        "divisor": oneof(int, RenderFile.DIVISORS), "start": float,
+        "noisetype": oneof(str, RenderFile.NOISETYPES)}
+
+
+def parse(spec):
+    # 'key=value,key=value' into a dict of makechain options
+    options = {}
+    for item in spec.split(","):
+        key, _, value = item.partition("=")
+        key = key.strip()
+        if key not in KEYS or not value:
+            raise ValueError("bad setting %r: use key=value with key one "
+                             "of %s" % (item, ", ".join(KEYS)))
+        try:
+            options[key] = KEYS[key](value.strip())
+        except ValueError as e:
+            raise ValueError("bad setting %r: %s" % (item, e))
+    return options
+
+
+def variants(base, specs=(), grids=()):
+    """
+    The options of each variant: base updated with each of specs, then
+    with every combination of grids ('key=v1,v2,...'). Returns a list of
+    (label, options).
+    """
+    changes = [parse(spec) for spec in specs]
+    axes = []
+    for grid in grids:
+        key, _, values = grid.partition("=")
+        axes.append([parse("%s=%s" % (key, v)) for v in values.split(",")])
+    for combination in itertools.product(*axes):
+        change = {}
+        for part in combination:
+            change.update(part)
+        if change:
+            changes.append(change)
+    if not changes:
+        changes = [{}]
+    result = []
+    for change in changes:
+        options = dict(base, **change)
+        label = "_".join("%s-%s" % (key, value if not isinstance(value, float)
+            else "%g" % value) for key, value in sorted(change.items()))
+        result.append((label or "base", options))
+    return result
+
+
+def makechains(blocksize, samplerate, channels, variants):
+    # a makechain stage per variant, sharing Filters between variants
+    # with the same band limits
+    shared = {}
+    chains = []
+    for label, options in variants:
+        key = (options["lower"], options["upper"], options["maxbirdfreq"])
+        filters = None
+        if options["mode"] in ("fold", "linear", "nonlinear"):
+            if key not in shared:
+                shared[key] = Filters.Filters(blocksize, samplerate,
+                    lower=key[0], upper=key[1], maxbirdfreq=key[2])
+            filters = shared[key]
+        chains.append(RenderFile.makechain(blocksize, samplerate, channels,
+            filters=filters, **options))
+    return chains
+
+
+def sweep(infile, outdir, variants, blocksize=1024, chunk=64, masktype="hanning",
+          subtype=None, interleave=None):
+    """
+    Renders every variant of infile; returns (seconds of audio, seconds
+    taken, names of the files written).
+    """
+    began = time.perf_counter()
+    stem, extension = os.path.splitext(os.path.basename(infile))
+    with sf.SoundFile(infile) as f:
+        channels = f.channels
+        ola = OlaFFT.olabatch(blocksize, masktype)
+        chains = makechains(blocksize, f.samplerate, channels, variants)
+        if interleave:
+            names = [interleave]
+            outs = [sf.SoundFile(interleave, 'w', samplerate=f.samplerate,
+                channels=channels * len(variants), subtype=subtype)]
+        else:
+            names = [os.path.join(outdir, "%s.%s%s" % (stem, label,
+                extension)) for label, options in variants]
+            outs = [sf.SoundFile(name, 'w', samplerate=f.samplerate,
+                channels=channels, subtype=subtype, format=f.format)
+                for name in names]
+        # the overlap-add's delay is dropped from the front and zeros go
+        # in after the end until the tail is out
+        latency = ola.latency_samples
+        end = f.frames + latency
+        produced = 0
+        try:
+            while produced < end:
+                data = f.read(blocksize * chunk, always_2d=True)
+                size = min(blocksize * chunk,
+                    -(-(end - produced) // blocksize) * blocksize)
+                if len(data) < size:
+                    data = numpy.concatenate((data, numpy.zeros(
+                        [size - len(data), channels])))
+                result = ola.processVariants(data, chains)
+                first = max(latency - produced, 0)
+                last = min(end - produced, size)
+                produced += size
+                if first >= last:
+                    continue
+                result = result[:, first:last]
+                length = last - first
+                if interleave:
+                    # (variants, samples, channels) to samples x (variant, channel)
+                    outs[0].write(result.transpose(1, 0, 2).reshape(length, -1))
+                else:
+                    for out, block in zip(outs, result):
+                        out.write(block)
+        finally:
+            for out in outs:
+                out.close()
+        return f.frames / f.samplerate, time.perf_counter() - began, names
+
+
+def check(infile, variants, blocksize=1024, blocks=200):
+    """
+    Runs the first blocks of infile through processVariants and each
+    variant through olabatch.process on its own; returns the largest
+    difference.
+    """
+    data, samplerate = sf.read(infile, frames=blocksize * blocks,
+        always_2d=True)
+    data = data[:len(data) // blocksize * blocksize]
+    channels = data.shape[1]
+    together = OlaFFT.olabatch(blocksize).processVariants(data,
+        makechains(blocksize, samplerate, channels, variants))
+    largest = 0.0
+    for (label, options), result in zip(variants, together):
+        alone = OlaFFT.olabatch(blocksize).process(data,
+            RenderFile.makechain(blocksize, samplerate, channels, **options))
+        largest = max(largest, abs(alone - result).max())
+    return largest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'infile', metavar='INFILE', help='audio file to be filtered')
+    parser.add_argument('-o', '--outdir', default='.',
+        help='directory for the variants (default: the current one)')
+    parser.add_argument('--interleave', metavar='FILE',
+        help='write one file with the variants side by side instead')
+    RenderFile.addoptions(parser)
+    parser.add_argument('-v', '--variant', action='append', default=[],
+        metavar='KEY=VALUE,...',
+        help='a variant: settings that differ from the options above '
+             '(mode, noise, noisetype, lower, upper, maxbirdfreq, divisor, '
+             'start)')
+    parser.add_argument('--grid', action='append', default=[],
+        metavar='KEY=V1,V2,...',
+        help='values of one setting; every combination of the grids is '
+             'a variant')
+    parser.add_argument('--chunk', type=int, default=64,
+        help='blocks processed at a time; the spectra of every variant '
+             'are held for a chunk (default: %(default)s)')
+    parser.add_argument('--check', action='store_true',
+        help='also compare the start of the file against rendering each '
+             'variant on its own')
+    args = parser.parse_args()
+    if args.chunk < 1:
+        parser.error('chunk must be at least 1')
+    try:
+        todo = variants(RenderFile.settings(args), args.variant, args.grid)
+    except ValueError as e:
+        parser.error(str(e))
+    if not args.interleave:
+        os.makedirs(args.outdir, exist_ok=True)
+
+    if args.check:
+        print("largest difference from rendering alone:",
+            check(args.infile, todo, args.blocksize))
+    duration, elapsed, names = sweep(args.infile, args.outdir, todo,
+        args.blocksize, args.chunk, subtype=args.subtype,
+        interleave=args.interleave)
+    if args.interleave:
+        for i, (label, options) in enumerate(todo):
+            print("variant %d: %s" % (i, label))
+        print("written to", names[0])
+    else:
+        for name in names:
+            print(name)
+    print("%d variants of %.1f s of audio in %.2f s (%.0fx real time per "
+          "variant)" % (len(todo), duration, elapsed,
+          duration * len(todo) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
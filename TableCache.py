@@ -0,0 +1,143 @@
+"""
+An on-disk cache of the tables that are slow to make at startup: the
+compiled Filters BinMaps, FFTW wisdom (so FFTW_MEASURE plans are made
+at once) and the autotune choice of FFT backend.
+
+Each entry is an uncompressed .npz file named after its kind and a
+hash of its key (the configuration it was made for). load() memory-maps
+the arrays inside the .npz instead of reading them: numpy.load ignores
+mmap_mode for .npz files, but members stored without compression are
+plain .npy files at a known offset in the zip, so each is opened as a
+read-only numpy.memmap at that offset. Nothing is read until it is used
+and the pages are shared by every process using the same tables.
+
+The cache is off until enable() is called, so the library and the
+offline tools never write files of their own accord. PySongFinder
+enables it unless given --no-cache; wireFFT only when given --cache.
+Both take --cache DIR, and otherwise the cache is $SONGFINDER_CACHE or
+~/.cache/songfinder. A missing, unreadable or stale entry is just
+made again; save() writes to a temporary file and renames it so a
+reader never sees half a file.
+Delete the directory to clear the cache.
+"""
+import hashlib
+import os
+import tempfile
+import zipfile
+
+import numpy
+
+VERSION = 1  # part of every key: bump when a table's layout changes
+
+directory = None  # None: the cache is off
+hits = 0
+misses = 0
+
+
+def enable(path=None):
+    global directory
+    if path is None:
+        path = os.environ.get("SONGFINDER_CACHE") or os.path.join(
+            os.path.expanduser("~"), ".cache", "songfinder")
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        directory = None
+        return None
+    directory = path
+    return path
+
+
+def disable():
+    global directory
+    directory = None
+
+
+def filename(kind, key):
+    digest = hashlib.sha1(repr((VERSION, key)).encode()).hexdigest()[:16]
+    return os.path.join(directory, "%s-%s.npz" % (kind, digest))
+
+
+def memmaps(name):
+    # the members of an uncompressed .npz as read-only memmaps
+    arrays = {}
+    with zipfile.ZipFile(name) as archive, open(name, "rb") as f:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError("compressed member")
+            # the local header is 30 bytes, the name and an extra field
+            f.seek(info.header_offset + 26)
+            lengths = numpy.frombuffer(f.read(4), dtype="<u2")
+            f.seek(info.header_offset + 30 + int(lengths[0]) + int(lengths[1]))
+            if numpy.lib.format.read_magic(f) == (1, 0):
+                header = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                header = numpy.lib.format.read_array_header_2_0(f)
+            shape, fortran, dtype = header
+            if dtype.hasobject:
+                raise ValueError("object array")
+            member = info.filename[:-len(".npy")]
+            if not numpy.prod(shape):  # memmap cannot map nothing
+                arrays[member] = numpy.zeros(shape, dtype)
+            else:
+                arrays[member] = numpy.memmap(name, dtype, "r", f.tell(),
+                    shape, "F" if fortran else "C")
+    return arrays
+
+
+def load(kind, key):
+    """
+    Returns the arrays saved for (kind, key) as a dict of read-only
+    memmaps, or None if the cache is off or has no such entry.
+    """
+    global hits, misses
+    if directory is None:
+        return None
+    name = filename(kind, key)
+    try:
+        arrays = memmaps(name)
+    except (OSError, ValueError, zipfile.BadZipFile):
+        misses += 1
+        return None
+    hits += 1
+    return arrays
+
+
+def save(kind, key, **arrays):
+    if directory is None:
+        return
+    name = filename(kind, key)
+    temporary = None
+    try:
+        handle, temporary = tempfile.mkstemp(".npz", kind, directory)
+        with os.fdopen(handle, "wb") as f:
+            numpy.savez(f, **arrays)
+        os.replace(temporary, name)
+    except OSError:  # a cache that cannot be written only costs time
+        if temporary is not None and os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def main():
+    import time
+    enable(tempfile.mkdtemp())
+    table = numpy.arange(100000, dtype=numpy.int64)
+    weights = numpy.linspace(0, 1, 7, dtype=numpy.float32).reshape(7, 1)
+    start = time.perf_counter()
+    save("test", ("a", 1), table=table, weights=weights,
+        empty=numpy.zeros(0))
+    saved = time.perf_counter() - start
+    start = time.perf_counter()
+    arrays = load("test", ("a", 1))
+    loaded = time.perf_counter() - start
+    print("saved in %.2f ms, mapped in %.2f ms: %s" % (saved * 1e3,
+        loaded * 1e3, ", ".join("%s %s %s" % (name, type(a).__name__,
+        a.shape) for name, a in sorted(arrays.items()))))
+    print("same:", (arrays["table"] == table).all()
+        and (arrays["weights"] == weights).all())
+    print("other key:", load("test", ("a", 2)), "hits", hits, "misses",
+        misses)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,245 @@
+"""
+Runs the DSP away from the audio callback. The callback given to
+sd.Stream only copies indata into an input ring and copies a finished
+block from an output ring into outdata; a worker thread (Worker) or
+process (ProcessWorker) takes blocks from the input ring, runs
+process(indata, out) on them (olafft and the filter chain) and puts the
+results in the output ring.
+
+The output is safety blocks behind the input: at callback n the block
+played is the one for input block n - safety, so the worker has safety
+block periods to finish each block instead of less than one, and a
+garbage collection, a slow stage or the GIL held elsewhere no longer
+costs an underrun unless it lasts that long. Each block of safety adds
+a block of latency.
+
+If the worker has not finished a block in time the callback plays the
+input instead (delayed by delay samples, the chain's own latency, so
+that it lines up), which is heard as the unfiltered sound rather than
+silence, and counts an underrun. A worker that has fallen behind skips
+the blocks that have already been played and carries on with the one
+due next.
+
+Both rings have a single writer and a single reader and are used the
+same way as Monitor's: a slot is filled before the counter saying so
+is advanced, and the counters (received, done, due, skipped, stop) are
+an int64 array so that, for ProcessWorker, they can live in shared
+memory with the rings. ProcessWorker avoids the GIL altogether but
+builds its process in the child by calling factory(), so it cannot be
+changed from the parent while running.
+"""
+import multiprocessing
+import multiprocessing.shared_memory
+import threading
+import time
+
+import numpy
+
+RECEIVED, DONE, DUE, SKIPPED, STOP = range(5)
+
+
+class Worker(object):
+    def __init__(self, process, blocksize, channels=2, dtype="float32",
+                 safety=2, delay=0):
+        if safety < 1:
+            raise ValueError("safety must be at least one block")
+        self.process = process
+        self.blocksize = blocksize
+        # (input, output) channels, as for sd.Stream, or one number for both
+        self.channels = channels
+        self.inchannels, self.outchannels = (channels if isinstance(channels,
+            (tuple, list)) else (channels, channels))
+        self.dtype = numpy.dtype(dtype)
+        self.safety = safety
+        self.delay = delay
+        # the input ring also holds the blocks the passthrough may need
+        self.capacity = safety + 2 + -(-delay // blocksize)
+        self.underruns = 0
+        self.thread = None
+        self.wake = threading.Event()
+        self.allocate()
+
+    def allocate(self, buffer=None):
+        # counters, input ring and output ring, in buffer (zeroed) if given
+        inshape = (self.capacity, self.blocksize, self.inchannels)
+        outshape = (self.capacity, self.blocksize, self.outchannels)
+        insize = numpy.prod(inshape) * self.dtype.itemsize
+        outsize = numpy.prod(outshape) * self.dtype.itemsize
+        if buffer is None:
+            buffer = bytearray(8 * 8 + insize + outsize)
+        self.counters = numpy.ndarray(5, numpy.int64, buffer)
+        self.inring = numpy.ndarray(inshape, self.dtype, buffer, 8 * 8)
+        self.outring = numpy.ndarray(outshape, self.dtype, buffer,
+            8 * 8 + insize)
+        self.inflat = self.inring.reshape(-1, self.inchannels)
+        return 8 * 8 + insize + outsize
+
+    # audio thread
+
+    def callback(self, indata, outdata, frames, time, status):
+        n = int(self.counters[RECEIVED])
+        self.inring[n % self.capacity] = indata
+        self.counters[RECEIVED] = n + 1
+
+        k = n - self.safety  # the block due now
+        if k < 0:
+            outdata.fill(0)
+        elif self.counters[DONE] > k:
+            outdata[:] = self.outring[k % self.capacity]
+        else:
+            self.passthrough(k * self.blocksize - self.delay, outdata)
+            self.underruns += 1
+        self.counters[DUE] = k + 1
+        self.wake.set()
+
+    def passthrough(self, start, outdata):
+        # the input from sample start on, from the ring (a mono input 
+        # goes to every output channel)
+        size = len(self.inflat)
+        if start < 0:
+            outdata[:-start].fill(0)
+            outdata, start = outdata[-start:], 0
+        p = start % size
+        first = min(len(outdata), size - p)
+        outdata[:first] = self.inflat[p:p + first]
+        outdata[first:] = self.inflat[:len(outdata) - first]
+
+    # worker
+
+    def loop(self):
+        counters = self.counters
+        next = 0
+        while not counters[STOP]:
+            self.wake.clear()
+            if counters[RECEIVED] <= next:
+                self.wake.wait(0.1)
+                continue
+            due = int(counters[DUE])
+            if next < due:  # already played through
+                counters[SKIPPED] += due - next
+                next = due
+                if counters[RECEIVED] <= next:
+                    continue
+            slot = next % self.capacity
+            self.process(self.inring[slot], self.outring[slot])
+            counters[DONE] = next + 1
+            next += 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.counters[STOP] = 1
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def report(self):
+        return ("%d blocks, %d safety blocks (%d samples of latency), "
+                "%d underruns passed through, %d blocks skipped" % (
+                self.counters[RECEIVED], self.safety,
+                self.safety * self.blocksize, self.underruns,
+                self.counters[SKIPPED]))
+
+
+def serve(factory, name, worker):
+    # the worker process: attach to the rings and run the loop
+    memory = multiprocessing.shared_memory.SharedMemory(name)
+    worker.process = factory()
+    worker.allocate(memory.buf)
+    try:
+        worker.loop()
+    finally:
+        del worker.counters, worker.inring, worker.outring, worker.inflat
+        memory.close()
+
+
+class ProcessWorker(Worker):
+    """
+    A Worker whose loop runs in another process. factory is called there
+    (so it must be picklable, e.g. a module level function or a
+    functools.partial of one) and returns process(indata, out).
+    """
+    def __init__(self, factory, blocksize, channels=2, dtype="float32",
+                 safety=2, delay=0):
+        self.factory = factory
+        self.memory = None
+        self.child = None
+        Worker.__init__(self, None, blocksize, channels, dtype, safety, delay)
+
+    def allocate(self, buffer=None):
+        if buffer is not None:  # in the child
+            return Worker.allocate(self, buffer)
+        size = Worker.allocate(self)  # work out the size
+        self.memory = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=size)
+        self.wake = multiprocessing.Event()
+        return Worker.allocate(self, self.memory.buf)
+
+    def __getstate__(self):
+        # what the child needs: the settings and the event, not the arrays
+        return {"blocksize": self.blocksize, "channels": self.channels,
+                "inchannels": self.inchannels,
+                "outchannels": self.outchannels, "dtype": self.dtype, "capacity": self.capacity,
+                "wake": self.wake}
+
+    def start(self):
+        self.child = multiprocessing.Process(target=serve,
+            args=(self.factory, self.memory.name, self), daemon=True)
+        self.child.start()
+
+    def close(self):
+        self.counters[STOP] = 1
+        self.wake.set()
+        if self.child is not None:
+            self.child.join()
+            self.child = None
+        if self.memory is not None:
+            counters = self.counters.copy()  # still readable for report()
+            del self.counters, self.inring, self.outring, self.inflat
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+            self.counters = counters
+
+
+def delayed(indata, out):
+    # a stand-in process for main(): half the input, slow now and then
+    out[:] = indata * 0.5
+    delayed.blocks = getattr(delayed, "blocks", 0) + 1
+    if delayed.blocks % 50 == 0:
+        time.sleep(0.1)
+
+
+def makeDelayed():
+    return delayed
+
+
+def main():
+    blocksize, samplerate = 256, 44100
+    period = blocksize / samplerate
+    x = numpy.random.standard_normal([blocksize * 400, 2]).astype(numpy.float32)
+    for worker in (Worker(delayed, blocksize, safety=3),
+                   ProcessWorker(makeDelayed, blocksize, safety=3)):
+        y = numpy.zeros_like(x)
+        worker.start()
+        start = time.perf_counter()
+        for i in range(0, len(x), blocksize):
+            # a callback every period, as the device would make them
+            time.sleep(max(0.0, start + i / blocksize * period
+                                - time.perf_counter()))
+            worker.callback(x[i:i + blocksize], y[i:i + blocksize],
+                blocksize, None, None)
+        worker.close()
+        lag = worker.safety * blocksize
+        processed = numpy.isclose(y[lag:], x[:-lag] * 0.5).all(axis=1)
+        passed = numpy.isclose(y[lag:], x[:-lag]).all(axis=1)
+        print(type(worker).__name__ + ":", worker.report())
+        print("  samples processed %d, passed through %d, other %d" % (
+            processed.sum(), passed.sum(), (~processed & ~passed).sum()))
+
+
+if __name__ == "__main__":
+    main()
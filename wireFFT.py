@@ -4,9 +4,7 @@ https://app.assembla.com/spaces/portaudio/git/source/master/test/patest_wire.c
 """
 import argparse
 
-import sounddevice as sd
-import numpy  # Make sure NumPy is loaded before it is used in the callback
-assert numpy  # avoid "imported but unused" message (W0611)
+# sounddevice and NumPy are imported once the arguments are known
 
 
 def int_or_str(text):
@@ -23,6 +21,7 @@ parser.add_argument(
     help='show list of audio devices and exit')
 args, remaining = parser.parse_known_args()
 if args.list_devices:
+    import sounddevice as sd
     print(sd.query_devices())
     parser.exit(0)
 parser = argparse.ArgumentParser(
@@ -38,23 +37,56 @@ parser.add_argument(
 parser.add_argument(
     '-c', '--channels', type=int, default=2,
     help='number of channels')
-parser.add_argument('--dtype', help='audio data type')
+parser.add_argument('--dtype', default='float32',
+                    help='audio data type, kept through the processing: float32, '
+                         'int16 or float64 (default: %(default)s)')
 parser.add_argument('--samplerate', type=float, help='sampling rate')
 parser.add_argument('--blocksize', type=int, help='block size', default=1024)
 parser.add_argument('--latency', type=float, help='latency in seconds')
+parser.add_argument('--fft', default='numpy',
+                    help='FFT backend: numpy, scipy, fftw or auto (default: %(default)s)')
+parser.add_argument('--simulate', metavar='FILE',
+                    help='play FILE through a simulated device instead of the '
+                         'sound card and report latency, overruns and '
+                         'glitches (see SimStream.py)')
+parser.add_argument('--capture', metavar='FILE',
+                    help='with --simulate, write the output played to FILE')
+parser.add_argument('--cache', nargs='?', const='', metavar='DIR',
+                    help='keep FFTW wisdom and the --fft auto choice in DIR '
+                         'between runs (default DIR: $SONGFINDER_CACHE or '
+                         '~/.cache/songfinder)')
 args = parser.parse_args(remaining)
 
+if args.simulate:
+    import functools
+    import SimStream
+    Stream = functools.partial(SimStream.Stream, source=args.simulate)
+else:
+    import sounddevice as sd
+    Stream = sd.Stream
+import numpy  # Make sure NumPy is loaded before it is used in the callback
+import FFTBackends
+import OlaFFT
+import TableCache
+if args.cache is not None:
+    TableCache.enable(args.cache or None)
+
 first = True
-parser.parse_args()  # needed to prevent blocksize from being 'none' in overlap computation
 blocksize = args.blocksize
 overlap = blocksize // 2
+# int16 is worked on as float32 at +-1: the scaling is in the mask
+real, scale = OlaFFT.precision(args.dtype)
 
 # create global areas for buffering and processing of channel data
-inbuffer = numpy.zeros([blocksize * 3, 2])
-outbuffer = numpy.zeros([blocksize + overlap * 2, 2])
-timedata = numpy.zeros([blocksize + overlap * 2, 2])
-channel = numpy.zeros([blocksize + overlap * 2])  # needs to be power of 2
-mask = numpy.hanning(blocksize + overlap * 2)  # blackman is another possibility
+inbuffer = numpy.zeros([blocksize * 3, 2], dtype=real)
+outbuffer = numpy.zeros([blocksize + overlap * 2, 2], dtype=real)
+timedata = numpy.zeros([blocksize + overlap * 2, 2], dtype=real)
+channel = numpy.zeros([blocksize + overlap * 2], dtype=real)  # needs to be power of 2
+mask = numpy.hanning(blocksize + overlap * 2).astype(real)  # blackman is another possibility
+if scale is not None:
+    mask /= scale
+    scratch = numpy.zeros([blocksize, 2], dtype=real)
+fft = FFTBackends.get(args.fft, shape=[blocksize + overlap * 2], dtype=real)
 
 
 def callback(indata, outdata, frames, time, status):
@@ -71,9 +103,9 @@ def callback(indata, outdata, frames, time, status):
     # replace timedata with inbuffer[blocksize - overlap:blocksize * 2 + overlap, :]?
     channel[:] = timedata[:, 0] * mask
     # do fft
-    freqdata = numpy.fft.rfft(channel)
+    freqdata = fft.rfft(channel)
     # do filtering here
-    channel = numpy.fft.irfft(freqdata)
+    channel = fft.irfft(freqdata)
 
     outbuffer[:, 0] += channel
 # end of loop for channels
@@ -83,19 +115,29 @@ def callback(indata, outdata, frames, time, status):
     outbuffer[:-overlap] = outbuffer[overlap:]  # left shift outbuffer
     outbuffer[-overlap:] = 0  # here, we do a add to the overlap and this zeroed area
 
-    outdata[:] = outbuffer[:blocksize]
+    if scale is None:
+        outdata[:] = outbuffer[:blocksize]
+    else:
+        OlaFFT.toint16(outbuffer[:blocksize], outdata, scratch, scale)
     first = False
 
 
 try:
-    with sd.Stream(device=(args.input_device, args.output_device),
-                   samplerate=args.samplerate, blocksize=args.blocksize,
-                   dtype=args.dtype, latency=args.latency,
-                   channels=args.channels, callback=callback):
-        print('#' * 80)
-        print('press Return to quit')
-        print('#' * 80)
-        input()
+    with Stream(device=(args.input_device, args.output_device),
+                samplerate=args.samplerate, blocksize=args.blocksize,
+                dtype=args.dtype, latency=args.latency,
+                channels=args.channels, callback=callback) as stream:
+        if args.simulate:
+            stream.wait()
+            print('simulated:', stream.report())
+            print(SimStream.analyse(stream, blocksize))
+            if args.capture:
+                stream.save(args.capture)
+        else:
+            print('#' * 80)
+            print('press Return to quit')
+            print('#' * 80)
+            input()
 except KeyboardInterrupt:
     parser.exit('')
 except Exception as e: